@@ -10,7 +10,7 @@ from django.contrib import messages
 from django.db.models import Q
 from django.utils.html import format_html
 import json
-from .models import Vision, Reply, Share, User, Category, Tweet, AppConfig
+from .models import Vision, Reply, Share, User, Category, Tweet, AppConfig, OutgoingTweet
 from .views import VisionViewSet
 
 
@@ -288,9 +288,17 @@ class AppConfigAdmin (admin.ModelAdmin):
     )
 
 
+class OutgoingTweetAdmin (admin.ModelAdmin):
+    list_display = ('__unicode__', 'kind', 'status', 'attempts', 'created_at', 'updated_at')
+    list_filter = ('status', 'kind', 'created_at')
+    raw_id_fields = ('requested_by', 'sender', 'vision', 'reply', 'share')
+    readonly_fields = ('attempts', 'error', 'tweet_id')
+
+
 admin.site.register(AppConfig, AppConfigAdmin)
 admin.site.register(Vision, VisionAdmin)
 admin.site.register(User, UserAdmin)
 admin.site.register(Reply, ReplyAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Tweet, TweetAdmin)
+admin.site.register(OutgoingTweet, OutgoingTweetAdmin)
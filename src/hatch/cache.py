@@ -1,15 +1,403 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from django.conf import settings
 from django.core import cache as django_cache
 from django.utils.timezone import now, timedelta
+from functools import wraps
+from threading import local, Condition, Event, Lock, RLock, Thread
+from time import sleep, time
+from uuid import uuid4
+from .utils import chunk
+import atexit
+
+from logging import getLogger
+log = getLogger(__name__)
 
 # A sentinel object to differentiate from None
 unspecified = object()
 
+
+class InvalidationChannel (object):
+    """
+    Carries the keys that one process has changed in the remote cache to the
+    other processes that may have buffered them. Each message is numbered;
+    subscribers poll with the number of the last message they've seen.
+
+    This implementation keeps its messages in memory, so it only reaches the
+    buffers in the current process. It is useful in tests, and as a stand-in
+    for the shared channel when running a single process.
+    """
+    def __init__(self, max_backlog=None):
+        self.max_backlog = max_backlog or getattr(settings, 'CACHE_INVALIDATION_MAX_BACKLOG', 1000)
+        self.lock = Lock()
+        self.seq = 0
+        self.messages = OrderedDict()
+
+    def publish(self, keys, origin=None):
+        with self.lock:
+            self.seq += 1
+            self.messages[self.seq] = (origin, list(keys))
+            while len(self.messages) > self.max_backlog:
+                self.messages.popitem(last=False)
+
+    def poll(self, since, origin=None):
+        """
+        Return the number of the latest message, and the set of keys changed
+        by other origins since the message numbered `since`. If the messages
+        since then are no longer available, the set of keys will be None.
+        """
+        with self.lock:
+            if since is None:
+                return self.seq, set()
+
+            if since > self.seq or (since < self.seq and since + 1 not in self.messages):
+                return self.seq, None
+
+            keys = set()
+            for seq in range(since + 1, self.seq + 1):
+                message_origin, message_keys = self.messages[seq]
+                if message_origin != origin:
+                    keys.update(message_keys)
+            return self.seq, keys
+
+
+class CacheInvalidationChannel (InvalidationChannel):
+    """
+    An invalidation channel that keeps its messages in the remote cache, so
+    that every process using the same cache sees them. Messages are kept for
+    CACHE_INVALIDATION_RETENTION seconds.
+    """
+    seq_key = 'cache-invalidation:seq'
+    message_key_format = 'cache-invalidation:%s'
+
+    def __init__(self, max_backlog=None, retention=None):
+        super(CacheInvalidationChannel, self).__init__(max_backlog)
+        self.retention = retention or getattr(settings, 'CACHE_INVALIDATION_RETENTION', 3600)
+
+    def get_message_key(self, seq):
+        return self.message_key_format % (seq,)
+
+    def next_seq(self):
+        cache = django_cache.cache
+        try:
+            return cache.incr(self.seq_key)
+        except ValueError:
+            # The counter doesn't exist yet (or has expired). Subscribers will
+            # notice that the count went backwards and start over.
+            cache.add(self.seq_key, 0, 30 * 24 * 60 * 60)
+            return cache.incr(self.seq_key)
+
+    def publish(self, keys, origin=None):
+        seq = self.next_seq()
+        django_cache.cache.set(self.get_message_key(seq), (origin, list(keys)), self.retention)
+
+    def poll(self, since, origin=None):
+        cache = django_cache.cache
+        seq = cache.get(self.seq_key) or 0
+
+        if since is None:
+            return seq, set()
+
+        if since > seq or seq - since > self.max_backlog:
+            return seq, None
+
+        message_keys = [self.get_message_key(n) for n in range(since + 1, seq + 1)]
+        messages = cache.get_many(message_keys) if message_keys else {}
+        if len(messages) < len(message_keys):
+            return seq, None
+
+        keys = set()
+        for message_origin, changed_keys in messages.itervalues():
+            if message_origin != origin:
+                keys.update(changed_keys)
+        return seq, keys
+
+
+class LocalCache (object):
+    """
+    A process-local, size-bounded cache. Entries expire after their timeout
+    and, once the cache is full, the least recently used entries are evicted
+    to make room for new ones.
+
+    A LocalCache is shared by all of the threads in a process, so every
+    operation on it is done while holding its lock.
+
+    If it is given an invalidation channel, the cache announces the keys that
+    it writes to the remote cache on the channel, and drops keys that other
+    processes have announced. It checks the channel at most once every
+    CACHE_BUFFER_SYNC_INTERVAL seconds, which bounds how long a value changed
+    elsewhere may be served from here.
+    """
+    def __init__(self, initial_data=None, max_size=None, timeout=None,
+                 channel=None, sync_interval=None):
+        self.lock = RLock()
+        self.max_size = max_size or getattr(settings, 'CACHE_BUFFER_MAX_SIZE', 10000)
+        self.default_timeout = timeout or getattr(settings, 'CACHE_BUFFER_TIMEOUT', 300)
+
+        # Each entry is stored as a (value, expiration time) pair, ordered
+        # from least to most recently used.
+        self.data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.channel = channel
+        self.sync_interval = sync_interval or getattr(settings, 'CACHE_BUFFER_SYNC_INTERVAL', 1)
+        self.origin = uuid4().hex
+        self.synced_seq = None
+        self.next_sync = 0
+
+        if initial_data:
+            self.update(initial_data)
+
+    def get_expiry(self, timeout=unspecified):
+        if timeout is unspecified or not timeout:
+            timeout = self.default_timeout
+        return time() + timeout
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value, expiry = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+
+            if expiry <= time():
+                self.misses += 1
+                raise KeyError(key)
+
+            # Re-insert the entry so that it is the most recently used.
+            self.data[key] = (value, expiry)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            try:
+                value, expiry = self.data[key]
+            except KeyError:
+                return False
+            return expiry > time()
+
+    def __len__(self):
+        return len(self.data)
+
+    def set(self, key, value, timeout=unspecified):
+        with self.lock:
+            try: del self.data[key]
+            except KeyError: pass
+
+            self.data[key] = (value, self.get_expiry(timeout))
+            self.cull()
+
+    def update(self, mapping, timeout=unspecified):
+        expiry = self.get_expiry(timeout)
+        with self.lock:
+            for key, value in mapping.iteritems():
+                try: del self.data[key]
+                except KeyError: pass
+
+                self.data[key] = (value, expiry)
+            self.cull()
+
+    def cull(self):
+        with self.lock:
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def discard_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def publish(self, keys):
+        """
+        Tell other processes that the given keys have changed in the remote
+        cache.
+        """
+        if self.channel is not None and keys:
+            self.channel.publish(keys, self.origin)
+
+    def invalidate(self, keys):
+        """
+        Drop the given keys here and in every other process.
+        """
+        self.discard_many(keys)
+        self.publish(keys)
+
+    def sync(self):
+        """
+        Drop any keys that other processes have changed since we last looked.
+        """
+        if self.channel is None or time() < self.next_sync:
+            return
+
+        with self.lock:
+            self.next_sync = time() + self.sync_interval
+            since = self.synced_seq
+
+        seq, keys = self.channel.poll(since, self.origin)
+
+        with self.lock:
+            self.synced_seq = seq
+            if keys is None:
+                # We've fallen too far behind to know what changed, so assume
+                # that everything did.
+                self.data.clear()
+            else:
+                for key in keys:
+                    self.data.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def write_to_cache(queue, timeouts, delete_queue, batch_size=None):
+    """
+    Write a queue of values and a queue of deletions to the remote cache,
+    with one set_many for each distinct timeout.
+    """
+    timed_queues = defaultdict(dict)
+
+    if queue:
+        for key, value in queue.iteritems():
+            timeout = timeouts.get(key, unspecified)
+            timed_queues[timeout][key] = value
+
+        for timeout, timed_queue in timed_queues.iteritems():
+            for key_group in chunk(timed_queue.keys(), batch_size or len(timed_queue)):
+                batch = dict([(key, timed_queue[key]) for key in key_group])
+                if timeout is not unspecified:
+                    django_cache.cache.set_many(batch, timeout)
+                else:
+                    django_cache.cache.set_many(batch)
+
+    if delete_queue:
+        for key_group in chunk(delete_queue, batch_size or len(delete_queue)):
+            django_cache.cache.delete_many(key_group)
+
+
+class WriteBehindFlusher (object):
+    """
+    Collects the queues flushed from any number of cache buffers and writes
+    them to the remote cache from a background thread, so that requests don't
+    wait on cache writes before responding.
+
+    Writes to the same key are coalesced; only the latest value (or deletion)
+    for each key is sent. Pending writes go out every CACHE_BUFFER_WRITE_BEHIND_
+    INTERVAL seconds, or sooner once CACHE_BUFFER_WRITE_BEHIND_BATCH_SIZE keys
+    are waiting, in batches of at most that many keys (the redis cache backend
+    sends each batch as a single pipeline).
+    """
+    def __init__(self, interval=None, batch_size=None, on_write=None):
+        self.interval = interval or getattr(settings, 'CACHE_BUFFER_WRITE_BEHIND_INTERVAL', 1)
+        self.batch_size = batch_size or getattr(settings, 'CACHE_BUFFER_WRITE_BEHIND_BATCH_SIZE', 100)
+
+        self.condition = Condition()
+        self.queue = {}
+        self.timeouts = {}
+        self.delete_queue = set()
+        self.thread = None
+        self.stopped = False
+
+        # Called with the keys of each batch of writes, once they've been
+        # written.
+        self.on_write = on_write
+
+    def enqueue(self, queue, timeouts, delete_queue):
+        with self.condition:
+            for key, value in queue.iteritems():
+                self.queue[key] = value
+                self.timeouts[key] = timeouts.get(key, unspecified)
+                self.delete_queue.discard(key)
+
+            for key in delete_queue:
+                self.queue.pop(key, None)
+                self.timeouts.pop(key, None)
+                self.delete_queue.add(key)
+
+            if len(self.queue) + len(self.delete_queue) >= self.batch_size:
+                self.condition.notify()
+
+            self.start()
+
+    def start(self):
+        with self.condition:
+            if self.stopped:
+                return
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='cache-write-behind')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, writing anything still pending.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+        self.drain()
+
+    def run(self):
+        while not self.stopped:
+            with self.condition:
+                self.condition.wait(self.interval)
+            self.drain()
+
+    def drain(self):
+        """
+        Write everything that is pending to the remote cache right now.
+        """
+        with self.condition:
+            queue, timeouts, delete_queue = self.queue, self.timeouts, self.delete_queue
+            self.queue, self.timeouts, self.delete_queue = {}, {}, set()
+
+        try:
+            write_to_cache(queue, timeouts, delete_queue, self.batch_size)
+            if self.on_write is not None:
+                self.on_write(set(queue) | delete_queue)
+        except Exception:
+            log.exception('Failed to write %s key(s) behind to the cache' %
+                          (len(queue) + len(delete_queue),))
+
+
 class CacheBuffer (object):
-    def __init__(self, initial_buffer=None):
+    def __init__(self, initial_buffer=None, max_size=None, timeout=None, local_cache=None,
+                 max_queue_size=None, max_queue_age=None, write_behind=None):
         # When we get a value from the remote cache, it goes in to the buffer
-        # so that we can retrieve it quickly on our next try.
-        self.buffer = initial_buffer or {}
+        # so that we can retrieve it quickly on our next try. The buffer
+        # outlives any single request, so it is bounded and its entries
+        # expire along with the timeouts that they were set with. Several
+        # cache buffers may share the same local cache.
+        if local_cache is None:
+            local_cache = LocalCache(initial_buffer, max_size, timeout)
+        elif initial_buffer:
+            local_cache.update(initial_buffer)
+        self.buffer = local_cache
         self.timeouts = {}
 
         # When we set a value, it goes into the queue as well as the buffer.
@@ -18,7 +406,20 @@ class CacheBuffer (object):
         self.queue = {}
         self.delete_queue = set()
 
+        # If either of these is set, the queues will be flushed automatically
+        # once they hold that many keys, or once the oldest queued write is
+        # that many seconds old. Long-running jobs should set them so that
+        # their writes reach the remote cache while they're still running.
+        self.max_queue_size = max_queue_size
+        self.max_queue_age = max_queue_age
+        self.queued_at = None
+
+        # If a write-behind flusher is given, flushing hands the queues off to
+        # it instead of writing them to the remote cache directly.
+        self.write_behind = write_behind
+
     def get_many(self, keys):
+        self.buffer.sync()
         results = {}
         unseen_keys = []
 
@@ -36,30 +437,35 @@ class CacheBuffer (object):
                 results.update(new_results)
                 self.buffer.update(new_results)
 
-        # TODO: Is this what's supposed to happen? get_many returns None for
-        #       each key that wasn't found?
-        all_results = dict([(key, unspecified) for key in set(keys) - set(results.keys())])
-        self.buffer.update(all_results)
+            # Remember the keys that the remote cache doesn't have either, so
+            # that we don't keep asking for them.
+            missing_keys = set(unseen_keys) - set(results.keys())
+            self.buffer.update(dict([(key, unspecified) for key in missing_keys]))
+
         return results
 
     def get(self, key, default=None):
+        self.buffer.sync()
         try:
             value = self.buffer[key]
-            return None if value is unspecified else value
+            return default if value is unspecified else value
         except KeyError:
-            value = django_cache.cache.get(key, default)
+            value = django_cache.cache.get(key, unspecified)
             self.buffer[key] = value
-            return value
+            return default if value is unspecified else value
 
     def set(self, key, value, timeout=unspecified):
-        self.buffer[key] = self.queue[key] = value
+        self.buffer.set(key, value, timeout)
+        self.queue[key] = value
         self.timeouts[key] = timeout
 
         try: self.delete_queue.remove(key)
         except KeyError: pass
 
+        self.check_queue()
+
     def set_many(self, mapping, timeout=unspecified):
-        self.buffer.update(mapping)
+        self.buffer.update(mapping, timeout)
         self.queue.update(mapping)
 
         for key in mapping:
@@ -68,6 +474,8 @@ class CacheBuffer (object):
             try: self.delete_queue.remove(key)
             except KeyError: pass
 
+        self.check_queue()
+
     def delete(self, key):
         try: del self.queue[key]
         except KeyError: pass
@@ -79,6 +487,7 @@ class CacheBuffer (object):
         except KeyError: pass
 
         self.delete_queue.add(key)
+        self.check_queue()
 
     def delete_many(self, keys):
         for key in keys:
@@ -92,29 +501,303 @@ class CacheBuffer (object):
             except KeyError: pass
 
         self.delete_queue.update(keys)
+        self.check_queue()
 
-    def flush(self):
-        timed_queues = defaultdict(dict)
+    def check_queue(self):
+        """
+        Flush the queues if they have gotten too big or too old.
+        """
+        if self.queued_at is None:
+            self.queued_at = time()
 
-        if self.queue:
-            for key, value in self.queue.iteritems():
-                timeout = self.timeouts[key]
-                timed_queues[timeout][key] = value
+        queue_size = len(self.queue) + len(self.delete_queue)
+        if self.max_queue_size and queue_size >= self.max_queue_size:
+            self.flush()
+        elif self.max_queue_age and time() - self.queued_at >= self.max_queue_age:
+            self.flush()
 
-            for timeout, queue in timed_queues.iteritems():
-                if timeout is not unspecified:
-                    django_cache.cache.set_many(queue, timeout)
-                else:
-                    django_cache.cache.set_many(queue)
+    def flush(self):
+        if self.write_behind is not None:
+            self.write_behind.enqueue(self.queue, self.timeouts, self.delete_queue)
+        else:
+            write_to_cache(self.queue, self.timeouts, self.delete_queue)
+            self.buffer.publish(set(self.queue) | self.delete_queue)
 
-        if self.delete_queue:
-            django_cache.cache.delete_many(self.delete_queue)
-        
         self.reset()
 
+    def invalidate(self, keys):
+        """
+        Drop keys that have been changed in the remote cache by some other
+        means from this buffer, and from the buffers of other processes.
+        """
+        for key in keys:
+            self.queue.pop(key, None)
+            self.timeouts.pop(key, None)
+        self.buffer.invalidate(keys)
+
     def reset(self):
         self.queue = {}
         self.delete_queue = set()
         self.timeouts = {}
+        self.queued_at = None
+
+    def clear(self):
+        """
+        Drop everything from the local buffer as well as the queues.
+        """
+        self.reset()
+        self.buffer.clear()
+
+    def remember(self, key, value, timeout=unspecified):
+        """
+        Put a value that has already been written to the remote cache into
+        the buffer, without queueing it to be written again.
+        """
+        self.buffer.set(key, value, timeout)
+        self.buffer.publish([key])
+
+    def stats(self):
+        return self.buffer.stats()
+
+
+class CacheBufferScope (object):
+    """
+    Binds a fresh buffer to the current thread for the duration of a block of
+    work, and flushes it when the block exits. Use it as a context manager:
+
+        with cache_buffer.scope():
+            ...
+
+    or as a decorator on tasks and commands:
+
+        @cache_buffer.scope()
+        def refresh_users():
+            ...
+
+    Unless told otherwise, the scoped buffer is flushed automatically each
+    time its queues reach CACHE_BUFFER_SCOPE_MAX_QUEUE_SIZE keys or
+    CACHE_BUFFER_SCOPE_MAX_QUEUE_AGE seconds of age.
+    """
+    def __init__(self, thread_local_buffer, max_queue_size=None, max_queue_age=None):
+        self.thread_local_buffer = thread_local_buffer
+        self.max_queue_size = max_queue_size or getattr(settings, 'CACHE_BUFFER_SCOPE_MAX_QUEUE_SIZE', 500)
+        self.max_queue_age = max_queue_age or getattr(settings, 'CACHE_BUFFER_SCOPE_MAX_QUEUE_AGE', 30)
+        # The same scope may be entered from several threads at once (e.g.,
+        # when it decorates a task), so keep track of the buffers that it
+        # replaces per-thread.
+        self.outer = local()
+
+    @property
+    def outer_buffers(self):
+        try:
+            return self.outer.buffers
+        except AttributeError:
+            self.outer.buffers = []
+            return self.outer.buffers
+
+    def __enter__(self):
+        self.outer_buffers.append(self.thread_local_buffer.bound())
+        return self.thread_local_buffer.bind(
+            max_queue_size=self.max_queue_size,
+            max_queue_age=self.max_queue_age,
+            write_behind=None)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.thread_local_buffer.flush()
+        finally:
+            self.thread_local_buffer.restore(self.outer_buffers.pop())
+
+    def __call__(self, func):
+        @wraps(func)
+        def scoped(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return scoped
+
+
+class ThreadLocalCacheBuffer (object):
+    """
+    Stands in for a CacheBuffer, delegating to a buffer that belongs to the
+    current thread (or greenlet, when threading is monkey-patched by gevent).
+    Each of those buffers has its own write queues, so concurrent requests
+    never flush each other's pending keys, but they all read through the same
+    process-local cache.
+
+    Use bind() at the start of a unit of work (e.g., a request) to give it a
+    fresh buffer, and release() when it's done.
+
+    If CACHE_BUFFER_WRITE_BEHIND is set, the bound buffers flush through a
+    shared WriteBehindFlusher. Buffers bound by a scope() always write to the
+    remote cache directly.
+
+    Unless CACHE_BUFFER_INVALIDATION is off, the local cache is kept in sync
+    with other processes through a CacheInvalidationChannel.
+    """
+    def __init__(self, max_size=None, timeout=None, write_behind=None, channel=None):
+        if channel is None and getattr(settings, 'CACHE_BUFFER_INVALIDATION', True):
+            channel = CacheInvalidationChannel()
+
+        self.local_cache = LocalCache(max_size=max_size, timeout=timeout, channel=channel)
+        self.thread_buffers = local()
+
+        if write_behind is None and getattr(settings, 'CACHE_BUFFER_WRITE_BEHIND', False):
+            write_behind = WriteBehindFlusher(on_write=self.local_cache.publish)
+            atexit.register(write_behind.stop)
+        self.write_behind = write_behind
+
+    def current(self):
+        try:
+            return self.thread_buffers.buffer
+        except AttributeError:
+            return self.bind()
+
+    def bound(self):
+        """
+        Return the buffer bound to the current thread, or None.
+        """
+        return getattr(self.thread_buffers, 'buffer', None)
+
+    def bind(self, **kwargs):
+        kwargs.setdefault('write_behind', self.write_behind)
+        buffer = CacheBuffer(local_cache=self.local_cache, **kwargs)
+        self.thread_buffers.buffer = buffer
+        return buffer
+
+    def restore(self, buffer):
+        if buffer is None:
+            self.release()
+        else:
+            self.thread_buffers.buffer = buffer
+
+    def release(self):
+        try: del self.thread_buffers.buffer
+        except AttributeError: pass
+
+    def scope(self, max_queue_size=None, max_queue_age=None):
+        return CacheBufferScope(self, max_queue_size, max_queue_age)
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+cache_buffer = ThreadLocalCacheBuffer()
+
+
+class _Flight (object):
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight (object):
+    """
+    Makes sure that, when a cached value is missing, only one caller at a time
+    goes to fetch it, instead of every thread in every process hitting the
+    API at once.
+
+    Within a process, callers that ask for a key that is already being fetched
+    wait for, and share, the result. Across processes, a lock key in the
+    shared cache decides who fetches; everyone else polls the shared cache for
+    the fetched value. If it doesn't show up within SINGLE_FLIGHT_WAIT_TIMEOUT
+    seconds, they fetch it themselves.
+
+    Callers that would rather have an old value than wait or fetch can ask
+    for a stale copy to be kept (keep_stale). It is a second copy of the
+    value, kept for SINGLE_FLIGHT_STALE_TIMEOUT seconds, so it is meant for
+    a few small keys, not for every user's info.
+    """
+    lock_key_format = '%s:lock'
+    stale_key_format = '%s:stale'
+
+    def __init__(self, buffer, lock_timeout=None, wait_timeout=None,
+                 poll_interval=None, stale_timeout=None):
+        self.buffer = buffer
+        self.lock_timeout = lock_timeout or getattr(settings, 'SINGLE_FLIGHT_LOCK_TIMEOUT', 30)
+        self.wait_timeout = wait_timeout or getattr(settings, 'SINGLE_FLIGHT_WAIT_TIMEOUT', 5)
+        self.poll_interval = poll_interval or getattr(settings, 'SINGLE_FLIGHT_POLL_INTERVAL', 0.1)
+        self.stale_timeout = stale_timeout or getattr(settings, 'SINGLE_FLIGHT_STALE_TIMEOUT', 7 * 24 * 60 * 60)
+
+        self.lock = Lock()
+        self.flights = {}
+
+    def do(self, key, fetch, timeout=unspecified, max_wait=None, keep_stale=False):
+        """
+        Return a fresh value for the given key, calling fetch() to get it if
+        no one else is already doing so. Waits at most max_wait seconds (if
+        given) for someone else's fetch before settling for a stale value, if
+        keep_stale is set, or fetching it anyway.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self.flights[key] = _Flight()
+
+        if not is_leader:
+            wait = self.wait_timeout + self.lock_timeout
+            flight.done.wait(wait if max_wait is None else max(min(wait, max_wait), 0))
+            if flight.error is not None:
+                raise flight.error
+            if flight.done.is_set():
+                return flight.value
+            return self.fetch(key, fetch, timeout, max_wait, keep_stale)
+
+        try:
+            flight.value = self.fetch(key, fetch, timeout, max_wait, keep_stale)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def get_stale(self, key):
+        """
+        Return the last value that was fetched for the key, if any. Only
+        keys fetched with keep_stale have one.
+        """
+        return django_cache.cache.get(self.stale_key_format % (key,))
+
+    def fetch(self, key, fetch, timeout=unspecified, max_wait=None, keep_stale=False):
+        cache = django_cache.cache
+        lock_key = self.lock_key_format % (key,)
+        stale_key = self.stale_key_format % (key,)
+
+        if not cache.add(lock_key, True, self.lock_timeout):
+            # Someone else is fetching the value; wait for it to show up.
+            wait = self.wait_timeout if max_wait is None else min(self.wait_timeout, max_wait)
+            deadline = time() + wait
+            while time() < deadline:
+                sleep(self.poll_interval)
+                value = cache.get(key)
+                if value is not None:
+                    self.buffer.remember(key, value, timeout)
+                    return value
+
+            if keep_stale:
+                value = cache.get(stale_key)
+                if value is not None:
+                    log.info('Gave up waiting on a fresh value for %s; using a '
+                             'stale one' % (key,))
+                    return value
+
+            lock_key = None
+
+        try:
+            value = fetch()
+            if keep_stale:
+                cache.set(stale_key, value, self.stale_timeout)
+            if timeout is not unspecified:
+                cache.set(key, value, timeout)
+            else:
+                cache.set(key, value)
+            self.buffer.remember(key, value, timeout)
+            return value
+        finally:
+            if lock_key is not None:
+                cache.delete(lock_key)
 
-cache_buffer = CacheBuffer()
+single_flight = SingleFlight(cache_buffer)
@@ -0,0 +1,154 @@
+"""
+Keeping slow or failing Twitter calls from holding up page rendering.
+
+The ``CircuitBreaker`` counts the calls to Twitter that time out, fail to
+connect, or get a server error. After TWITTER_CIRCUIT_BREAKER_THRESHOLD
+failures in a row, it opens: calls fail right away with ``TwitterUnavailable``
+instead of going out, until TWITTER_CIRCUIT_BREAKER_RESET_TIMEOUT seconds have
+passed. Then one call is let through to see whether Twitter is back. The
+breaker is kept in process memory, so each process finds out for itself.
+
+Each thread can also have a deadline for its calls, set with ``time_budget``.
+Calls are cut short when the deadline arrives, and calls made after it fail
+right away, so a request that needs Twitter finishes in bounded time.
+Callers handle ``TwitterUnavailable`` like any other error from Twitter, and
+fall back on cached or blank data.
+"""
+
+from django.conf import settings
+from contextlib import contextmanager
+from threading import local, Lock
+from time import time
+from twitter import TwitterHTTPError
+from urllib2 import HTTPError
+import json
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class TwitterUnavailable (TwitterHTTPError):
+    """
+    Raised instead of making a call that the circuit breaker or the time
+    budget won't allow, or when a call doesn't get a response. It looks like
+    the 503 response Twitter sends when it is over capacity, so that callers
+    can handle it the same way.
+    """
+    def __init__(self, endpoint, reason):
+        self.endpoint = endpoint
+        self.reason = reason
+        self.e = HTTPError(endpoint, 503, 'Service Unavailable', {}, None)
+        self.uri = endpoint
+        self.format = ''
+        self.uriparts = None
+        self.response_data = json.dumps({'errors': [{
+            'code': 130, 'message': reason}]})
+        Exception.__init__(self, 'Not calling %s: %s' % (endpoint, reason))
+
+    def __str__(self):
+        return self.args[0]
+
+
+class CircuitBreaker (object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold or settings.TWITTER_CIRCUIT_BREAKER_THRESHOLD
+        self.reset_timeout = reset_timeout or settings.TWITTER_CIRCUIT_BREAKER_RESET_TIMEOUT
+        self.lock = Lock()
+        self.local = local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    # ==================================================================
+    # How long the current thread has left for its calls
+
+    def get_deadline(self):
+        return getattr(self.local, 'deadline', None)
+
+    def get_time_left(self):
+        deadline = self.get_deadline()
+        if deadline is None:
+            return None
+        return deadline - time()
+
+    @contextmanager
+    def deadline(self, deadline):
+        """
+        Have calls in the current thread give up at the given time (e.g., to
+        hand a deadline on to worker threads). A deadline of None leaves the
+        calls unbounded; an earlier deadline that is already set still holds.
+        """
+        previous = self.get_deadline()
+        if previous is not None and (deadline is None or previous < deadline):
+            deadline = previous
+
+        self.local.deadline = deadline
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.local.deadline
+            else:
+                self.local.deadline = previous
+
+    def time_budget(self, seconds):
+        """
+        Have calls in the current thread give up after the given number of
+        seconds from now.
+        """
+        return self.deadline(time() + seconds if seconds is not None else None)
+
+    # ==================================================================
+    # The breaker
+
+    def before_call(self, endpoint):
+        """
+        Check that a call to the endpoint may go ahead. Returns the number of
+        seconds that the call has to finish in (or None if it has no limit),
+        and raises TwitterUnavailable if it may not go ahead at all.
+        """
+        time_left = self.get_time_left()
+        if time_left is not None and time_left <= 0:
+            raise TwitterUnavailable(endpoint, 'out of time for calls to Twitter')
+
+        with self.lock:
+            if self.state != self.CLOSED:
+                if time() - self.opened_at < self.reset_timeout:
+                    raise TwitterUnavailable(endpoint, 'Twitter has been failing; waiting for it to recover')
+
+                # Let this one call through to see whether Twitter is back.
+                # Others keep failing fast until it does (or until another
+                # reset timeout passes without hearing from it).
+                self.state = self.HALF_OPEN
+                self.opened_at = time()
+                log.info('\n*** Trying Twitter again after %s seconds\n' % (self.reset_timeout,))
+
+        return time_left
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                log.info('\n*** Twitter is back; closing the circuit breaker\n')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self, endpoint, reason):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    log.warning('\n*** Call to %s failed (%s); opening the circuit '
+                                'breaker for %s seconds\n' % (endpoint, reason, self.reset_timeout))
+                self.state = self.OPEN
+                self.opened_at = time()
+
+
+twitter_circuit = CircuitBreaker()
@@ -0,0 +1,321 @@
+"""
+A stand-in for the Twitter API, for benchmarks and offline tests.
+
+``FakeTwitterAPI`` answers the calls that the app makes (users/lookup,
+users/show, friends/ids, statuses/show, statuses/update, statuses/retweet,
+favorites/create, favorites/destroy and help/configuration) with made-up but
+consistent data. It plugs in where the connection pool would be, so every
+call still goes through the app's real transport, rate limit scheduler and
+error handling::
+
+    fake = FakeTwitterAPI(latency=(0.05, 0.2), error_rate=0.01, rate_limit=180)
+    service = TwitterService(connection_pool=fake)
+
+It can also stand in for the filter stream; see ``FakeTwitterAPI.get_stream``.
+To use it for the whole app, set TWITTER_FAKE_API to a dictionary of options
+for the fake in your local settings.
+"""
+
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+from mimetools import Message
+from random import Random
+from StringIO import StringIO
+from threading import Lock
+from time import sleep, time
+from urlparse import urlsplit, parse_qs
+import json
+import re
+
+
+class FakeTwitterAPI (object):
+    """
+    Options:
+
+    latency -- seconds to take answering each call; either a number, or a
+        (min, max) pair to pick from at random
+    error_rate -- the fraction of calls that fail with a 503
+    rate_limit -- the number of calls each token may make to each endpoint
+        per window; calls over the limit get a 429 (None for no limit)
+    rate_limit_window -- the length of a rate limit window, in seconds
+    missing_user_ids -- ids of users that Twitter "can't find"
+    friends_count -- how many users each user follows
+    stream_script -- what the filter stream sends; see get_stream
+    max_tweets -- how many of the latest tweets to remember, for
+        statuses/show, statuses/retweet and statuses/user_timeline
+    seed -- seed for the random numbers, for repeatable runs
+    """
+    def __init__(self, latency=0, error_rate=0, rate_limit=None,
+                 rate_limit_window=15 * 60, missing_user_ids=(),
+                 friends_count=100, stream_script=None, max_tweets=1000,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.missing_user_ids = set(str(user_id) for user_id in missing_user_ids)
+        self.friends_count = friends_count
+        self.stream_script = stream_script
+        self.max_tweets = max_tweets
+
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(int)
+            self.windows = {}
+            self.next_tweet_id = 1000000
+            self.tweets = OrderedDict()
+
+    # ==================================================================
+    # The connection pool interface
+
+    def request(self, method, url, body=None, headers={}, read_timeout=None):
+        _, _, path, query, _ = urlsplit(url)
+        params = dict((key, values[0]) for key, values in
+                      parse_qs(query if method == 'GET' else body or '').items())
+        endpoint, resource_id = self.parse_path(path)
+        token = self.get_token(headers, params)
+
+        with self.lock:
+            self.calls[endpoint] += 1
+            over_limit, rate_limit_headers = self.count_call(endpoint, token)
+            failed = self.random.random() < self.error_rate
+            latency = self.pick_latency()
+
+        if latency:
+            sleep(latency)
+
+        if over_limit:
+            return self.respond(429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, rate_limit_headers)
+
+        if failed:
+            return self.respond(503, {'errors': [{'code': 130, 'message': 'Over capacity'}]}, rate_limit_headers)
+
+        handler = getattr(self, 'handle_' + endpoint.replace('/', '_'), None)
+        if handler is None:
+            return self.respond(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist'}]})
+
+        status, data = handler(resource_id=resource_id, token=token, **params)
+        return self.respond(status, data, rate_limit_headers)
+
+    def close(self):
+        pass
+
+    # ==================================================================
+    # Helpers
+
+    def parse_path(self, path):
+        # '/1.1/statuses/retweet/123.json' => ('statuses/retweet', '123')
+        path = re.sub(r'\.json$', '', path)
+        parts = [part for part in path.split('/') if part][1:]
+        resource_id = None
+        if parts and parts[-1].isdigit():
+            resource_id = parts.pop()
+        return '/'.join(parts), resource_id
+
+    def get_token(self, headers, params):
+        if 'oauth_token' in params:
+            return params['oauth_token']
+        match = re.search(r'oauth_token="([^"]*)"', headers.get('Authorization', ''))
+        return match.group(1) if match else None
+
+    def pick_latency(self):
+        if isinstance(self.latency, (tuple, list)):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    def count_call(self, endpoint, token):
+        if self.rate_limit is None:
+            return False, {}
+
+        now = time()
+        key = (endpoint, token)
+        reset, used = self.windows.get(key, (0, 0))
+        if reset <= now:
+            reset, used = int(now) + self.rate_limit_window, 0
+        used += 1
+        self.windows[key] = (reset, used)
+
+        return used > self.rate_limit, {
+            'x-rate-limit-limit': str(self.rate_limit),
+            'x-rate-limit-remaining': str(max(self.rate_limit - used, 0)),
+            'x-rate-limit-reset': str(reset),
+        }
+
+    def respond(self, status, data, headers={}):
+        reasons = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests',
+                   503: 'Service Unavailable'}
+        header_lines = ['Content-Type: application/json; charset=utf-8']
+        header_lines += ['%s: %s' % item for item in headers.items()]
+        message = Message(StringIO('\r\n'.join(header_lines) + '\r\n\r\n'))
+        return status, reasons.get(status, ''), message, json.dumps(data)
+
+    # ==================================================================
+    # Made-up data
+
+    def make_user(self, user_id):
+        user_id = str(user_id)
+        return {
+            'id': int(user_id),
+            'id_str': user_id,
+            'screen_name': 'user%s' % user_id,
+            'name': 'User %s' % user_id,
+            'description': 'A made-up user',
+            'profile_image_url': 'http://example.com/avatars/%s_normal.png' % user_id,
+        }
+
+    def get_user_id_for_token(self, token):
+        # Tokens look like '<user id>-<secret stuff>'
+        match = re.match(r'^(\d+)-', token or '')
+        return match.group(1) if match else '1'
+
+    def make_tweet(self, text, user_id, **extra):
+        tweet = {
+            'text': text,
+            'created_at': datetime.utcnow().strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'user': self.make_user(user_id),
+            'in_reply_to_status_id': None,
+            'in_reply_to_status_id_str': None,
+            'entities': {'hashtags': [], 'urls': [], 'user_mentions': []},
+        }
+        tweet.update(extra)
+
+        # Only the latest tweets are kept, so that a long-running stream
+        # doesn't fill up memory. They are kept oldest first.
+        with self.lock:
+            self.next_tweet_id += 1
+            tweet['id'] = self.next_tweet_id
+            tweet['id_str'] = str(self.next_tweet_id)
+
+            self.tweets[tweet['id']] = tweet
+            while len(self.tweets) > self.max_tweets:
+                self.tweets.popitem(last=False)
+        return tweet
+
+    # ==================================================================
+    # Endpoints
+
+    def handle_help_configuration(self, **params):
+        return 200, {
+            'characters_reserved_per_media': 23,
+            'max_media_per_upload': 1,
+            'short_url_length': 22,
+            'short_url_length_https': 23,
+        }
+
+    def handle_users_show(self, user_id=None, **params):
+        if user_id is None or str(user_id) in self.missing_user_ids:
+            return 404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist'}]}
+        return 200, self.make_user(user_id)
+
+    def handle_users_lookup(self, user_id='', **params):
+        users = [self.make_user(user_id) for user_id in user_id.split(',')
+                 if user_id and user_id not in self.missing_user_ids]
+        if not users:
+            return 404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist'}]}
+        return 200, users
+
+    def handle_friends_ids(self, user_id=None, **params):
+        if user_id is None or str(user_id) in self.missing_user_ids:
+            return 404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist'}]}
+
+        # The same user always follows the same people
+        friends = Random(user_id).sample(xrange(1, 100 * self.friends_count + 1), self.friends_count)
+        return 200, {
+            'ids': friends,
+            'next_cursor': 0, 'next_cursor_str': '0',
+            'previous_cursor': 0, 'previous_cursor_str': '0',
+        }
+
+    def handle_statuses_show(self, resource_id=None, id=None, **params):
+        tweet = self.tweets.get(int(resource_id or id or 0))
+        if tweet is None:
+            return 404, {'errors': [{'code': 144, 'message': 'No status found with that ID.'}]}
+        return 200, tweet
+
+    def handle_statuses_update(self, status='', token=None, in_reply_to_status_id=None, **params):
+        extra = {}
+        if in_reply_to_status_id:
+            extra = {'in_reply_to_status_id': int(in_reply_to_status_id),
+                     'in_reply_to_status_id_str': str(in_reply_to_status_id)}
+        return 200, self.make_tweet(status.decode('utf8'), self.get_user_id_for_token(token), **extra)
+
+    def handle_statuses_retweet(self, resource_id=None, token=None, **params):
+        original = self.tweets.get(int(resource_id or 0))
+        if original is None:
+            return 404, {'errors': [{'code': 144, 'message': 'No status found with that ID.'}]}
+        user_id = self.get_user_id_for_token(token)
+        return 200, self.make_tweet('RT @%s: %s' % (original['user']['screen_name'], original['text']),
+                                    user_id, retweeted_status=original)
+
+    def handle_statuses_user_timeline(self, user_id=None, since_id=None, count=20, **params):
+        tweets = []
+        with self.lock:
+            for tweet_id in reversed(self.tweets):
+                if len(tweets) >= int(count) or tweet_id <= int(since_id or 0):
+                    break
+                if self.tweets[tweet_id]['user']['id_str'] == str(user_id):
+                    tweets.append(self.tweets[tweet_id])
+        return 200, tweets
+
+    def handle_favorites_create(self, id=None, **params):
+        return self.handle_statuses_show(id=id)
+
+    handle_favorites_destroy = handle_favorites_create
+
+    # ==================================================================
+    # The filter stream
+
+    def get_stream(self, **kwargs):
+        return FakeTwitterStream(self)
+
+    def generate_stream(self, track='', follow='', rate=10, count=None):
+        """
+        Send ``rate`` tweets per second, each from a made-up user and
+        mentioning one of the tracked terms, with None between tweets (as the
+        non-blocking stream does when it has nothing to send). Stops after
+        ``count`` tweets, if given.
+        """
+        terms = [term.strip() for term in track.split(',') if term.strip()] or ['hello']
+        user_ids = [user_id for user_id in follow.split(',') if user_id] or ['1']
+        interval = 1.0 / rate
+        sent = 0
+
+        while count is None or sent < count:
+            next_at = time() + interval
+            yield self.make_tweet(
+                'Just a made-up tweet about %s' % self.random.choice(terms),
+                self.random.choice(user_ids))
+            sent += 1
+
+            while time() < next_at:
+                yield None
+                sleep(min(0.01, interval))
+
+
+class FakeTwitterStream (object):
+    """
+    Stands in for ``twitter.stream.TwitterStream``. The stream_script of the
+    fake API can be a list of messages (tweets, deletes, disconnects, or None
+    for a moment with nothing to send), or a callable that takes the filter
+    parameters and returns an iterable of them. By default, the stream sends
+    a steady trickle of made-up tweets; see FakeTwitterAPI.generate_stream.
+    """
+    def __init__(self, api):
+        self.api = api
+
+    @property
+    def statuses(self):
+        return self
+
+    def filter(self, **params):
+        script = self.api.stream_script
+        if script is None:
+            return self.api.generate_stream(**params)
+        elif callable(script):
+            return iter(script(**params))
+        else:
+            return iter(script)
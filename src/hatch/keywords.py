@@ -0,0 +1,139 @@
+"""
+Matching tweet text against the tracked keywords.
+
+The tracking keywords are a list of terms, one per line. Like Twitter's track
+parameter (https://dev.twitter.com/docs/streaming-apis/parameters#track), a
+term matches when the text contains every one of its words, and the text
+matches when any of the terms does. We are a little more lenient than Twitter,
+though: case is ignored, and words match anywhere in the text, not only as
+whole words.
+
+``KeywordMatcher`` puts all of the words into one Aho-Corasick automaton, so
+that a tweet is checked in one pass over its text, however many terms there
+are. For a short list of words, looking for each word in turn is faster (the
+search runs in C), so the matcher does that instead. See
+scripts/benchmark_keywords.py.
+"""
+
+from collections import deque
+
+
+class KeywordMatcher (object):
+    # Up to this many distinct words, look for each word in turn instead of
+    # running the automaton.
+    scan_threshold = 32
+
+    def __init__(self, terms):
+        """
+        Build a matcher for the given terms; each term is a string of words
+        separated by whitespace. Blank terms are ignored.
+        """
+        words = {}
+        self.terms = []
+        for term in terms:
+            term_words = set(term.lower().split())
+            if term_words:
+                self.terms.append(frozenset(
+                    words.setdefault(word, len(words)) for word in term_words))
+
+        # For each word, the terms that it is a part of
+        self.word_terms = [[] for _ in words]
+        for term_index, term in enumerate(self.terms):
+            for word_index in term:
+                self.word_terms[word_index].append(term_index)
+
+        self.words = sorted(words, key=words.get)
+        if len(self.words) > self.scan_threshold:
+            self.build_automaton(words)
+        else:
+            self.goto = None
+
+    def build_automaton(self, words):
+        # State 0 is the root. For each state, keep its transitions, the
+        # state to fall back to when no transition matches, and the words
+        # that end there (including the ones that end at its fallbacks).
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for word, word_index in words.iteritems():
+            state = 0
+            for char in word:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += (word_index,)
+
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                fallback = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = fallback
+                self.output[next_state] += self.output[fallback]
+
+    def __nonzero__(self):
+        return bool(self.terms)
+
+    def matches(self, text):
+        """
+        Return whether the text contains all of the words of any term.
+        """
+        if not self.terms:
+            return False
+
+        text = text.lower()
+        missing = [len(term) for term in self.terms]
+
+        if self.goto is None:
+            for word_index, word in enumerate(self.words):
+                if word in text:
+                    for term_index in self.word_terms[word_index]:
+                        missing[term_index] -= 1
+                        if not missing[term_index]:
+                            return True
+            return False
+
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for word_index in output[state]:
+                if word_index in found:
+                    continue
+                found.add(word_index)
+                for term_index in self.word_terms[word_index]:
+                    missing[term_index] -= 1
+                    if not missing[term_index]:
+                        return True
+
+        return False
+
+
+_matcher_cache = {}
+
+def get_keyword_matcher(keywords):
+    """
+    Get a matcher for the tracking keywords (one term per line). Matchers are
+    built once for each value of the keywords.
+    """
+    matcher = _matcher_cache.get(keywords)
+    if matcher is None:
+        # The keywords seldom change; there's no use holding on to old ones.
+        _matcher_cache.clear()
+        matcher = _matcher_cache[keywords] = KeywordMatcher(keywords.split('\n'))
+    return matcher
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from hatch.tasks import send_pending_tweets
+
+from logging import getLogger
+log = getLogger(__name__)
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Send the tweets that are still waiting in the outbox'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than',
+            type='int',
+            default=0,
+            help='Only send tweets that have been waiting at least this many seconds'),
+    )
+
+    def handle(self, *args, **options):
+        send_pending_tweets(options['older_than'])
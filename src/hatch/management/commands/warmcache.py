@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from hatch.cache import cache_buffer
+from hatch.models import AppConfig, User
+from hatch.ratelimit import rate_limits
+from hatch.services import default_twitter_service as twitter_service
+from hatch.utils import chunk
+from hatch.views import AppMixin
+
+from logging import getLogger
+log = getLogger(__name__)
+
+CURSOR_CACHE_KEY = 'warmcache:last-user-pk'
+CURSOR_TIMEOUT = 24 * 60 * 60
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Fill the cache with the app config, the Twitter config, the '
+            'category data, and the Twitter info for every user. If a run is '
+            'interrupted, the next one picks up with the users it had not '
+            'gotten to yet.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--restart',
+            action='store_true',
+            default=False,
+            help='Start over with the first user instead of resuming'),
+        make_option('--batch-size',
+            type='int',
+            default=settings.WARMCACHE_BATCH_SIZE,
+            help='Number of users to look up on Twitter at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be a positive number')
+
+        with cache_buffer.scope():
+            self.warm_app_data()
+
+        with rate_limits.patience(settings.TWITTER_RATE_LIMIT_BACKGROUND_MAX_WAIT):
+            self.warm_users_info(options['batch_size'], options['restart'])
+
+    def report(self, message):
+        log.info('\n*** %s\n' % (message,))
+        self.stdout.write(message)
+
+    def warm_app_data(self):
+        try:
+            app_config = AppConfig.get(cache=cache_buffer)
+        except IndexError:
+            raise CommandError('This app has not been configured yet')
+
+        AppMixin.get_app_config_json(app_config)
+        AppMixin.get_categories_json()
+        twitter_service.get_config()
+        self.report('Cached the app config, Twitter config, and categories')
+
+    def warm_users_info(self, batch_size, restart):
+        if restart:
+            cache.delete(CURSOR_CACHE_KEY)
+
+        last_pk = cache.get(CURSOR_CACHE_KEY) or 0
+        users = User.objects\
+            .filter(twitter_uid__isnull=False, pk__gt=last_pk)\
+            .order_by('pk')
+
+        total = users.count()
+        if last_pk:
+            self.report('Resuming after user %s; %s user(s) left' % (last_pk, total))
+        else:
+            self.report('Caching info for %s user(s)' % (total,))
+
+        done = 0
+        for user_group in chunk(users, batch_size):
+            with cache_buffer.scope():
+                twitter_service.get_users_info(user_group)
+
+            # Only move the cursor once the batch is in the cache, so that an
+            # interrupted run repeats at most one batch.
+            done += len(user_group)
+            cache.set(CURSOR_CACHE_KEY, user_group[-1].pk, CURSOR_TIMEOUT)
+            self.report('Cached info for %s/%s user(s)' % (done, total))
+
+        cache.delete(CURSOR_CACHE_KEY)
+        self.report('Done warming the cache')
@@ -1,5 +1,6 @@
 from django.utils.functional import SimpleLazyObject
 from django.contrib.auth.middleware import get_user as base_get_user
+from .cache import cache_buffer
 from .models import User
 
 
@@ -16,3 +17,19 @@ def get_user(request):
 class HatchAuthMiddleware(object):
     def process_request(self, request):
         request.user = SimpleLazyObject(lambda: get_user(request))
+
+
+class CacheBufferMiddleware(object):
+    """
+    Give each request its own cache buffer, and flush the buffer's pending
+    writes to the shared cache once the response is ready.
+    """
+    def process_request(self, request):
+        cache_buffer.bind()
+
+    def process_response(self, request, response):
+        try:
+            cache_buffer.flush()
+        finally:
+            cache_buffer.release()
+        return response
@@ -3,15 +3,19 @@ from django.core import cache as django_cache
 from django.core.files.storage import default_storage
 from django.db import models, IntegrityError, transaction
 from django.db.models import query
+from django.db.models.signals import post_save, post_delete
 from django.utils.timezone import now, datetime, utc
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import Group, AbstractUser
+from collections import OrderedDict
+from httplib import HTTPException
 from jsonfield import JSONField
 from random import randint
 from social_auth.models import UserSocialAuth
 from os.path import join as path_join
 from uuid import uuid1, uuid4
 from .cache import cache_buffer
+from .streaming import listener_control
 import json
 import re
 
@@ -24,13 +28,18 @@ class User (AbstractUser):
     checked_notifications_at = models.DateTimeField(default=now)
     sm_not_found = models.BooleanField(default=False)
 
+    # Copied from the user's Twitter social auth record, so that we don't
+    # have to go through it every time we need to know who they are.
+    twitter_uid = models.CharField(max_length=255, null=True, blank=True, db_index=True, editable=False)
+    twitter_screen_name = models.CharField(max_length=50, blank=True, default='', editable=False)
+
     def support(self, vision):
         vision.supporters.add(self)
 
     def unsupport(self, vision):
         vision.supporters.remove(self)
 
-    def share(self, vision, share_id=None):
+    def share(self, vision, share_id=''):
         self.support(vision)
         share = Share(vision=vision, user=self, retweet_id=share_id)
         share.save()
@@ -155,8 +164,114 @@ class TweetManager (models.Manager):
             # that.
             pass
 
+        if commit:
+            TrackedTwitterUser.objects.saw_tweets([obj])
+
         return obj, created
 
+    def import_from_stream(self, tweets_data, is_wanted):
+        """
+        Save a batch of tweets from the stream, in one transaction. A tweet is
+        kept if it replies to a tweet that we have (even one earlier in the
+        batch), or if is_wanted(text) is true. Replies to a vision or to one
+        of its replies become replies to that vision. Tweets that we already
+        have are left alone. Returns the tweets that were saved.
+
+        Which tweets we already have, and which conversations the tweets being
+        replied to belong to, take a fixed number of queries however many
+        tweets there are.
+        """
+        # If a tweet shows up more than once, keep the latest copy of it.
+        batch = OrderedDict()
+        for tweet_data in tweets_data:
+            batch[str(get_tweet_id(tweet_data))] = tweet_data
+
+        parent_ids = set(tweet_data.get('in_reply_to_status_id_str')
+                         for tweet_data in batch.itervalues()) - set([None])
+        known_ids = set(self.get_query_set()
+            .filter(tweet_id__in=list(parent_ids.union(batch)))
+            .values_list('tweet_id', flat=True))
+
+        # The vision whose conversation each of the tweets being replied to is
+        # in, if any
+        conversations = {}
+        if parent_ids:
+            for vision_id, tweet_id, app_tweet_id in Vision.objects\
+                    .filter(models.Q(tweet__in=parent_ids) | models.Q(app_tweet__in=parent_ids))\
+                    .values_list('id', 'tweet', 'app_tweet'):
+                conversations[tweet_id] = conversations[app_tweet_id] = vision_id
+            conversations.pop(None, None)
+            for tweet_id, vision_id in Reply.objects\
+                    .filter(tweet__in=parent_ids)\
+                    .values_list('tweet', 'vision'):
+                conversations[tweet_id] = vision_id
+
+        tweets = []
+        replies = []
+        for tweet_id, tweet_data in batch.iteritems():
+            if tweet_id in known_ids:
+                continue
+
+            parent_id = tweet_data.get('in_reply_to_status_id_str')
+            if parent_id not in known_ids and not is_wanted(tweet_data.get('text', '')):
+                continue
+
+            tweet = self.model(
+                tweet_id=tweet_id,
+                tweet_data=tweet_data,
+                tweet_user_id=tweet_data['user']['id_str'],
+                tweet_user_screen_name=tweet_data['user']['screen_name'],
+                in_reply_to_id=(parent_id if parent_id in known_ids else None))
+            tweets.append(tweet)
+            known_ids.add(tweet_id)
+
+            if parent_id in conversations:
+                reply = Reply(tweet=tweet, vision_id=conversations[parent_id])
+                reply.set_text_from_tweet(tweet)
+                reply.set_time_from_tweet(tweet)
+                replies.append(reply)
+                conversations[tweet_id] = reply.vision_id
+
+        Reply.set_users_from_tweets(replies)
+
+        try:
+            # TODO: Change to transaction.atomic when upgrading to Django 1.6
+            with transaction.commit_on_success():
+                self.bulk_create(tweets)
+                Reply.objects.bulk_create(replies)
+        except IntegrityError:
+            # Some other process saved some of these tweets since we looked
+            # (e.g., the app just sent one of them). Save the rest one at a
+            # time.
+            tweets, replies = self.save_each(tweets, replies)
+
+        TrackedTwitterUser.objects.saw_tweets(tweets)
+        return tweets
+
+    def save_each(self, tweets, replies):
+        saved_tweets = []
+        for tweet in tweets:
+            try:
+                with transaction.commit_on_success():
+                    tweet.save(force_insert=True)
+            except IntegrityError:
+                continue
+            saved_tweets.append(tweet)
+
+        saved_ids = set(tweet.tweet_id for tweet in saved_tweets)
+        saved_replies = []
+        for reply in replies:
+            if reply.tweet_id not in saved_ids:
+                continue
+            try:
+                with transaction.commit_on_success():
+                    reply.save(force_insert=True)
+            except IntegrityError:
+                continue
+            saved_replies.append(reply)
+
+        return saved_tweets, saved_replies
+
 
 class TweetedObjectManager (models.Manager):
     """
@@ -309,11 +424,85 @@ class Tweet (models.Model):
         return super(Tweet, self).save(*args, **kwargs)
 
 
+class TrackedTwitterUserManager (models.Manager):
+    def saw_tweets(self, tweets):
+        """
+        Note that the tweeters of the given tweets were just seen. Users
+        already tracked are updated in place; the rest are added.
+        """
+        screen_names = dict((tweet.tweet_user_id, tweet.tweet_user_screen_name)
+                            for tweet in tweets if tweet.tweet_user_id)
+        if not screen_names:
+            return
+
+        seen_at = now()
+        known = dict(self.get_query_set()
+                     .filter(user_id__in=screen_names.keys())
+                     .values_list('user_id', 'screen_name'))
+
+        if known:
+            self.get_query_set().filter(user_id__in=known.keys()).update(last_seen=seen_at)
+            for user_id, screen_name in known.iteritems():
+                if screen_name != screen_names[user_id]:
+                    self.get_query_set().filter(user_id=user_id).update(screen_name=screen_names[user_id])
+
+        new_users = [
+            self.model(user_id=user_id, screen_name=screen_name, last_seen=seen_at)
+            for user_id, screen_name in screen_names.iteritems()
+            if user_id not in known]
+        if not new_users:
+            return
+
+        try:
+            # TODO: Change to transaction.atomic when upgrading to Django 1.6
+            with transaction.commit_on_success():
+                self.bulk_create(new_users)
+        except IntegrityError:
+            # Another process added some of them since we looked.
+            for user in new_users:
+                try:
+                    with transaction.commit_on_success():
+                        user.save(force_insert=True)
+                except IntegrityError:
+                    self.get_query_set().filter(user_id=user.user_id)\
+                        .update(screen_name=user.screen_name, last_seen=seen_at)
+
+    def most_recently_seen(self, count):
+        return self.get_query_set().order_by('-last_seen')[:count]
+
+
+class TrackedTwitterUser (models.Model):
+    """
+    A Twitter user whose tweets we have, and when we last saw one. The tweet
+    listener follows the users seen most recently. This is kept up to date as
+    tweets are saved, so that the listener doesn't have to go through all the
+    tweets to find out.
+    """
+    user_id = models.CharField(max_length=64, primary_key=True)
+    screen_name = models.CharField(max_length=16, blank=True)
+    last_seen = models.DateTimeField(default=now, db_index=True)
+
+    objects = TrackedTwitterUserManager()
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.screen_name, self.user_id)
+
+
 class TweetedModelMixin (object):
     @classmethod
     def get_or_create_tweeter(cls, user_info):
         user_id = user_info['id']
         username = user_info['screen_name']
+        try:
+            user = User.objects.filter(twitter_uid=str(user_id))[0]
+        except IndexError:
+            pass
+        else:
+            if user.twitter_screen_name != username:
+                user.twitter_screen_name = username[:50]
+                User.objects.filter(pk=user.pk).update(twitter_screen_name=user.twitter_screen_name)
+            return user
+
         try:
             user_social_auth = UserSocialAuth.objects.get(uid=user_id, provider='twitter')
             user = user_social_auth.user
@@ -364,6 +553,26 @@ class TweetedModelMixin (object):
         user = self.get_or_create_tweeter(tweet.tweet_data['user'])
         self.author = user
 
+    @classmethod
+    def set_users_from_tweets(cls, objs):
+        """
+        Like set_user_from_tweet, for many objects at once. Tweeters that we
+        know, by the same screen name, are looked up with one query.
+        """
+        if not objs:
+            return
+
+        tweeters = dict(
+            (user.twitter_uid, user) for user in User.objects.filter(
+                twitter_uid__in=set(obj.tweet.tweet_user_id for obj in objs)))
+
+        for obj in objs:
+            user_info = obj.tweet.tweet_data['user']
+            user = tweeters.get(user_info['id_str'])
+            if user is None or user.twitter_screen_name != user_info['screen_name']:
+                user = tweeters[user_info['id_str']] = cls.get_or_create_tweeter(user_info)
+            obj.author = user
+
     def make_all_replies(self):
         for tweet in self.tweet.tweet_replies.all():
             if not tweet.is_vision() and not tweet.is_reply():
@@ -384,6 +593,12 @@ class Category (models.Model):
     def __unicode__(self):
         return unicode(self.name)
 
+    def save(self, *args, **kwargs):
+        result = super(Category, self).save(*args, **kwargs)
+        django_cache.cache.delete(settings.CATEGORIES_JSON_CACHE_KEY)
+        cache_buffer.invalidate([settings.CATEGORIES_JSON_CACHE_KEY])
+        return result
+
 
 class Vision (TweetedModelMixin, models.Model):
     app_tweet = models.OneToOneField('Tweet', related_name='app_tweeted_vision', null=True, blank=True, unique=True)
@@ -462,7 +677,9 @@ class Reply (TweetedModelMixin, models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    tweet = models.OneToOneField('Tweet', related_name='reply', unique=True)
+    # Replies entered through the app have no tweet until it has been sent
+    # (see OutgoingTweet).
+    tweet = models.OneToOneField('Tweet', related_name='reply', unique=True, null=True, blank=True)
     tweeted_at = models.DateTimeField(blank=True, default=now)
     vision = models.ForeignKey(Vision, related_name='replies')
     author = models.ForeignKey(User, related_name='replies')
@@ -491,6 +708,190 @@ class Reply (TweetedModelMixin, models.Model):
         return super(Reply, self).save(*args, **kwargs)
 
 
+class TemporaryTweetFailure (Exception):
+    """
+    Raised when an outgoing tweet could not be sent, but may go through if we
+    try again later (e.g., Twitter is over capacity or we're rate limited).
+    """
+    pass
+
+
+class OutgoingTweet (models.Model):
+    """
+    A tweet that the app has to send on someone's behalf. Requests that write
+    visions, replies, and shares save one of these instead of waiting on
+    Twitter, and a worker sends it later (see hatch.tasks.send_outgoing_tweet).
+    Once the tweet is sent, it is attached to the vision, reply, or share that
+    it was sent for. If it can't be sent, the reply or share (or the vision,
+    if the app couldn't tweet it) is removed, as it would have been had we
+    tried to tweet it right away.
+    """
+    APP_VISION = 'app-vision'
+    USER_VISION = 'user-vision'
+    REPLY = 'reply'
+    SHARE = 'share'
+    KIND_CHOICES = (
+        (APP_VISION, 'Vision, from the app'),
+        (USER_VISION, 'Vision, from the author'),
+        (REPLY, 'Reply'),
+        (SHARE, 'Share (retweet)'),
+    )
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    # Twitter errors that are worth waiting out: rate limit exceeded, over
+    # capacity, and internal error.
+    TEMPORARY_ERROR_CODES = (88, 130, 131)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    requested_by = models.ForeignKey(User, related_name='outgoing_tweets')
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    # What to send. The sender is None when the tweet is from the app's
+    # account. The target tweet is the one being replied to or retweeted.
+    sender = models.ForeignKey(User, related_name='+', null=True, blank=True)
+    text = models.CharField(max_length=200, blank=True)
+    target_tweet_id = models.CharField(max_length=64, blank=True)
+
+    # What it was sent for, and what came of it
+    vision = models.ForeignKey(Vision, related_name='outgoing_tweets', null=True, blank=True, on_delete=models.SET_NULL)
+    reply = models.ForeignKey(Reply, related_name='outgoing_tweets', null=True, blank=True, on_delete=models.SET_NULL)
+    share = models.ForeignKey(Share, related_name='outgoing_tweets', null=True, blank=True, on_delete=models.SET_NULL)
+    tweet_id = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        ordering = ('created_at',)
+
+    def __unicode__(self):
+        return '%s tweet requested by %s (%s)' % (self.kind, self.requested_by, self.status)
+
+    def is_temporary_failure(self, response):
+        try:
+            errors = json.loads(response)['errors']
+            codes = set(error.get('code') for error in errors)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            # Not an error that Twitter sent us; maybe a proxy or load
+            # balancer along the way. Try again.
+            return True
+        return bool(codes & set(self.TEMPORARY_ERROR_CODES))
+
+    def send(self, service, final=True):
+        """
+        Send the tweet through the given Twitter service. Returns True if it
+        was sent and False if it could not be. If the tweet is not final and
+        the failure looks temporary, raises TemporaryTweetFailure instead, and
+        the tweet stays pending.
+        """
+        if self.status != self.PENDING:
+            return self.status == self.SENT
+
+        # Replies and shares go to the vision's tweet, which may not have
+        # been sent yet itself.
+        if self.kind in (self.REPLY, self.SHARE):
+            if self.vision is None:
+                return self.give_up_or_retry('The vision was removed', temporary=False, final=final)
+            self.target_tweet_id = self.vision.tweet_id or self.vision.app_tweet_id or ''
+            if not self.target_tweet_id:
+                return self.give_up_or_retry('The vision has not been tweeted yet', temporary=True, final=final)
+
+        self.attempts += 1
+        try:
+            if self.kind == self.SHARE:
+                success, response = service.retweet(self.target_tweet_id, self.sender)
+            else:
+                extra = {}
+                if self.target_tweet_id:
+                    extra['in_reply_to_status_id'] = self.target_tweet_id
+                if self.sender is None:
+                    success, response = service.tweet(self.text, **extra)
+                else:
+                    success, response = service.tweet(self.text, self.sender, **extra)
+        except (IOError, HTTPException) as e:
+            # Socket errors, timeouts, and the like
+            return self.give_up_or_retry(unicode(e), temporary=True, final=final)
+
+        if success:
+            self.attach(response)
+            return True
+
+        error = response if isinstance(response, basestring) else json.dumps(response)
+        return self.give_up_or_retry(error, self.is_temporary_failure(response), final)
+
+    def give_up_or_retry(self, error, temporary, final):
+        self.error = error
+        if temporary and not final:
+            self.save()
+            raise TemporaryTweetFailure(error)
+
+        self.fail()
+        return False
+
+    def attach(self, tweet_data):
+        """
+        Attach the tweet that was sent to whatever it was sent for.
+        """
+        self.tweet_id = str(get_tweet_id(tweet_data))
+
+        if self.kind == self.SHARE:
+            if self.share is not None:
+                self.share.retweet_id = self.tweet_id
+                self.share.save()
+
+        else:
+            tweet, _ = Tweet.objects.create_or_update_from_tweet_data(tweet_data)
+
+            if self.kind == self.APP_VISION and self.vision is not None:
+                self.vision.app_tweet = tweet
+                self.vision.save()
+
+            elif self.kind == self.USER_VISION and self.vision is not None:
+                # The user's tweet becomes the vision's primary tweet
+                self.vision.tweet = tweet
+                self.vision.save()
+
+            elif self.kind == self.REPLY and self.reply is not None:
+                # The tweet listener may have seen the tweet and made its own
+                # reply out of it before we got here. Keep ours.
+                Reply.objects.filter(tweet=tweet).exclude(pk=self.reply.pk).delete()
+                self.reply.tweet = tweet
+                self.reply.save()
+
+        self.status = self.SENT
+        self.error = ''
+        self.save()
+
+    def fail(self):
+        """
+        Give up on the tweet, and remove what it was sent for.
+        """
+        if self.kind == self.APP_VISION and self.vision is not None:
+            self.vision.delete()
+            self.vision = None
+        elif self.kind == self.REPLY and self.reply is not None:
+            self.reply.delete()
+            self.reply = None
+        elif self.kind == self.SHARE and self.share is not None:
+            # Sharing also made the user a supporter; undo both, as unshare
+            # does.
+            self.share.user.unshare(self.share.vision)
+            self.share = None
+
+        self.status = self.FAILED
+        self.save()
+
+
 class AppConfig (models.Model):
     title = models.CharField(max_length=50, help_text="This appears in the"
         " app's header on every page.")
@@ -587,7 +988,13 @@ class AppConfig (models.Model):
     def save(self, *args, **kwargs):
         result = super(AppConfig, self).save(*args, **kwargs)
         django_cache.cache.set(settings.APP_CONFIG_CACHE_KEY, self)
-        django_cache.cache.set('restart_listener', True)
+        django_cache.cache.delete(settings.APP_CONFIG_JSON_CACHE_KEY)
+        # The listener picks up new keywords the next time it reconnects
+        listener_control.publish('refresh')
+
+        # Make sure that no process keeps using the old config from its buffer.
+        cache_buffer.invalidate([settings.APP_CONFIG_CACHE_KEY,
+                                 settings.APP_CONFIG_JSON_CACHE_KEY])
         return result
 
     @classmethod
@@ -598,3 +1005,36 @@ class AppConfig (models.Model):
             app_config = app_config_query[settings.APP_CONFIG_INDEX]
             cache.set(settings.APP_CONFIG_CACHE_KEY, app_config)
         return app_config
+
+
+# ==================================================================
+# Keep each user's copy of their Twitter identity in sync with their
+# social auth record
+# ==================================================================
+def sync_user_twitter_identity(sender, instance, **kwargs):
+    if instance.provider != 'twitter':
+        return
+
+    extra_data = instance.extra_data
+    if isinstance(extra_data, basestring):
+        extra_data = json.loads(extra_data or '{}')
+    fields = {'twitter_uid': instance.uid}
+    if extra_data.get('screen_name'):
+        fields['twitter_screen_name'] = extra_data['screen_name'][:50]
+
+    # If a user has more than one Twitter account, stick with the first.
+    User.objects\
+        .filter(pk=instance.user_id)\
+        .filter(models.Q(twitter_uid__isnull=True) | models.Q(twitter_uid=instance.uid))\
+        .update(**fields)
+
+def clear_user_twitter_identity(sender, instance, **kwargs):
+    if instance.provider != 'twitter':
+        return
+
+    User.objects\
+        .filter(pk=instance.user_id, twitter_uid=instance.uid)\
+        .update(twitter_uid=None, twitter_screen_name='')
+
+post_save.connect(sync_user_twitter_identity, sender=UserSocialAuth)
+post_delete.connect(clear_user_twitter_identity, sender=UserSocialAuth)
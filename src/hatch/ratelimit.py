@@ -0,0 +1,228 @@
+"""
+Pacing for calls to the Twitter API.
+
+Twitter gives each OAuth identity a quota of calls to each endpoint per 15
+minute window, and reports what is left of it in the ``x-rate-limit-*``
+headers of every response. The scheduler keeps a token bucket for each
+(endpoint, identity) pair, filled from those headers. Calls go ahead right
+away while there are tokens left; once a bucket is empty, calls wait for the
+window to reset if the caller is willing to wait that long, and are deferred
+with ``RateLimitExceeded`` otherwise.
+
+The buckets are kept in the shared cache so that every process calling
+Twitter with the same credentials draws from the same quota. Each bucket is
+two cache entries: the number of calls left, which is taken from with the
+cache's atomic decr, and the time the window resets.
+"""
+
+from django.conf import settings
+from django.core import cache as django_cache
+from contextlib import contextmanager
+from hashlib import md5
+from random import random
+from threading import local
+from time import sleep, time
+from twitter import TwitterHTTPError
+from urllib2 import HTTPError
+import json
+import re
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class RateLimitExceeded (TwitterHTTPError):
+    """
+    Raised instead of making a call that would go over quota. It looks like
+    the 429 response Twitter would have sent, so that callers can handle it
+    the same way.
+    """
+    def __init__(self, endpoint, wait):
+        self.endpoint = endpoint
+        self.wait = wait
+        self.e = HTTPError(endpoint, 429, 'Too Many Requests', {}, None)
+        self.uri = endpoint
+        self.format = ''
+        self.uriparts = None
+        self.response_data = json.dumps({'errors': [{
+            'code': 88, 'message': 'Rate limit exceeded'}]})
+        Exception.__init__(self,
+            'Rate limit for %s exhausted; it resets in %d seconds' % (endpoint, wait))
+
+    def __str__(self):
+        return self.args[0]
+
+
+class RateLimitScheduler (object):
+    key_format = 'rate-limit:%s:%s'
+
+    def __init__(self, max_wait=None):
+        self.default_max_wait = max_wait if max_wait is not None else \
+            getattr(settings, 'TWITTER_RATE_LIMIT_MAX_WAIT', 0)
+        self.local = local()
+
+    # ==================================================================
+    # How long the current thread is willing to wait for quota
+
+    def get_max_wait(self):
+        return getattr(self.local, 'max_wait', self.default_max_wait)
+
+    @contextmanager
+    def patience(self, max_wait):
+        """
+        Let calls in the current thread wait up to max_wait seconds for quota
+        to free up, instead of being deferred.
+        """
+        previous = getattr(self.local, 'max_wait', None)
+        self.local.max_wait = max_wait
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.local.max_wait
+            else:
+                self.local.max_wait = previous
+
+    # ==================================================================
+    # Buckets
+
+    def get_endpoint(self, uri):
+        # Drop the API version and any ids: '1.1/statuses/show/123' is in the
+        # 'statuses/show' family.
+        parts = [part for part in uri.split('/') if part]
+        if parts and re.match(r'^\d+(\.\d+)?$', parts[0]):
+            parts = parts[1:]
+        return '/'.join(part for part in parts if not part.isdigit())
+
+    def get_identity(self, auth):
+        token = getattr(auth, 'token', None) or getattr(auth, 'bearer_token', None)
+        if not token:
+            return 'anonymous'
+        return md5(token).hexdigest()
+
+    def get_bucket_key(self, endpoint, identity):
+        return self.key_format % (endpoint, identity)
+
+    def get_bucket_keys(self, endpoint, identity):
+        """
+        Return the keys of the calls left and the reset time for a bucket.
+        """
+        key = self.get_bucket_key(endpoint, identity)
+        return key + ':remaining', key + ':reset'
+
+    def get_buckets(self, endpoint, identities):
+        """
+        Return a (remaining, reset) pair for each of the identities, with
+        None for buckets we know nothing about or whose window has passed.
+        """
+        cache = django_cache.cache
+        keys = [self.get_bucket_keys(endpoint, identity) for identity in identities]
+        entries = cache.get_many([key for pair in keys for key in pair])
+        now = time()
+
+        buckets = []
+        for remaining_key, reset_key in keys:
+            remaining, reset = entries.get(remaining_key), entries.get(reset_key)
+            if remaining is None or reset is None or reset <= now:
+                buckets.append(None)
+            else:
+                buckets.append((remaining, reset))
+        return buckets
+
+    def choose(self, endpoint, identities):
+        """
+        Return the index of one of the identities to make a call to the
+        endpoint with. Identities are picked at random, in proportion to the
+        calls they have left, so that calls spread out over the identities
+        even when they are chosen ahead of time or by several processes at
+        once. Identities we know nothing about yet count as having as many
+        calls left as the best of the rest.
+        """
+        buckets = self.get_buckets(endpoint, identities)
+        calls_left = [None if bucket is None else max(bucket[0], 0) for bucket in buckets]
+
+        most_left = max([left for left in calls_left if left is not None] + [1])
+        weights = [most_left if left is None else left for left in calls_left]
+
+        if sum(weights) <= 0:
+            # Everyone is out; take whoever's window resets first.
+            return min(range(len(buckets)), key=lambda index: buckets[index][1])
+
+        point = random() * sum(weights)
+        for index, weight in enumerate(weights):
+            point -= weight
+            if point < 0:
+                return index
+        return len(weights) - 1
+
+    def acquire(self, endpoint, identity, max_wait=None):
+        """
+        Take a token for a call to the endpoint, waiting for the window to
+        reset if the bucket is empty. Raises RateLimitExceeded if that would
+        take longer than max_wait seconds.
+
+        Tokens are taken with the cache's decr, which is atomic in Redis and
+        memcached, so processes sharing a bucket don't go over quota between
+        them. (Memcached won't count below zero, so there, a call may slip
+        through when two processes take the last token at once. With the
+        local memory cache, used in development, decr isn't atomic at all.)
+        """
+        if max_wait is None:
+            max_wait = self.get_max_wait()
+
+        cache = django_cache.cache
+        remaining_key, _ = self.get_bucket_keys(endpoint, identity)
+
+        while True:
+            bucket, = self.get_buckets(endpoint, [identity])
+
+            # We know nothing about this quota yet, or its window has
+            # passed; go ahead and let the response tell us where we are.
+            if bucket is None:
+                return
+
+            remaining, reset = bucket
+            if remaining > 0:
+                try:
+                    if cache.decr(remaining_key) >= 0:
+                        return
+                except ValueError:
+                    # The bucket expired in the mean time
+                    return
+
+            wait = reset - time()
+
+            if wait > max_wait:
+                raise RateLimitExceeded(endpoint, wait)
+
+            log.info('\n*** Rate limit for %s exhausted; waiting %d seconds\n' %
+                     (endpoint, wait))
+            sleep(wait)
+            max_wait -= wait
+
+    def update(self, endpoint, identity, headers, status=None):
+        """
+        Refill the bucket for the endpoint from the rate limit headers of a
+        response.
+        """
+        try:
+            remaining = int(headers.get('x-rate-limit-remaining'))
+            reset = int(headers.get('x-rate-limit-reset'))
+        except (TypeError, ValueError):
+            # Twitter only sends the headers for endpoints with a quota. If
+            # it tells us we're over an unknown quota, back off for a minute.
+            if status != 429:
+                return
+            remaining, reset = 0, time() + 60
+
+        if status == 429:
+            remaining = 0
+
+        timeout = int(reset - time()) + 1
+        if timeout > 0:
+            cache = django_cache.cache
+            remaining_key, reset_key = self.get_bucket_keys(endpoint, identity)
+            cache.set_many({remaining_key: remaining, reset_key: reset}, timeout)
+
+
+rate_limits = RateLimitScheduler()
@@ -3,7 +3,7 @@ from rest_framework.serializers import (
     CharField, ImageField, IntegerField, ModelSerializer,
     PrimaryKeyRelatedField, SerializerMethodField, DateTimeField,
     RelatedField, ValidationError, Serializer)
-from .models import User, Vision, Reply, Category, AppConfig
+from .models import User, Vision, Reply, Category, AppConfig, OutgoingTweet
 from .services import SocialMediaException
 
 
@@ -202,6 +202,13 @@ class ReplySerializer (ModelSerializer):
         exclude = ('tweet',)
 
 
+class OutgoingTweetSerializer (ModelSerializer):
+    class Meta:
+        model = OutgoingTweet
+        fields = ('id', 'kind', 'status', 'attempts', 'error', 'tweet_id',
+                  'vision', 'reply', 'share', 'created_at', 'updated_at')
+
+
 class CategorySerializer (ModelSerializer):
     image = SerializerMethodField('image_url')
     vision_count = SerializerMethodField('get_vision_count')
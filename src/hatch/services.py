@@ -1,11 +1,23 @@
+from django.conf import settings
 from django.core import cache as django_cache
-from twitter import Twitter, OAuth, TwitterHTTPError
+from twitter import OAuth, TwitterHTTPError
 from twitter.stream import TwitterStream
+from array import array
+from multiprocessing.pool import ThreadPool
 from urlparse import parse_qs
+from time import time
+import json
 import re
-from .models import AppConfig
-from .cache import cache_buffer as cache
-from .utils import chunk
+import struct
+import zlib
+from social_auth.models import UserSocialAuth
+from .models import AppConfig, User
+from .cache import cache_buffer as cache, single_flight
+from .circuit import twitter_circuit
+from .ratelimit import rate_limits
+from .streaming import KeepAliveStream, listener_control
+from .transport import PooledTwitter
+from .utils import chunk, intersect_sorted
 
 from logging import getLogger
 log = getLogger(__name__)
@@ -24,21 +36,44 @@ class SocialMediaException (Exception):
 # ============================================================
 
 class TwitterService (object):
+    def __init__(self, connection_pool=None):
+        # The connection pool to make API calls over; by default, the shared
+        # pool of connections to Twitter. Pass a FakeTwitterAPI to work
+        # offline.
+        self.connection_pool = connection_pool
+
     # ==================================================================
     # General Twitter info, cached
     # ==================================================================
     def get_config_cache_key(self):
         return 'twitter-config'
 
+    # What we go by when we can't get the configuration from Twitter
+    DEFAULT_CONFIG = {
+        'characters_reserved_per_media': 23,
+        'max_media_per_upload': 1,
+        'short_url_length': 22,
+        'short_url_length_https': 23,
+    }
+
     def get_config(self, on_behalf_of=None):
         cache_key = self.get_config_cache_key()
         config = cache.get(cache_key)
 
         if config is None:
-            t = self.get_api(on_behalf_of)
-            config = t.help.configuration()
-            config = dict(config.items())
-            cache.set(cache_key, config)
+            def fetch_config():
+                t = self.get_api(on_behalf_of)
+                config = t.help.configuration()
+                return dict(config.items())
+
+            try:
+                config = single_flight.do(cache_key, fetch_config,
+                                          max_wait=twitter_circuit.get_time_left(),
+                                          keep_stale=True)
+            except TwitterHTTPError as e:
+                log.warning('Could not get the Twitter configuration (%s); '
+                            'using the last one we got' % (e,))
+                config = single_flight.get_stale(cache_key) or self.DEFAULT_CONFIG
         return config
 
     def get_url_length(self, url, on_behalf_of=None):
@@ -60,43 +95,202 @@ class TwitterService (object):
     def get_user_cache_key(self, user, extra):
         return ':'.join([self.get_user_cache_key_prefix(user), extra])
 
+    # Cached user info is kept for a long time, but is only considered fresh
+    # for a while. When a stale entry is read, it is used anyway, and a
+    # background task fetches a fresh copy.
+    #
+    # Only the fields that we actually use are cached. Each entry is packed
+    # into a JSON list (the time it's fresh until, followed by the values of
+    # USER_INFO_FIELDS), compressed if TWITTER_USER_INFO_COMPRESS is set.
+    USER_INFO_FIELDS = ('id_str', 'screen_name', 'name', 'description', 'profile_image_url')
+    USER_INFO_JSON_PREFIX = 'j'
+    USER_INFO_ZLIB_PREFIX = 'z'
+
+    def pack_user_info(self, info):
+        fresh_timeout = getattr(settings, 'TWITTER_USER_INFO_FRESH_TIMEOUT', 24 * 60 * 60)
+        record = [time() + fresh_timeout] + [info.get(field) for field in self.USER_INFO_FIELDS]
+        packed = json.dumps(record, separators=(',', ':'))
+
+        if getattr(settings, 'TWITTER_USER_INFO_COMPRESS', False):
+            return self.USER_INFO_ZLIB_PREFIX + zlib.compress(packed)
+        else:
+            return self.USER_INFO_JSON_PREFIX + packed
+
+    def unpack_user_info(self, entry):
+        """
+        Return the user info from a cache entry, and whether it is still
+        fresh. Entries cached in older formats (full info dictionaries, with
+        or without a freshness time) can still be read; bare dictionaries are
+        considered stale.
+        """
+        if isinstance(entry, dict):
+            if 'fresh_until' not in entry:
+                return entry, False
+            return entry['info'], entry['fresh_until'] > time()
+
+        if entry.startswith(self.USER_INFO_ZLIB_PREFIX):
+            record = json.loads(zlib.decompress(entry[1:]))
+        else:
+            record = json.loads(entry[1:])
+
+        fresh_until, values = record[0], record[1:]
+        info = dict(zip(self.USER_INFO_FIELDS, values))
+        return info, fresh_until > time()
+
+    def get_user_info_timeout(self):
+        return getattr(settings, 'TWITTER_USER_INFO_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+
+    def schedule_user_info_refresh(self, users):
+        """
+        Refresh the info for the given users in the background, unless a
+        refresh is already on its way.
+
+        This runs while pages are being built, so the users are claimed all
+        at once (one get_many and one set_many) rather than with a lock per
+        user. Two processes may now and then claim the same user at the same
+        time; the worst that happens is that the user's info is fetched twice.
+        """
+        lock_timeout = getattr(settings, 'TWITTER_USER_INFO_REFRESH_LOCK_TIMEOUT', 5 * 60)
+        keys = dict([(self.get_user_cache_key(user, 'info:refreshing'), user) for user in users])
+        if not keys:
+            return
+
+        refreshing = django_cache.cache.get_many(keys.keys())
+        claimed = dict([(key, True) for key in keys if key not in refreshing])
+        if not claimed:
+            return
+
+        django_cache.cache.set_many(claimed, lock_timeout)
+        user_pks = sorted(keys[key].pk for key in claimed)
+
+        from .tasks import refresh_users_info
+        try:
+            refresh_users_info.delay(user_pks)
+        except Exception as e:
+            log.warning('Could not schedule a refresh of user info: %s' % (e,))
+
+    # Users that Twitter can't give us info for (i.e., they are protected,
+    # suspended, or gone) are remembered for a while, so that we don't keep
+    # asking. Each time they come up missing again, we wait longer before
+    # the next try, according to TWITTER_NOT_FOUND_BACKOFF.
+    def get_not_found_entries(self, users):
+        """
+        Return a mapping from user to negative cache entry for each of the
+        given users that Twitter has recently been unable to find.
+        """
+        keys = dict([(self.get_user_cache_key(user, 'not-found'), user) for user in users])
+        entries = cache.get_many(keys.keys())
+        return dict([(keys[key], entry) for key, entry in entries.iteritems()])
+
+    def is_backing_off(self, entry):
+        return entry is not None and entry['retry_at'] > time()
+
+    def check_user_found(self, user):
+        entry = cache.get(self.get_user_cache_key(user, 'not-found'))
+        if self.is_backing_off(entry):
+            raise SocialMediaException(
+                'User %s was not found on Twitter recently; not trying again '
+                'until later' % (user.username,))
+
+    def mark_users_not_found(self, users):
+        if not users:
+            return
+
+        backoff = getattr(settings, 'TWITTER_NOT_FOUND_BACKOFF', (60 * 60, 6 * 60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60))
+        entries = self.get_not_found_entries(users)
+
+        new_entries = {}
+        for user in users:
+            strikes = entries[user]['strikes'] + 1 if user in entries else 1
+            new_entries[self.get_user_cache_key(user, 'not-found')] = {
+                'strikes': strikes,
+                'retry_at': time() + backoff[min(strikes, len(backoff)) - 1],
+            }
+
+        # Keep the entries around for longer than the backoff, so that we
+        # know how many strikes each user has had.
+        cache.set_many(new_entries, 4 * backoff[-1])
+
+        # Only touch the database for users that aren't already flagged.
+        pks = [user.pk for user in users if not user.sm_not_found]
+        if pks:
+            User.objects.filter(pk__in=pks).update(sm_not_found=True)
+        for user in users:
+            user.sm_not_found = True
+
+    def mark_users_found(self, users):
+        # Users only have negative cache entries if they're flagged.
+        users = [user for user in users if user.sm_not_found]
+        if not users:
+            return
+
+        cache.delete_many([self.get_user_cache_key(user, 'not-found') for user in users])
+
+        User.objects.filter(pk__in=[user.pk for user in users]).update(sm_not_found=False)
+        for user in users:
+            user.sm_not_found = False
+
+    def is_unreachable_error(self, error):
+        """
+        Whether an error from the API means that the account we asked about
+        is gone (404) or off limits (403), as opposed to a problem with the
+        request or with Twitter.
+        """
+        return error.e.code in (403, 404)
+
     def get_user_info(self, user, on_behalf_of=None):
         cache_key = self.get_user_cache_key(user, 'info')
-        info = cache.get(cache_key)
-
-        if info is None:
-            user_id = self.get_user_id(user)
+        entry = cache.get(cache_key)
+
+        if entry is None:
+            self.check_user_found(user)
+            entry = single_flight.do(
+                cache_key,
+                lambda: self.pack_user_info(self.fetch_user_info(user, on_behalf_of)),
+                self.get_user_info_timeout(),
+                max_wait=twitter_circuit.get_time_left())
+
+        info, is_fresh = self.unpack_user_info(entry)
+        if not is_fresh:
+            self.schedule_user_info_refresh([user])
+        return info
 
-            log_string = (
-                '\n'
-                '============================================================\n'
-                'Hitting the API for %s to get info on %s (%s)\n'
-                '============================================================\n'
-            ) % (
-                on_behalf_of.username if on_behalf_of else 'the app',
-                user.username, user_id
-            )
-            log.info(log_string)
+    def fetch_user_info(self, user, on_behalf_of=None):
+        user_id = self.get_user_id(user)
+
+        log_string = (
+            '\n'
+            '============================================================\n'
+            'Hitting the API for %s to get info on %s (%s)\n'
+            '============================================================\n'
+        ) % (
+            on_behalf_of.username if on_behalf_of else 'the app',
+            user.username, user_id
+        )
+        log.info(log_string)
 
-            t = self.get_api(on_behalf_of)
-            try:
-                info = t.users.show(user_id=user_id)
-            except TwitterHTTPError:
-                user.sm_not_found = True
-                user.save(update_fields=['sm_not_found'])
+        t = self.get_api(on_behalf_of)
+        try:
+            info = t.users.show(user_id=user_id)
+        except TwitterHTTPError as e:
+            if self.is_unreachable_error(e):
+                self.mark_users_not_found([user])
                 raise SocialMediaException('User %s (%s) not found on Twitter' % (user.username, user_id))
-            info = dict(info.items())  # info is a WrappedTwitterResponse
-            cache.set(cache_key, info)
-        return info
+            raise SocialMediaException('Could not get info for user %s (%s): %s' % (user.username, user_id, e))
+
+        self.mark_users_found([user])
+        return dict(info.items())  # info is a WrappedTwitterResponse
 
     def get_users_info(self, users, on_behalf_of=None, force_refresh=False):
         # Build a mapping from cache_key => user_id
         data = {}
+        users_by_key = {}
         for user in users:
             try:
                 cache_key = self.get_user_cache_key(user, 'info')
                 user_id = self.get_user_id(user)
                 data[cache_key] = user_id
+                users_by_key[cache_key] = user
             except SocialMediaException as e:
                 log.warning(e)
                 pass
@@ -113,12 +307,28 @@ class TwitterService (object):
         #       API limits with twitter. If there are more than 6000 users,
         #       just ignore the force_refresh and only update uncached users.
         if not force_refresh or len(data) > 6000:
-            all_info = cache.get_many(data.keys())
+            all_info = {}
+            stale_keys = []
+            for cache_key, entry in cache.get_many(data.keys()).iteritems():
+                all_info[cache_key], is_fresh = self.unpack_user_info(entry)
+                if not is_fresh:
+                    stale_keys.append(cache_key)
+
+            # Serve the stale info for now, and fetch fresh info in the
+            # background.
+            if stale_keys:
+                self.schedule_user_info_refresh([users_by_key[key] for key in stale_keys])
         else:
             all_info = {}
 
-        # Build a list of keys that have no cached data
+        # Build a list of keys that have no cached data, leaving out any users
+        # that Twitter couldn't find for us recently.
         uncached_keys = filter(lambda key: key not in all_info, data.keys())
+        if uncached_keys:
+            not_found_entries = self.get_not_found_entries([users_by_key[key] for key in uncached_keys])
+            uncached_keys = filter(
+                lambda key: not self.is_backing_off(not_found_entries.get(users_by_key[key])),
+                uncached_keys)
 
         if uncached_keys:
             log_string = (
@@ -135,17 +345,48 @@ class TwitterService (object):
             log.info(log_string)
 
             # If there are uncached keys, fetch the user info for those users
-            # in chunks of 100
-            t = self.get_api(on_behalf_of)
+            # in chunks of 100, a few chunks at a time.
             user_ids = [data[key] for key in uncached_keys]
             new_info = {}
             questionable_ids = []
 
-            for id_group in chunk(user_ids, 100):
+            # The lookups may run in other threads; let them wait for quota as
+            # long as, and give up on Twitter when, this one would.
+            max_wait = rate_limits.get_max_wait()
+            deadline = twitter_circuit.get_deadline()
+
+            def lookup_group(group):
+                id_group, t = group
                 try:
-                    bulk_info = t.users.lookup(user_id=','.join([str(user_id) for user_id in id_group]))
-                except TwitterHTTPError:
+                    with rate_limits.patience(max_wait), twitter_circuit.deadline(deadline):
+                        bulk_info = t.users.lookup(user_id=','.join([str(user_id) for user_id in id_group]))
+                except TwitterHTTPError as e:
+                    # Twitter responds with a 404 when none of the users in
+                    # the group can be found. Any other error says nothing
+                    # about the users, so just skip them for now.
+                    if not self.is_unreachable_error(e):
+                        log.warning('Could not look up a group of users: %s' % (e,))
+                        return id_group, None
                     bulk_info = []
+                return id_group, bulk_info
+
+            # Pick the credentials for each group up front, so that the
+            # lookup threads don't need to touch the database.
+            groups = [
+                (id_group, self.get_api(on_behalf_of, bulk_endpoint='users/lookup'))
+                for id_group in chunk(user_ids, 100)]
+            if len(groups) > 1:
+                pool = ThreadPool(min(len(groups), settings.TWITTER_LOOKUP_CONCURRENCY))
+                try:
+                    results = pool.map(lookup_group, groups)
+                finally:
+                    pool.terminate()
+            else:
+                results = map(lookup_group, groups)
+
+            for id_group, bulk_info in results:
+                if bulk_info is None:
+                    continue
 
                 for info in bulk_info:
                     cache_key = reverse_data[str(info['id'])]
@@ -175,19 +416,17 @@ class TwitterService (object):
                 log.warning(log_string)
 
             # Store any new information gotten in the cache
-            cache.set_many(new_info)
+            new_entries = dict([(key, self.pack_user_info(info)) for key, info in new_info.iteritems()])
+            cache.set_many(new_entries, self.get_user_info_timeout())
 
-            # Add the new info to the already cached info
-            all_info.update(new_info)
+            # Add the new info to the already cached info, in the same shape
+            # as it comes out of the cache
+            for key, entry in new_entries.iteritems():
+                all_info[key], _ = self.unpack_user_info(entry)
 
             # Update the social media found status for all the users.
-            from .models import User
-
-            seen_users = User.objects.filter(social_auth__uid__in=seen_ids)
-            seen_users.update(sm_not_found=False)
-
-            questionable_users = User.objects.filter(social_auth__uid__in=questionable_ids)
-            questionable_users.update(sm_not_found=True)
+            self.mark_users_found([users_by_key[key] for key in new_info])
+            self.mark_users_not_found([users_by_key[reverse_data[str(user_id)]] for user_id in questionable_ids])
 
         return all_info.values()
 
@@ -210,41 +449,136 @@ class TwitterService (object):
         user_info = self.get_user_info(user, on_behalf_of)
         return user_info['description']
 
+    # Followed user ids are kept as a compact, sorted run of integers, and
+    # only the ones that belong to users of this site are kept at all. The
+    # integers are 64-bit little-endian, so that every process reads them
+    # the same way, whatever machine it's on.
+    def pack_user_ids(self, user_ids):
+        user_ids = sorted(user_ids)
+        return 'q' + struct.pack('<%dq' % len(user_ids), *user_ids)
+
+    def unpack_user_ids(self, entry):
+        if isinstance(entry, basestring) and entry.startswith('q'):
+            return struct.unpack('<%dq' % ((len(entry) - 1) // 8), entry[1:])
+        if isinstance(entry, basestring) and entry.startswith('a'):
+            # Entries packed in the machine's own format, before the format
+            # was fixed; they expire with the cache.
+            user_ids = array('l')
+            user_ids.fromstring(entry[1:])
+            return user_ids
+        # Older entries are plain lists of every followed id
+        return array('l', sorted(int(user_id) for user_id in entry))
+
+    def get_site_user_ids(self):
+        """
+        Get the sorted Twitter ids of all the users of the site.
+        """
+        cache_key = 'site-twitter-ids'
+        entry = cache.get(cache_key)
+
+        if entry is None:
+            uids = User.objects.filter(twitter_uid__isnull=False).values_list('twitter_uid', flat=True)
+            entry = self.pack_user_ids(int(uid) for uid in uids if uid.isdigit())
+            cache.set(cache_key, entry, settings.SITE_TWITTER_IDS_CACHE_TIMEOUT)
+
+        return self.unpack_user_ids(entry)
+
     def get_followed_users(self, user, on_behalf_of=None):
+        """
+        Get the sorted Twitter ids of the users of this site that the given
+        user follows.
+        """
         cache_key = self.get_user_cache_key(user, 'follows')
-        followed_user_ids = cache.get(cache_key)
-
-        if followed_user_ids is None:
-            user_id = self.get_user_id(user)
-
-            log_string = (
-                '\n'
-                '============================================================\n'
-                'Hitting the API for %s to get IDs for users that %s (%s)\n'
-                'follows\n'
-                '============================================================\n'
-            ) % (
-                on_behalf_of.username if on_behalf_of else 'the app',
-                user.username, user_id
-            )
-            log.info(log_string)
-
-            t = self.get_api(on_behalf_of)
+        entry = cache.get(cache_key)
+
+        if entry is None:
+            self.check_user_found(user)
+            entry = single_flight.do(cache_key, lambda: self.pack_user_ids(
+                intersect_sorted(self.fetch_followed_users(user, on_behalf_of),
+                                 self.get_site_user_ids())),
+                max_wait=twitter_circuit.get_time_left())
+        return self.unpack_user_ids(entry)
+
+    def get_followed_site_users(self, user, on_behalf_of=None):
+        """
+        Get the primary keys of the users of this site that the given user
+        follows.
+        """
+        cache_key = self.get_user_cache_key(user, 'follows:pks')
+        user_pks = cache.get(cache_key)
+
+        if user_pks is None:
+            user_pks = []
+            for uid_group in chunk(self.get_followed_users(user, on_behalf_of), 500):
+                user_pks += User.objects\
+                    .filter(twitter_uid__in=[str(uid) for uid in uid_group])\
+                    .values_list('pk', flat=True)
+            user_pks = sorted(set(user_pks))
+            cache.set(cache_key, user_pks)
+
+        return user_pks
+
+    def fetch_followed_users(self, user, on_behalf_of=None):
+        user_id = self.get_user_id(user)
+
+        log_string = (
+            '\n'
+            '============================================================\n'
+            'Hitting the API for %s to get IDs for users that %s (%s)\n'
+            'follows\n'
+            '============================================================\n'
+        ) % (
+            on_behalf_of.username if on_behalf_of else 'the app',
+            user.username, user_id
+        )
+        log.info(log_string)
+
+        # Twitter gives us the ids 5000 at a time; follow the cursor until
+        # we've got them all.
+        t = self.get_api(on_behalf_of, bulk_endpoint='friends/ids')
+        followed_user_ids = array('l')
+        cursor = -1
+        while cursor:
             try:
-                followed_user_ids = t.friends.ids(user_id=user_id)
-            except TwitterHTTPError:
-                user.sm_not_found = True
-                user.save(update_fields=['sm_not_found'])
-                raise SocialMediaException('User %s (%s) not found on Twitter' % (user.username, user_id))
-            followed_user_ids = followed_user_ids['ids']
-            cache.set(cache_key, followed_user_ids)
-        return followed_user_ids
+                page = t.friends.ids(user_id=user_id, cursor=cursor, count=5000)
+            except TwitterHTTPError as e:
+                if self.is_unreachable_error(e):
+                    self.mark_users_not_found([user])
+                    raise SocialMediaException('User %s (%s) not found on Twitter' % (user.username, user_id))
+                raise SocialMediaException('Could not get followed users for %s (%s): %s' % (user.username, user_id, e))
+
+            followed_user_ids.extend(page['ids'])
+            cursor = page.get('next_cursor', 0)
+
+        return sorted(followed_user_ids)
+
+    def fetch_recent_tweets(self, user_id, since_id=None, count=None):
+        """
+        Get the tweets that the user has sent since the tweet with the given
+        id (or their latest few tweets), oldest first. Returns an empty list
+        if Twitter can't give them to us right now.
+        """
+        params = {'user_id': user_id, 'count': count or 20, 'include_rts': 'false'}
+        if since_id is not None:
+            params['since_id'] = since_id
+
+        t = self.get_api(bulk_endpoint='statuses/user_timeline')
+        try:
+            tweets = t.statuses.user_timeline(**params)
+        except TwitterHTTPError as e:
+            log.warning('Could not get recent tweets for user %s: %s' % (user_id, e))
+            return []
+
+        return list(reversed(tweets))
 
     # ==================================================================
     # User-specific info, from the database, used for authenticating
     # against Twitter on behalf of a specific user
     # ==================================================================
     def get_user_id(self, user):
+        if user.twitter_uid:
+            return user.twitter_uid
+
         cache_key = self.get_user_cache_key(user, 'social-id')
         social_id = cache.get(cache_key)
 
@@ -320,15 +654,62 @@ class TwitterService (object):
             app_config.twitter_consumer_secret,
         )
 
-    def get_api(self, on_behalf_of=None):
-        # If user is None, tweet from the app's account
+    # ==================================================================
+    # A pool of credentials to spread bulk reads over. Rate limits are
+    # counted per token, so reads that the app makes for itself can be made
+    # with the app's token or with the token of any user who has agreed to
+    # lend theirs (by setting TWITTER_CREDENTIAL_POOL_CONSENT_KEY in their
+    # social auth extra data).
+    # ==================================================================
+    def get_credential_pool(self):
+        cache_key = 'twitter-credential-pool'
+        pool = cache.get(cache_key)
+
+        if pool is None:
+            app_config = AppConfig.get()
+            consumer = (app_config.twitter_consumer_key, app_config.twitter_consumer_secret)
+            pool = [(app_config.twitter_access_token,
+                     app_config.twitter_access_token_secret) + consumer]
+
+            consent_key = settings.TWITTER_CREDENTIAL_POOL_CONSENT_KEY
+            lenders = UserSocialAuth.objects\
+                .filter(provider='twitter')\
+                .filter(extra_data__contains='"%s": true' % consent_key)\
+                .order_by('pk')
+            for social_auth in lenders:
+                if len(pool) >= settings.TWITTER_CREDENTIAL_POOL_MAX_SIZE:
+                    break
+
+                extra_data = social_auth.extra_data
+                if extra_data.get(consent_key) is not True:
+                    continue
+
+                access_token = parse_qs(extra_data['access_token'])
+                pool.append((access_token['oauth_token'][0],
+                             access_token['oauth_token_secret'][0]) + consumer)
+
+            cache.set(cache_key, pool, settings.TWITTER_CREDENTIAL_POOL_CACHE_TIMEOUT)
+
+        return [OAuth(*oauth_args) for oauth_args in pool]
+
+    def get_pooled_oauth(self, endpoint):
+        pool = self.get_credential_pool()
+        identities = [rate_limits.get_identity(oauth) for oauth in pool]
+        return pool[rate_limits.choose(endpoint, identities)]
+
+    def get_api(self, on_behalf_of=None, bulk_endpoint=None):
+        # If user is None, tweet from the app's account. For bulk reads, any
+        # of the pooled credentials will do.
         if on_behalf_of is None:
-            oauth = self.get_app_oauth()
+            if bulk_endpoint is None:
+                oauth = self.get_app_oauth()
+            else:
+                oauth = self.get_pooled_oauth(bulk_endpoint)
         # Otherwise, tweet from the user's twitter account
         else:
             oauth = self.get_user_oauth(on_behalf_of)
 
-        return Twitter(auth=oauth)
+        return PooledTwitter(auth=oauth, connection_pool=self.connection_pool)
 
     def get_stream(self, on_behalf_of=None, **kwargs):
         # If user is None, tweet from the app's account
@@ -338,6 +719,13 @@ class TwitterService (object):
         else:
             oauth = self.get_user_oauth(on_behalf_of)
 
+        if hasattr(self.connection_pool, 'get_stream'):
+            return self.connection_pool.get_stream(auth=oauth, **kwargs)
+
+        # Blocking streams with a timeout only notice keep-alives with our
+        # own stream class; see KeepAliveJSONIter.
+        if kwargs.get('block', True) and kwargs.get('timeout'):
+            return KeepAliveStream(auth=oauth, timeout=kwargs['timeout'])
         return TwitterStream(auth=oauth, **kwargs)
 
     # ==================================================================
@@ -352,10 +740,12 @@ class TwitterService (object):
         else:
             if on_behalf_of is not None:
                 user_ids = cache.get('listening_user_ids', set())
-                if self.get_user_id(on_behalf_of) not in user_ids:
-                    # Since we're communicating with a different process, go
-                    # directly to the central cache.
-                    django_cache.cache.set('restart_listener', True)
+                user_id = self.get_user_id(on_behalf_of)
+                if user_id not in user_ids:
+                    # Have the listener follow this user's tweets too. It
+                    # catches up on their tweets, starting after this one,
+                    # until it reconnects with them in the stream.
+                    listener_control.publish('follow:%s:%s' % (user_id, result['id_str']))
             return True, result
 
     def add_favorite(self, on_behalf_of, tweet_id, **extra):
@@ -382,9 +772,17 @@ class TwitterService (object):
     #
     # Streaming
     #
-    def itertweets(self, on_behalf_of=None, **extra):
-        s = self.get_stream(on_behalf_of, block=False)
+    def itertweets(self, on_behalf_of=None, block=False, timeout=None, **extra):
+        s = self.get_stream(on_behalf_of, block=block, timeout=timeout)
         return s.statuses.filter(**extra)
 
 
-default_twitter_service = TwitterService()
+def make_default_twitter_service():
+    fake_api_options = getattr(settings, 'TWITTER_FAKE_API', None)
+    if fake_api_options is not None:
+        from .faketwitter import FakeTwitterAPI
+        log.warning('Using a fake Twitter API')
+        return TwitterService(connection_pool=FakeTwitterAPI(**fake_api_options))
+    return TwitterService()
+
+default_twitter_service = make_default_twitter_service()
@@ -29,6 +29,157 @@ ALLOWED_HOSTS = []
 APP_CONFIG_CACHE_KEY = 'app_config'
 APP_CONFIG_INDEX = 0
 
+###############################################################################
+#
+# Caching
+#
+
+# Each process keeps a local buffer of values read from the shared cache. It
+# holds at most CACHE_BUFFER_MAX_SIZE entries, and values that are not set with
+# an explicit timeout expire after CACHE_BUFFER_TIMEOUT seconds.
+CACHE_BUFFER_MAX_SIZE = 10000
+CACHE_BUFFER_TIMEOUT = 300
+
+# Tasks and commands that run inside of a cache buffer scope flush their
+# writes to the shared cache once this many keys are queued, or once the oldest
+# queued write is this many seconds old.
+CACHE_BUFFER_SCOPE_MAX_QUEUE_SIZE = 500
+CACHE_BUFFER_SCOPE_MAX_QUEUE_AGE = 30
+
+# When CACHE_BUFFER_WRITE_BEHIND is True, requests hand their cache writes off
+# to a background thread instead of writing them before responding. The
+# thread writes them every CACHE_BUFFER_WRITE_BEHIND_INTERVAL seconds, in
+# batches of up to CACHE_BUFFER_WRITE_BEHIND_BATCH_SIZE keys.
+CACHE_BUFFER_WRITE_BEHIND = False
+CACHE_BUFFER_WRITE_BEHIND_INTERVAL = 1
+CACHE_BUFFER_WRITE_BEHIND_BATCH_SIZE = 100
+
+# When CACHE_BUFFER_INVALIDATION is True, processes announce the keys that
+# they change through the shared cache, and other processes drop those keys
+# from their local buffers within CACHE_BUFFER_SYNC_INTERVAL seconds.
+# Announcements are kept for CACHE_INVALIDATION_RETENTION seconds; a process
+# that falls more than CACHE_INVALIDATION_MAX_BACKLOG announcements behind
+# drops its whole buffer.
+CACHE_BUFFER_INVALIDATION = True
+CACHE_BUFFER_SYNC_INTERVAL = 1
+CACHE_INVALIDATION_RETENTION = 3600
+CACHE_INVALIDATION_MAX_BACKLOG = 1000
+
+# When a cached Twitter lookup is missing, only one process fetches it; it
+# holds a lock for at most SINGLE_FLIGHT_LOCK_TIMEOUT seconds. The others check
+# the cache for the result every SINGLE_FLIGHT_POLL_INTERVAL seconds, for up to
+# SINGLE_FLIGHT_WAIT_TIMEOUT seconds, before fetching it themselves. For the
+# few lookups that keep a stale copy (just the Twitter configuration), they
+# fall back on the last value fetched instead, which is kept for
+# SINGLE_FLIGHT_STALE_TIMEOUT seconds.
+SINGLE_FLIGHT_LOCK_TIMEOUT = 30
+SINGLE_FLIGHT_WAIT_TIMEOUT = 5
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+SINGLE_FLIGHT_STALE_TIMEOUT = 7 * 24 * 60 * 60
+
+# Twitter user info is cached for TWITTER_USER_INFO_CACHE_TIMEOUT seconds, but
+# after TWITTER_USER_INFO_FRESH_TIMEOUT seconds it is refreshed in the
+# background the next time it is read. A user's info is refreshed at most once
+# every TWITTER_USER_INFO_REFRESH_LOCK_TIMEOUT seconds.
+TWITTER_USER_INFO_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+TWITTER_USER_INFO_FRESH_TIMEOUT = 24 * 60 * 60
+TWITTER_USER_INFO_REFRESH_LOCK_TIMEOUT = 5 * 60
+
+# Set TWITTER_USER_INFO_COMPRESS to zlib-compress cached Twitter user info.
+TWITTER_USER_INFO_COMPRESS = False
+
+# When Twitter can't find a user (they are protected, suspended, or gone), we
+# wait before asking about them again: an hour after the first miss, then six
+# hours, a day, and a week after each miss thereafter.
+TWITTER_NOT_FOUND_BACKOFF = (60 * 60, 6 * 60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60)
+
+# Calls to the Twitter API reuse open connections, with at most
+# TWITTER_HTTP_MAX_CONNECTIONS_PER_HOST connections to a host in each process.
+# Connections that sit idle for TWITTER_HTTP_IDLE_TIMEOUT seconds are dropped.
+# Requests give up after TWITTER_HTTP_CONNECT_TIMEOUT seconds trying to connect,
+# or TWITTER_HTTP_READ_TIMEOUT seconds waiting for a response.
+TWITTER_HTTP_MAX_CONNECTIONS_PER_HOST = 4
+TWITTER_HTTP_IDLE_TIMEOUT = 60
+TWITTER_HTTP_CONNECT_TIMEOUT = 5
+TWITTER_HTTP_READ_TIMEOUT = 30
+
+# Calls to Twitter are paced by the rate limit quotas that Twitter reports.
+# When a quota is used up, calls made while serving a page wait at most
+# TWITTER_RATE_LIMIT_MAX_WAIT seconds for it to reset before giving up, while
+# background tasks and commands wait up to TWITTER_RATE_LIMIT_BACKGROUND_MAX_WAIT
+# seconds.
+TWITTER_RATE_LIMIT_MAX_WAIT = 0
+TWITTER_RATE_LIMIT_BACKGROUND_MAX_WAIT = 15 * 60
+
+# While serving a request, calls to Twitter must finish within
+# TWITTER_REQUEST_TIME_BUDGET seconds of the start of the request; after that,
+# pages make do with cached or blank Twitter info. When
+# TWITTER_CIRCUIT_BREAKER_THRESHOLD calls in a row fail or time out, a process
+# stops calling Twitter for TWITTER_CIRCUIT_BREAKER_RESET_TIMEOUT seconds.
+TWITTER_REQUEST_TIME_BUDGET = 3
+TWITTER_CIRCUIT_BREAKER_THRESHOLD = 5
+TWITTER_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Only the followed users who are also users of the site are kept. The list of
+# the site's Twitter ids to compare against is cached for
+# SITE_TWITTER_IDS_CACHE_TIMEOUT seconds.
+SITE_TWITTER_IDS_CACHE_TIMEOUT = 5 * 60
+
+# The tweet listener reconnects if the stream sends nothing (not even a
+# keep-alive) for TWITTER_STREAM_STALL_TIMEOUT seconds. Other processes send it
+# commands (to follow a user, or to check for new keywords) through Redis
+# pub/sub when the shared cache is Redis; otherwise, it checks the shared cache
+# for commands every LISTENER_CONTROL_POLL_INTERVAL seconds.
+TWITTER_STREAM_STALL_TIMEOUT = 90
+LISTENER_CONTROL_POLL_INTERVAL = 5
+
+# The tweet listener imports tweets in batches of up to TWEET_IMPORT_BATCH_SIZE,
+# waiting at most TWEET_IMPORT_BATCH_WAIT seconds after the first tweet of a
+# batch arrives before importing it.
+TWEET_IMPORT_BATCH_SIZE = 100
+TWEET_IMPORT_BATCH_WAIT = 1
+
+# The tweet listener reconnects to the stream to follow new users or to track
+# new keywords at most once every LISTENER_RECONNECT_INTERVAL seconds. Until
+# then, it fetches the new users' tweets every LISTENER_CATCH_UP_INTERVAL
+# seconds, and keeps doing so for LISTENER_RECONNECT_OVERLAP seconds after
+# reconnecting, so that tweets sent while reconnecting aren't missed.
+LISTENER_RECONNECT_INTERVAL = 5 * 60
+LISTENER_CATCH_UP_INTERVAL = 60
+LISTENER_RECONNECT_OVERLAP = 60
+
+# Set TWITTER_FAKE_API to a dictionary of options for hatch.faketwitter's
+# FakeTwitterAPI (e.g., {'latency': 0.1, 'rate_limit': 180}) to have the app
+# talk to a local stand-in for Twitter instead of the real thing. This is for
+# benchmarks and offline development only.
+TWITTER_FAKE_API = None
+
+# Bulk reads that the app makes for itself (e.g., refreshing user info) are
+# spread over a pool of at most TWITTER_CREDENTIAL_POOL_MAX_SIZE tokens: the
+# app's, and those of users who have agreed to lend theirs. A user
+# agrees by having TWITTER_CREDENTIAL_POOL_CONSENT_KEY set to true in the extra
+# data of their Twitter social auth record. The pool is rebuilt every
+# TWITTER_CREDENTIAL_POOL_CACHE_TIMEOUT seconds.
+TWITTER_CREDENTIAL_POOL_CONSENT_KEY = 'lend_rate_limits'
+TWITTER_CREDENTIAL_POOL_MAX_SIZE = 20
+TWITTER_CREDENTIAL_POOL_CACHE_TIMEOUT = 60 * 60
+
+# Bulk user lookups ask Twitter about up to TWITTER_LOOKUP_CONCURRENCY groups
+# of 100 users at once.
+TWITTER_LOOKUP_CONCURRENCY = 4
+
+# The serialized categories and app config that are bootstrapped into every
+# page are cached. The app config JSON is replaced whenever the config is
+# saved; the categories JSON (which includes vision counts) is rebuilt at most
+# every CATEGORIES_JSON_CACHE_TIMEOUT seconds.
+APP_CONFIG_JSON_CACHE_KEY = 'app_config:json'
+CATEGORIES_JSON_CACHE_KEY = 'categories:json'
+CATEGORIES_JSON_CACHE_TIMEOUT = 60
+
+# The warmcache command looks up users on Twitter in batches of
+# WARMCACHE_BATCH_SIZE (at most 100 per users/lookup request).
+WARMCACHE_BATCH_SIZE = 100
+
 ###############################################################################
 #
 # Time Zones
@@ -103,6 +254,7 @@ MIDDLEWARE_CLASSES = (
 
     'social_auth.middleware.SocialAuthExceptionMiddleware',
     'hatch.middleware.HatchAuthMiddleware',
+    'hatch.middleware.CacheBufferMiddleware',
 )
 
 SECRET_KEY = 'Set me in local settings!!!'
@@ -127,6 +279,11 @@ LOGIN_URL          = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGIN_ERROR_URL    = '/'
 
+# Keep the screen name in the extra data of Twitter social auth records. The
+# user's Twitter id and screen name are copied from there onto the user
+# whenever the record is saved (see sync_user_twitter_identity).
+TWITTER_EXTRA_DATA = [('screen_name', 'screen_name')]
+
 # The Twitter configuration variable have to be present and truthy in order
 # for social_auth to recognize the Twitter log in as enabled. We have to use
 # lazy instantiation of the values because hatch.models imports this settings
@@ -197,6 +354,16 @@ INSTALLED_APPS = (
 import djcelery
 djcelery.setup_loader()
 
+# The tweets sent for new visions, replies, and shares wait in an outbox for a
+# Celery worker to send them, so that requests don't wait on Twitter. When
+# Twitter can't take a tweet right now, the worker tries again after
+# OUTGOING_TWEET_RETRY_DELAY seconds, then after twice that, and so on, up to
+# OUTGOING_TWEET_MAX_RETRIES times. Set OUTGOING_TWEETS_ASYNC to False to send
+# the tweets before responding instead (e.g., when there is no worker).
+OUTGOING_TWEETS_ASYNC = True
+OUTGOING_TWEET_RETRY_DELAY = 30
+OUTGOING_TWEET_MAX_RETRIES = 6
+
 ################################################################################
 #
 # Testing and administration
@@ -0,0 +1,465 @@
+"""
+Plumbing for the tweet listener.
+
+The filter stream is read with blocking reads on a thread of its own, which
+puts each message on a queue. The listener waits on that queue, so it sits
+idle until there is a tweet to handle. It takes the messages off the queue in
+small batches (see read_batches), so that each batch can be imported with a
+handful of queries.
+
+Other processes tell the listener what to do (e.g., follow a user who just
+tweeted through the app) through a control channel. When the shared cache is
+Redis, commands are sent with Redis pub/sub; otherwise, they are kept in the
+shared cache, where a thread in the listener checks for them every
+LISTENER_CONTROL_POLL_INTERVAL seconds. Either way, commands land on the same
+queue as the stream's messages.
+"""
+
+from django.conf import settings
+from Queue import Queue, Empty
+from threading import Thread, Event
+from time import time
+from twitter.api import TwitterHTTPError, wrap_response
+from twitter.stream import TwitterStream, TwitterStreamCall
+from .cache import CacheInvalidationChannel
+import json
+import select
+import socket
+import sys
+import urllib2
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+# ============================================================
+# The control channel
+# ============================================================
+
+def get_redis_connection():
+    """
+    Get a connection to the Redis server behind the shared cache, or None if
+    the shared cache isn't Redis.
+    """
+    try:
+        try:
+            from django_redis import get_redis_connection
+        except ImportError:
+            from redis_cache import get_redis_connection
+        return get_redis_connection()
+    except Exception:
+        return None
+
+
+class CacheControlChannel (CacheInvalidationChannel):
+    """
+    Keeps commands in the shared cache, numbered, the same way that cache
+    invalidation messages are kept.
+    """
+    seq_key = 'listener-control:seq'
+    message_key_format = 'listener-control:%s'
+
+    # Only the listener polls the channel, and it never publishes, so every
+    # command comes from some other origin.
+    listener_origin = 'listener'
+
+
+class Subscription (object):
+    def __init__(self, thread, stop):
+        self.thread = thread
+        self.stop = stop
+
+    def close(self):
+        self.stop()
+
+
+class ListenerControl (object):
+    channel_name = 'hatch:listener-control'
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval or getattr(settings, 'LISTENER_CONTROL_POLL_INTERVAL', 5)
+        self.cache_channel = CacheControlChannel()
+
+    def publish(self, command):
+        """
+        Send a command to the listener. Commands are fire-and-forget; one
+        sent while no listener is running is dropped.
+        """
+        redis = get_redis_connection()
+        if redis is not None:
+            redis.publish(self.channel_name, json.dumps(command))
+        else:
+            self.cache_channel.publish([command])
+
+    def subscribe(self, callback):
+        """
+        Call callback(command), on another thread, for each command sent from
+        now on. Returns a subscription to close when you're done listening.
+        """
+        redis = get_redis_connection()
+        if redis is not None:
+            return self.subscribe_redis(redis, callback)
+        else:
+            return self.subscribe_cache(callback)
+
+    def subscribe_redis(self, redis, callback):
+        pubsub = redis.pubsub()
+        pubsub.subscribe(self.channel_name)
+
+        def listen():
+            try:
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        callback(json.loads(message['data']))
+            except Exception as e:
+                log.warning('Stopped listening for listener commands: %s' % (e,))
+
+        def stop():
+            try:
+                pubsub.unsubscribe(self.channel_name)
+            except Exception:
+                pass
+
+        thread = Thread(target=listen, name='listener-control')
+        thread.daemon = True
+        thread.start()
+        return Subscription(thread, stop)
+
+    def subscribe_cache(self, callback):
+        stopped = Event()
+        seq, _ = self.cache_channel.poll(None)
+
+        def listen():
+            since = seq
+            looked_again = False
+            while not stopped.wait(self.poll_interval):
+                latest, commands = self.cache_channel.poll(
+                    since, self.cache_channel.listener_origin)
+
+                if commands is None and not looked_again:
+                    # A command may be half sent (numbered, but not stored
+                    # yet); look again next time before giving up on it.
+                    looked_again = True
+                    continue
+                looked_again = False
+                since = latest
+
+                if commands is None:
+                    # We missed some commands. Users who were to be followed
+                    # will be picked up at the next reconnect anyway, so
+                    # just check whether the keywords changed.
+                    commands = ['refresh']
+                for command in commands:
+                    callback(command)
+
+        thread = Thread(target=listen, name='listener-control')
+        thread.daemon = True
+        thread.start()
+        return Subscription(thread, stopped.set)
+
+
+listener_control = ListenerControl()
+
+
+# ============================================================
+# What to ask the stream for
+# ============================================================
+
+class StreamFilter (object):
+    """
+    The keywords and users that the listener has asked the stream for, and
+    the changes waiting to be made to them. Changing what the stream sends
+    means reconnecting, and Twitter makes clients that reconnect too often
+    wait (that's the 420 response), so changes are saved up and made at most
+    once every reconnect_interval seconds.
+    """
+    def __init__(self, track, follow, reconnect_interval=None):
+        self.track = list(track)
+        self.follow = set(str(user_id) for user_id in follow)
+        self.reconnect_interval = reconnect_interval or settings.LISTENER_RECONNECT_INTERVAL
+        self.connected_at = time()
+
+        self.pending_users = set()
+        self.track_changed = False
+
+    def get_stream_params(self):
+        stream_params = {}
+        if self.track:
+            stream_params['track'] = ','.join(self.track)
+        if self.follow:
+            stream_params['follow'] = ','.join(sorted(self.follow))
+        return stream_params
+
+    def add_users(self, user_ids):
+        """
+        Note users to follow the next time the stream is reconnected. Returns
+        the ones that were new.
+        """
+        new_users = set(str(user_id) for user_id in user_ids) - self.follow - self.pending_users
+        self.pending_users.update(new_users)
+        return new_users
+
+    def change_track(self, track):
+        if list(track) != self.track:
+            self.track_changed = True
+
+    def is_stale(self):
+        return bool(self.pending_users) or self.track_changed
+
+    def should_reconnect(self):
+        return self.is_stale() and time() - self.connected_at >= self.reconnect_interval
+
+
+# ============================================================
+# Connecting to the stream
+# ============================================================
+
+class KeepAliveJSONIter (object):
+    """
+    Reads the messages from a filter stream response. It works like
+    twitter.stream.TwitterJSONIter, except that anything at all coming in on
+    the socket, keep-alives included, counts as a sign of life. (The
+    original only counts whole messages, so a quiet but healthy stream looks
+    stalled.) Yields {'timeout': True} once stall_timeout seconds go by
+    without a byte from Twitter, and {'hangup': True} when Twitter closes the
+    connection. It can be closed from another thread, and closes the
+    connection once it stops.
+
+    It also undoes the chunked transfer encoding itself, rather than with
+    twitter.stream.recv_chunk, which loses data when one read takes in the
+    end of one chunk and the start of the next.
+    """
+    poll_interval = 1
+
+    def __init__(self, handle, stall_timeout, poll_interval=None):
+        self.handle = handle
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval or min(self.poll_interval, stall_timeout)
+        self.closed = False
+
+    def get_socket(self):
+        return self.handle.fp._sock.fp._sock
+
+    def close(self):
+        # The reading thread notices within poll_interval seconds, and closes
+        # the connection itself.
+        self.closed = True
+
+    def __iter__(self):
+        sock = self.get_socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.settimeout(self.stall_timeout)
+
+        decoder = json.JSONDecoder()
+        raw = ''
+        buf = ''
+        last_heard_at = time()
+
+        try:
+            while not self.closed:
+                buf = buf.lstrip()
+                try:
+                    message, end = decoder.raw_decode(buf)
+                except ValueError:
+                    pass
+                else:
+                    buf = buf[end:]
+                    yield wrap_response(message, self.handle.headers)
+                    continue
+
+                # SSL sockets may have data waiting that select can't see
+                pending = getattr(sock, 'pending', lambda: 0)()
+                if not pending and not select.select([sock], [], [], self.poll_interval)[0]:
+                    if time() - last_heard_at > self.stall_timeout:
+                        yield {'timeout': True}
+                        return
+                    continue
+
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    yield {'timeout': True}
+                    return
+
+                if not data:
+                    yield {'hangup': True}
+                    return
+                last_heard_at = time()
+
+                data, raw, ended = self.decode_chunks(raw + data)
+                buf += data.decode('utf-8')
+                if ended:
+                    yield {'hangup': True}
+                    return
+        finally:
+            self.handle.close()
+
+    def decode_chunks(self, raw):
+        """
+        Take the data out of the complete chunks at the start of a chunked
+        response body. Returns the data, the rest of the body, and whether
+        the last chunk has been seen.
+        """
+        data = []
+        while True:
+            header_end = raw.find('\r\n')
+            if header_end < 0:
+                break
+
+            size = int(raw[:header_end].split(';')[0], 16)
+            if size == 0:
+                return ''.join(data), '', True
+
+            chunk_start = header_end + 2
+            chunk_end = chunk_start + size
+            if len(raw) < chunk_end + 2:
+                break
+
+            data.append(raw[chunk_start:chunk_end])
+            raw = raw[chunk_end + 2:]
+
+        return ''.join(data), raw, False
+
+
+class KeepAliveStreamCall (TwitterStreamCall):
+    def _handle_response(self, req, uri, arg_data, _timeout=None):
+        try:
+            handle = urllib2.urlopen(req)
+        except urllib2.HTTPError as e:
+            raise TwitterHTTPError(e, uri, 'json', arg_data)
+        return KeepAliveJSONIter(handle, self.timeout)
+
+
+class KeepAliveStream (TwitterStream):
+    """
+    A blocking TwitterStream that is only considered stalled when nothing,
+    not even a keep-alive, has come in for ``timeout`` seconds. See
+    KeepAliveJSONIter.
+    """
+    def __init__(self, domain='stream.twitter.com', secure=True, auth=None,
+                 api_version='1.1', timeout=90):
+        TwitterStreamCall.__init__(
+            self, auth=auth, format='json', domain=domain,
+            callable_cls=KeepAliveStreamCall, secure=secure,
+            uriparts=(str(api_version),), timeout=timeout, gzip=False)
+
+
+# ============================================================
+# Reading the stream
+# ============================================================
+
+class StreamReader (Thread):
+    """
+    Reads messages from a stream and puts them on a queue as (kind, value)
+    pairs: (MESSAGE, message) for each message, then (END, None) when the
+    stream hangs up or stalls, or (ERROR, exc_info) if reading it fails.
+    """
+    MESSAGE = 'message'
+    END = 'end'
+    ERROR = 'error'
+
+    def __init__(self, stream, queue):
+        super(StreamReader, self).__init__(name='stream-reader')
+        self.daemon = True
+        self.stream = stream
+        self.queue = queue
+        self.stopped = False
+
+    def run(self):
+        try:
+            for message in self.stream:
+                if self.stopped:
+                    return
+
+                # Non-blocking streams send None when there's nothing to read
+                if message is None:
+                    continue
+
+                if message.get('hangup') or message.get('timeout'):
+                    log.info('\n*** The stream %s\n' % (
+                        'hung up' if message.get('hangup') else 'stalled',))
+                    break
+
+                self.queue.put((self.MESSAGE, message))
+        except Exception:
+            self.queue.put((self.ERROR, sys.exc_info()))
+        else:
+            self.queue.put((self.END, None))
+
+    def stop(self):
+        # The reader can't be interrupted in the middle of a read. Once it's
+        # stopped, it exits on the next message, or sooner if the stream can
+        # be closed (see KeepAliveJSONIter); either way, the old connection
+        # doesn't linger alongside the new one.
+        self.stopped = True
+        close = getattr(self.stream, 'close', None)
+        if close is not None:
+            close()
+
+
+def read_batches(stream, max_size, max_wait, control=listener_control,
+                 on_command=None, idle_interval=None):
+    """
+    Yield the messages from a stream in lists of up to max_size messages,
+    until the stream ends. A list is yielded once it is full, or once
+    max_wait seconds have passed since its first message arrived, whichever
+    comes first. Messages that have arrived are always yielded before
+    stopping.
+
+    Commands sent to the listener are passed to on_command, in the thread
+    that is reading the batches. If idle_interval is given, an empty list is
+    yielded whenever that many seconds go by without a message, so that the
+    reader gets a chance to do other work.
+    """
+    CONTROL = 'control'
+
+    messages = Queue()
+    reader = StreamReader(stream, messages)
+    subscription = control.subscribe(lambda command: messages.put((CONTROL, command)))
+    reader.start()
+
+    batch = []
+    batch_deadline = None
+
+    try:
+        while True:
+            if batch and (len(batch) >= max_size or time() >= batch_deadline):
+                yield batch
+                batch = []
+                continue
+
+            try:
+                # Wake up now and then, so that the process can be
+                # interrupted, or in time to hand over the current batch.
+                wait = max(0, batch_deadline - time()) if batch else (idle_interval or 60)
+                kind, value = messages.get(True, wait)
+            except Empty:
+                if not batch and idle_interval:
+                    yield []
+                continue
+
+            if kind == StreamReader.MESSAGE:
+                if not batch:
+                    batch_deadline = time() + (max_wait or 0)
+                batch.append(value)
+
+            elif kind == CONTROL:
+                if on_command is not None:
+                    on_command(value)
+                else:
+                    log.warning('Unknown listener command: %r' % (value,))
+
+            elif kind == StreamReader.END:
+                if batch:
+                    yield batch
+                return
+
+            elif kind == StreamReader.ERROR:
+                if batch:
+                    yield batch
+                exc_type, exc_value, exc_traceback = value
+                raise exc_type, exc_value, exc_traceback
+
+    finally:
+        subscription.close()
+        reader.stop()
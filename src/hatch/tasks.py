@@ -1,162 +1,262 @@
 import re
 from django.conf import settings
 from django.core.cache import cache
-from django.db import IntegrityError
-from django.db.models import Max
-from django.db.transaction import commit_on_success
+from django.utils.timezone import now, timedelta
 from celery import task
-from time import sleep
+from time import time
 from .cache import cache_buffer
-from .models import User, Tweet, AppConfig
+from .keywords import get_keyword_matcher
+from .models import User, Tweet, TrackedTwitterUser, AppConfig, OutgoingTweet, TemporaryTweetFailure
+from .ratelimit import rate_limits
 from .utils import chunk
 from .services import default_twitter_service as twitter_service
+from .streaming import StreamFilter, read_batches
 
 import logging
 log = logging.getLogger(__name__)
 
+LISTENER_CATCH_UP_CACHE_KEY = 'listener:catching-up'
+
 
 @task
+@cache_buffer.scope()
 def refresh_users():
 
     log.info('\n*** Refreshing user cache\n')
 
-    first_group_done = False
-    for user_group in chunk(User.objects.all(), 100):
+    # Go as fast as the rate limits allow, waiting for them to reset as needed
+    with rate_limits.patience(settings.TWITTER_RATE_LIMIT_BACKGROUND_MAX_WAIT):
+        for user_group in chunk(User.objects.all(), 100):
+            log.info('\n  - Downloading info for group of %s user(s)\n' %
+                     (len(user_group),))
+            twitter_service.get_users_info(user_group, force_refresh=True)
 
-        if first_group_done:
-            log.info('\n  - Waiting 60 seconds before next group\n')
-            sleep(60)
+    log.info('\n*** Done refreshing the user cache. Run me again in a day!\n')
 
-        log.info('\n  - Downloading info for group of %s user(s)\n' %
-                 (len(user_group),))
-        twitter_service.get_users_info(user_group, force_refresh=True)
-        first_group_done = True
 
-    log.info('\n*** Done refreshing the user cache. Run me again in a day!\n')
+@task
+@cache_buffer.scope()
+def refresh_users_info(user_pks):
+    """
+    Fetch fresh info for users whose cached info has gone stale.
+    """
+    users = User.objects.filter(pk__in=user_pks)
+    with rate_limits.patience(settings.TWITTER_RATE_LIMIT_BACKGROUND_MAX_WAIT):
+        for user_group in chunk(users, 100):
+            twitter_service.get_users_info(user_group, force_refresh=True)
+            cache.delete_many([
+                twitter_service.get_user_cache_key(user, 'info:refreshing')
+                for user in user_group])
+
+
+@task(max_retries=settings.OUTGOING_TWEET_MAX_RETRIES)
+@cache_buffer.scope()
+def send_outgoing_tweet(outgoing_tweet_pk):
+    """
+    Send a tweet from the outbox, trying again later (waiting twice as long
+    each time) if Twitter can't take it right now.
+    """
+    try:
+        outgoing_tweet = OutgoingTweet.objects.get(pk=outgoing_tweet_pk)
+    except OutgoingTweet.DoesNotExist:
+        log.warning('\n*** Outgoing tweet %s is gone; nothing to send\n' %
+                    (outgoing_tweet_pk,))
+        return
+
+    retries = send_outgoing_tweet.request.retries
+    final = (retries >= send_outgoing_tweet.max_retries)
+
+    try:
+        sent = outgoing_tweet.send(twitter_service, final=final)
+    except TemporaryTweetFailure as e:
+        delay = settings.OUTGOING_TWEET_RETRY_DELAY * 2 ** retries
+        log.info('\n*** Could not send %s yet (%s); trying again in %s seconds\n' %
+                 (outgoing_tweet, e, delay))
+        raise send_outgoing_tweet.retry(exc=e, countdown=delay)
+
+    if not sent:
+        log.warning('\n*** Gave up on %s: %s\n' % (outgoing_tweet, outgoing_tweet.error))
+
+
+@task
+@cache_buffer.scope()
+def send_pending_tweets(older_than=0):
+    """
+    Try once more to send the tweets that are still waiting in the outbox
+    (e.g., because the worker was down when they were queued).
+    """
+    cutoff = now() - timedelta(seconds=older_than)
+    pending = OutgoingTweet.objects\
+        .filter(status=OutgoingTweet.PENDING, updated_at__lte=cutoff)\
+        .order_by('created_at')
+
+    for outgoing_tweet in pending:
+        final = (outgoing_tweet.attempts >= settings.OUTGOING_TWEET_MAX_RETRIES)
+        try:
+            outgoing_tweet.send(twitter_service, final=final)
+        except TemporaryTweetFailure as e:
+            log.info('\n*** Could not send %s yet (%s)\n' % (outgoing_tweet, e))
+
+
+def get_tracking_terms(app_config):
+    terms = app_config.twitter_tracking_keywords.split('\n')
+    return [term.strip() for term in terms if term.strip()]
+
+
+def catch_up_on_users(since_ids, is_wanted):
+    """
+    Import the tweets that each of the users has sent since the tweet with
+    the given id, as the stream would have if we had been following them.
+    Moves each user's since id up to their latest tweet.
+    """
+    for user_id, since_id in since_ids.items():
+        tweets_data = twitter_service.fetch_recent_tweets(user_id, since_id)
+        if not tweets_data:
+            continue
+
+        since_ids[user_id] = tweets_data[-1]['id_str']
+        tweets_data = [tweet_data for tweet_data in tweets_data
+                       if 'retweeted_status' not in tweet_data]
+        tweets = Tweet.objects.import_from_stream(tweets_data, is_wanted)
+        if tweets:
+            log.info('\n  - Caught up on %s tweet(s) from user %s\n' % (len(tweets), user_id))
 
 
 @task
+@cache_buffer.scope()
 def listen_for_tweets():
 
     log.info('\n*** Listening for tweets...\n')
 
     app_config = AppConfig.get(cache=cache)
-    streaming_keywords = app_config.twitter_tracking_keywords.split('\n')
-    streaming_keywords = map(lambda keyword: keyword.strip(), streaming_keywords)
-
-    def contains_keywords(text):
-        """
-        Like twitter's criteria for matching tracking parameters, but a little
-        more lenient: https://dev.twitter.com/docs/streaming-apis/parameters#track
-        """
-        text = text.lower()
-
-        # If any of the terms match, return True. Otherwise False.
-        for term in streaming_keywords:
-            if all(keyword in text for keyword in term.lower().split()):
-                return True
-                
-        return False
-
-    # User on most recent tweets
-    recent_tweets = Tweet.objects.all()\
-        .values('tweet_user_id', 'tweet_user_screen_name')\
-        .annotate(most_recent=Max('created_at'))\
-        .order_by('-most_recent')[:5000]
-
-    user_ids = [tweet['tweet_user_id'] for tweet in recent_tweets if tweet['tweet_user_id']]
+    streaming_keywords = get_tracking_terms(app_config)
+
+    # Built once for each value of the keywords, so that checking a tweet
+    # doesn't take longer as the list of keywords grows.
+    keyword_matcher = get_keyword_matcher(app_config.twitter_tracking_keywords)
+
+    # Follow the users whose tweets we've seen most recently
+    tracked_users = list(TrackedTwitterUser.objects.most_recently_seen(5000))
+
+    user_ids = [user.user_id for user in tracked_users]
     cache.set('listening_user_ids', set(user_ids))
 
-    stream_params = {}
-    if streaming_keywords:
-        stream_params['track'] = ','.join(streaming_keywords)
-    if user_ids:
-        stream_params['follow'] = ','.join(user_ids)
+    stream_filter = StreamFilter(streaming_keywords, user_ids)
+    stream_params = stream_filter.get_stream_params()
 
     log.info('\nTracking "%s" and following "%s"\n' % (
         ','.join(streaming_keywords),
-        ','.join([tweet['tweet_user_screen_name'] for tweet in recent_tweets if tweet['tweet_user_id']])
+        ','.join([user.screen_name for user in tracked_users])
     ))
 
-    tweets = twitter_service.itertweets(**stream_params)
-    for tweet_data in tweets:
-        if tweet_data is None:
-            # Any time we're not handling a tweet, we should be checking
-            # whether we should restart.
-            if cache.get('restart_listener'):
-                log.info(
-                    "\n*** Someone has told the tweet listener to restart, so I will.\n")
-                cache.delete('restart_listener')
-                return
-            else:
-                sleep(0.03)
-                continue
-
-        if 'disconnect' in tweet_data:
-            msg = tweet_data['disconnect']
-            log.info(
-                "\n*** Twitter doesn't like you anymore. Reason: %s (%s)\n" %
-                (msg.get('reason'), msg.get('code')))
-            return
-
-        if 'delete' in tweet_data:
-            tweet_data = tweet_data['delete']['status']
-            try:
-                tweet = Tweet.objects.get(tweet_id=tweet_data['id'])
-            except Tweet.DoesNotExist:
-                continue
-            else:
-                log.info('\n*** Twitter wants us to delete a tweet. Let\'s comply.\n')
-                tweet.delete()
-                continue
-
-        log.info('\n  - I see a tweet!: %s; Checking it out.\n' % (tweet_data.get('id', str(tweet_data)),))
-
-        if 'retweeted_status' in tweet_data:
-            log.info('\n  - Oh, nevermind, it\'s a retweet.\n')
-            continue
-
-        # Now we're interested. Check if we already have it.
-        tweet, created = Tweet.objects.create_or_update_from_tweet_data(tweet_data, commit=False)
-        log.info('\n  - Imported a tweet: %s!\n' % (tweet,))
+    # Users who we aren't following yet get their tweets fetched every
+    # LISTENER_CATCH_UP_INTERVAL seconds, until the stream is reconnected
+    # with them in it. Keep fetching for the users who were added on this
+    # connection for LISTENER_RECONNECT_OVERLAP seconds, in case they sent
+    # anything while we were reconnecting.
+    catching_up = cache.get(LISTENER_CATCH_UP_CACHE_KEY) or {}
+    cache.delete(LISTENER_CATCH_UP_CACHE_KEY)
+    overlapping_users = set(catching_up)
+    stream_filter.add_users(catching_up)
+    overlap_ends_at = time() + settings.LISTENER_RECONNECT_OVERLAP
+    last_caught_up_at = time()
 
-        # Do we already have this tweet? This will be the case if someone has
-        # entered a vision or a reply through the app UI. In that case, we
-        # create a tweet immediately.
-        if not created:
-            log.info('\n  - Ah, we already have this one. It has been dealt with, I assume.\n')
-            continue
+    def handle_command(command):
+        if command == 'refresh':
+            app_config = AppConfig.get(cache=cache)
+            stream_filter.change_track(get_tracking_terms(app_config))
 
-        # Is it a reply, and is the tweet it's replying to already assigned?
-        # If so, attach this tweet.
-        elif tweet.in_reply_to:
-            log.info('\n  - It\'s a reply, and we have the original! Let\'s keep it.\n')
-
-            # Since we did not commit the tweet immediately, we don't know
-            # whether another process or thread has created in the mean time.
-            # Assume it is still new, and just handle the exception if our
-            # assumption is wrong.
-            try:
-                with commit_on_success():
-                    tweet.save(force_insert=True)
-            except IntegrityError:
-                log.info('\n  - Oh, nevermind. Someone got to it before us.\n')
-                continue
-
-            if tweet.in_reply_to.is_vision() or tweet.in_reply_to.is_reply():
-                log.info('\n  - Even better: we know what conversation it belongs to!\n')
-                tweet.make_reply()
-
-        # Otherwise, does it mention any of our keywords?
-        elif contains_keywords(tweet.tweet_data['text']):
-            log.info('\n  - Mmm, I see those keywords I\'m lookin for. I\'ll keep it.\n')
-            tweet.save()
+        elif command.startswith('follow:'):
+            # 'follow:<user id>:<id of the tweet they just sent>'
+            _, user_id, since_id = (command.split(':') + [''])[:3]
+            if stream_filter.add_users([user_id]):
+                log.info('\n  - I\'ll follow user %s when I next reconnect\n' % (user_id,))
+                catching_up[user_id] = since_id or None
 
         else:
-            log.info('\n  - Bah, it doesn\'t have anything I\'m interested in. Discarding.\n')
-            continue
+            log.warning('Unknown listener command: %r' % (command,))
+
+    # Read the stream on a thread of its own, and import the tweets in small
+    # batches as they come in. Commands come in on the listener's control
+    # channel.
+    stream = twitter_service.itertweets(
+        block=True, timeout=settings.TWITTER_STREAM_STALL_TIMEOUT, **stream_params)
+    batches = read_batches(stream,
+                           settings.TWEET_IMPORT_BATCH_SIZE,
+                           settings.TWEET_IMPORT_BATCH_WAIT,
+                           on_command=handle_command,
+                           idle_interval=settings.LISTENER_CATCH_UP_INTERVAL)
+
+    try:
+        for batch in batches:
+            tweets_data = []
+            deleted_ids = []
+            disconnected = False
+
+            for tweet_data in batch:
+                if 'disconnect' in tweet_data:
+                    msg = tweet_data['disconnect']
+                    log.info(
+                        "\n*** Twitter doesn't like you anymore. Reason: %s (%s)\n" %
+                        (msg.get('reason'), msg.get('code')))
+                    disconnected = True
+                    break
+
+                if 'delete' in tweet_data:
+                    deleted_ids.append(str(tweet_data['delete']['status']['id']))
+                    continue
+
+                if 'retweeted_status' in tweet_data:
+                    continue
+
+                if 'user' not in tweet_data:
+                    log.info('\n  - Skipping a message that isn\'t a tweet: %s\n' % (tweet_data,))
+                    continue
+
+                tweets_data.append(tweet_data)
+
+            if tweets_data:
+                tweets = Tweet.objects.import_from_stream(tweets_data, keyword_matcher.matches)
+                log.info('\n*** Kept %s of the %s tweet(s) I saw\n' % (len(tweets), len(tweets_data)))
+
+                # Follow the users we haven't seen before, so that we see the
+                # replies to their tweets.
+                for tweet in tweets:
+                    if stream_filter.add_users([tweet.tweet_user_id]):
+                        log.info('\n  - I see a new user, %s! I\'ll follow them when I next reconnect.\n' % (
+                            tweet.tweet_user_screen_name,))
+                        catching_up[tweet.tweet_user_id] = tweet.tweet_id
+
+            # Deletes come after the tweets in the same batch, in case any of
+            # them is among the deleted.
+            if deleted_ids:
+                deleted = Tweet.objects.filter(tweet_id__in=deleted_ids)
+                if deleted.exists():
+                    log.info('\n*** Twitter wants us to delete some tweets. Let\'s comply.\n')
+                    deleted.delete()
+
+            if disconnected:
+                return
+
+            if overlapping_users and time() >= overlap_ends_at:
+                for user_id in overlapping_users - stream_filter.pending_users:
+                    catching_up.pop(user_id, None)
+                overlapping_users = set()
+
+            if catching_up and time() - last_caught_up_at >= settings.LISTENER_CATCH_UP_INTERVAL:
+                catch_up_on_users(catching_up, keyword_matcher.matches)
+                last_caught_up_at = time()
+
+            if stream_filter.should_reconnect():
+                log.info('\n*** Reconnecting to pick up %s new user(s)%s\n' % (
+                    len(stream_filter.pending_users),
+                    ' and the new keywords' if stream_filter.track_changed else ''))
+                return
 
-        # If the user is new, bail out of the loop.
-        if tweet.pk and tweet_data['user']['id_str'] not in user_ids:
-            log.info('\n  - I see a new user, %s! I\'m gonna bail now; bye.\n' % tweet_data['user']['screen_name'])
-            break
\ No newline at end of file
+    finally:
+        # However the stream ends, hand the users we're catching up on to the
+        # next connection.
+        cache.set(LISTENER_CATCH_UP_CACHE_KEY,
+                  dict((user_id, catching_up[user_id]) for user_id in stream_filter.pending_users
+                       if user_id in catching_up),
+                  settings.LISTENER_RECONNECT_INTERVAL)
@@ -1,23 +1,26 @@
 from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
 from django.conf import settings
 from django.core.urlresolvers import reverse, clear_url_caches
 from django.core.cache import cache
 from .utils import create_app_config
 from ..services import TwitterService
 from ..serializers import VisionSerializer, UserSerializer
-from ..views import VisionViewSet, UserViewSet, ReplyViewSet, VisionActionViewSet
-from ..models import Vision, User, Reply, Category, Tweet, AppConfig, Share
+from ..views import VisionViewSet, UserViewSet, ReplyViewSet, VisionActionViewSet, OutgoingTweetViewSet
+from ..models import Vision, User, Reply, Category, Tweet, AppConfig, Share, OutgoingTweet, TemporaryTweetFailure
+from ..tasks import send_outgoing_tweet
 from ..cache import cache_buffer
 from social_auth.models import UserSocialAuth
 from mock import patch, Mock
 import json
 
 
+@override_settings(OUTGOING_TWEETS_ASYNC=False)
 class VisionsTest (TestCase):
     def setUp(self):
         create_app_config()
         cache.clear()
-        cache_buffer.reset()
+        cache_buffer.clear()
 
         # Reload the urls to reinitialize the vision routes
         import hatch.urls
@@ -29,7 +32,7 @@ class VisionsTest (TestCase):
         Vision.objects.all().delete()
         AppConfig.objects.all().delete()
         cache.clear()
-        cache_buffer.reset()
+        cache_buffer.clear()
 
     def test_vision_contents(self):
         user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
@@ -165,6 +168,7 @@ class VisionsTest (TestCase):
             self.assertEqual(response.status_code, 400)
 
 
+@override_settings(OUTGOING_TWEETS_ASYNC=False)
 class ReplyTest (TestCase):
     def setUp(self):
         create_app_config()
@@ -244,6 +248,7 @@ class ReplyTest (TestCase):
             self.assertIn('tweet', response.content)
 
 
+@override_settings(OUTGOING_TWEETS_ASYNC=False)
 class ShareTest (TestCase):
     def setUp(self):
         create_app_config()
@@ -299,6 +304,183 @@ class ShareTest (TestCase):
             self.assertEqual(share.retweet_id, '12345')
 
 
+@override_settings(OUTGOING_TWEETS_ASYNC=True)
+class OutgoingTweetTest (TestCase):
+    def setUp(self):
+        create_app_config()
+        cache.clear()
+
+        # Reload the urls to reinitialize the vision routes
+        import hatch.urls
+        reload(hatch.urls)
+        clear_url_caches()
+
+        Category.objects.create(name='economy', title='', prompt='')
+
+        self.user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
+        self.sent_tweet = {'id': 12345, 'user': {'id_str': '2468', 'screen_name': 'mjumbe'}}
+        self.over_capacity = json.dumps({'errors': [{'code': 130, 'message': 'Over capacity'}]})
+        self.duplicate = json.dumps({'errors': [{'code': 187, 'message': 'Status is a duplicate'}]})
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Vision.objects.all().delete()
+        Category.objects.all().delete()
+        OutgoingTweet.objects.all().delete()
+        AppConfig.objects.all().delete()
+        cache.clear()
+
+    def create_vision(self):
+        class StubTwitterService (object):
+            tweet = Mock()
+
+            def get_avatar_url(self, user, actor=None):
+                return ''
+
+            def get_full_name(self, user, actor=None):
+                return ''
+
+            def get_bio(self, user, actor=None):
+                return ''
+
+            def get_url_length(self, url, actor=None):
+                return 20
+
+            def get_users_info(self, users, actor=None):
+                return []
+
+        request = RequestFactory().post(reverse('vision-list'), data=json.dumps({
+                'author': self.user.pk,
+                'category': 'economy',
+                'text': 'This is a vision',
+            }), content_type='application/json')
+        request.user = self.user
+        request.csrf_processing_done = True
+
+        with patch('hatch.views.VisionViewSet.get_twitter_service', classmethod(lambda cls: StubTwitterService())):
+            with patch('hatch.views.send_outgoing_tweet') as task:
+                view = VisionViewSet.as_view({'post': 'create'})
+                response = view(request)
+                response.render()
+
+        # Nothing should have been tweeted while the request waited
+        self.assertEqual(StubTwitterService.tweet.call_count, 0)
+        return response, task
+
+    def test_vision_is_saved_before_it_is_tweeted(self):
+        response, task = self.create_vision()
+        self.assertEqual(response.status_code, 201, response.content)
+
+        vision = Vision.objects.get()
+        self.assertIsNone(vision.app_tweet)
+
+        outgoing_tweet = OutgoingTweet.objects.get()
+        self.assertEqual(outgoing_tweet.status, OutgoingTweet.PENDING)
+        self.assertEqual(outgoing_tweet.vision, vision)
+        task.delay.assert_called_once_with(outgoing_tweet.pk)
+
+        data = json.loads(response.content)
+        self.assertEqual([t['id'] for t in data['outgoing_tweets']], [outgoing_tweet.pk])
+
+    def test_temporary_failures_are_retried(self):
+        self.create_vision()
+        outgoing_tweet = OutgoingTweet.objects.get()
+        service = Mock()
+
+        service.tweet.return_value = (False, self.over_capacity)
+        with self.assertRaises(TemporaryTweetFailure):
+            outgoing_tweet.send(service, final=False)
+        self.assertEqual(OutgoingTweet.objects.get().status, OutgoingTweet.PENDING)
+
+        service.tweet.return_value = (True, self.sent_tweet)
+        self.assertTrue(outgoing_tweet.send(service, final=False))
+
+        outgoing_tweet = OutgoingTweet.objects.get()
+        self.assertEqual(outgoing_tweet.status, OutgoingTweet.SENT)
+        self.assertEqual(outgoing_tweet.attempts, 2)
+        self.assertEqual(Vision.objects.get().app_tweet_id, '12345')
+
+    def test_vision_is_removed_when_the_app_tweet_fails(self):
+        self.create_vision()
+        outgoing_tweet = OutgoingTweet.objects.get()
+        service = Mock()
+        service.tweet.return_value = (False, self.duplicate)
+
+        self.assertFalse(outgoing_tweet.send(service, final=False))
+        self.assertEqual(Vision.objects.count(), 0)
+
+        outgoing_tweet = OutgoingTweet.objects.get()
+        self.assertEqual(outgoing_tweet.status, OutgoingTweet.FAILED)
+        self.assertIn('duplicate', outgoing_tweet.error)
+
+    def test_share_is_undone_when_the_retweet_fails(self):
+        Tweet.objects.create(tweet_id='c', tweet_data={'text': 'abc'})
+        vision = Vision.objects.create(author=self.user, text='abc', app_tweet_id='c')
+        share = self.user.share(vision)
+        outgoing_tweet = OutgoingTweet.objects.create(
+            kind=OutgoingTweet.SHARE, requested_by=self.user, sender=self.user,
+            vision=vision, share=share)
+        service = Mock()
+        service.retweet.return_value = (False, self.duplicate)
+
+        self.assertFalse(outgoing_tweet.send(service, final=False))
+        self.assertEqual(Share.objects.count(), 0)
+        self.assertNotIn(self.user, vision.supporters.all())
+
+    def test_task_gives_up_after_max_retries(self):
+        self.create_vision()
+        outgoing_tweet = OutgoingTweet.objects.get()
+        service = Mock()
+        service.tweet.return_value = (False, self.over_capacity)
+
+        with patch('hatch.tasks.twitter_service', service):
+            send_outgoing_tweet.apply(args=[outgoing_tweet.pk])
+
+        outgoing_tweet = OutgoingTweet.objects.get()
+        self.assertEqual(outgoing_tweet.status, OutgoingTweet.FAILED)
+        self.assertEqual(outgoing_tweet.attempts, send_outgoing_tweet.max_retries + 1)
+        self.assertEqual(Vision.objects.count(), 0)
+
+    def test_reply_waits_for_the_vision_tweet(self):
+        vision = Vision.objects.create(author=self.user, text='abc')
+        reply = Reply.objects.create(author=self.user, vision=vision, text='def')
+        outgoing_tweet = OutgoingTweet.objects.create(
+            kind=OutgoingTweet.REPLY, requested_by=self.user, sender=self.user,
+            vision=vision, reply=reply, text='def')
+        service = Mock()
+        service.tweet.return_value = (True, dict(self.sent_tweet, text='def'))
+
+        with self.assertRaises(TemporaryTweetFailure):
+            outgoing_tweet.send(service, final=False)
+        self.assertEqual(service.tweet.call_count, 0)
+
+        Tweet.objects.create(tweet_id='c', tweet_data={'text': 'abc'})
+        vision.app_tweet_id = 'c'
+        vision.save()
+
+        outgoing_tweet = OutgoingTweet.objects.get()
+        self.assertTrue(outgoing_tweet.send(service, final=False))
+        self.assertEqual(service.tweet.call_args[1], {'in_reply_to_status_id': 'c'})
+        self.assertEqual(Reply.objects.get().tweet_id, '12345')
+
+    def test_outbox_shows_only_your_own_tweets(self):
+        self.create_vision()
+        outgoing_tweet = OutgoingTweet.objects.get()
+        other_user = User.objects.create_user('other', 'other@example.com', 'password')
+        view = OutgoingTweetViewSet.as_view({'get': 'retrieve'})
+
+        request = RequestFactory().get('/api/outbox/%s' % (outgoing_tweet.pk,))
+        request.user = self.user
+        response = view(request, pk=outgoing_tweet.pk)
+        response.render()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['status'], 'pending')
+
+        request.user = other_user
+        response = view(request, pk=outgoing_tweet.pk)
+        self.assertEqual(response.status_code, 404)
+
+
 class UserSerializerTest (TestCase):
     def test_non_twitter_user(self):
         user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
@@ -334,3 +516,27 @@ class UserSerializerTest (TestCase):
             # Note that we're using the 'bigger' avatar variants.
             self.assertEqual(data.get('avatar_url'), 'http://www.google.com/happy_ducks_bigger.png')
             self.assertEqual(data.get('full_name'), 'Mjumbe Poe')
+
+
+class UserQuerysetTest (TestCase):
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_followed_users_come_first(self):
+        users = []
+        for uid in (1, 2, 3):
+            user = User.objects.create(username='user%s' % uid)
+            UserSocialAuth.objects.create(user=user, uid=uid, provider='twitter', extra_data='{}')
+            users.append(user)
+
+        request = RequestFactory().get('/api/users/')
+        request.user = users[0]
+        view = UserViewSet()
+        view.request = request
+
+        with patch.object(TwitterService, 'get_followed_users', return_value=[3]):
+            qs = view.get_user_queryset()
+            self.assertEqual(qs[0], users[2])
+            self.assertEqual(len(qs), 3)
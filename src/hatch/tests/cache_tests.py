@@ -1,6 +1,10 @@
 from django.test import TestCase
 from django.core.cache import cache
-from ..cache import CacheBuffer
+from ..cache import (
+    CacheBuffer, ThreadLocalCacheBuffer, WriteBehindFlusher, LocalCache,
+    InvalidationChannel, CacheInvalidationChannel, SingleFlight)
+from ..middleware import CacheBufferMiddleware
+from ..models import AppConfig
 from mock import patch, Mock
 
 
@@ -58,3 +62,383 @@ class CacheBufferTest (TestCase):
         b.delete_many(['a', 'b'])
         b.delete_many(['b', 'd'])
         self.assertEqual(b.delete_queue, set(['a', 'b', 'd']))
+
+    def test_buffer_is_bounded(self):
+        b = CacheBuffer(max_size=3)
+
+        b.set('a', 1)
+        b.set('b', 2)
+        b.set('c', 3)
+        b.get('a')  # Touch 'a' so that 'b' is the least recently used
+        b.set('d', 4)
+
+        self.assertEqual(len(b.buffer), 3)
+        self.assertNotIn('b', b.buffer)
+        self.assertIn('a', b.buffer)
+        self.assertEqual(b.stats()['evictions'], 1)
+
+    def test_buffered_values_expire_with_their_timeout(self):
+        b = CacheBuffer(timeout=300)
+
+        with patch('hatch.cache.time') as time:
+            time.return_value = 1000
+            b.set('short', 'val1', 10)
+            b.set('long', 'val2')
+
+            time.return_value = 1011
+            self.assertNotIn('short', b.buffer)
+            self.assertIn('long', b.buffer)
+
+            time.return_value = 1301
+            self.assertNotIn('long', b.buffer)
+
+    def test_expired_values_are_read_from_the_remote_cache(self):
+        cache.set('key1', 'remote')
+        b = CacheBuffer({'key1': 'local'}, timeout=60)
+
+        with patch('hatch.cache.time') as time:
+            time.return_value = 0
+            b.buffer.set('key1', 'local')
+            self.assertEqual(b.get('key1'), 'local')
+
+            time.return_value = 61
+            self.assertEqual(b.get('key1'), 'remote')
+
+    def test_flushes_automatically_when_queue_is_full(self):
+        b = CacheBuffer(max_queue_size=3)
+
+        b.set('a', 1)
+        b.set_many({'b': 2})
+        self.assertEqual(cache.get_many(['a', 'b']), {})
+
+        b.delete('c')
+        self.assertEqual(cache.get_many(['a', 'b']), {'a': 1, 'b': 2})
+        self.assertEqual(b.queue, {})
+
+    def test_flushes_automatically_when_queue_is_old(self):
+        b = CacheBuffer(max_queue_age=30)
+
+        with patch('hatch.cache.time') as time:
+            time.return_value = 1000
+            b.set('a', 1)
+
+            time.return_value = 1029
+            b.set('b', 2)
+            self.assertEqual(cache.get_many(['a', 'b']), {})
+
+            time.return_value = 1030
+            b.set('c', 3)
+            self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_counts_hits_and_misses(self):
+        cache.set('a', 1)
+        b = CacheBuffer()
+
+        b.get('a')
+        b.get('a')
+        b.get_many(['a', 'b'])
+
+        stats = b.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+
+class ThreadLocalCacheBufferTest (TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_threads_have_separate_queues(self):
+        from threading import Thread
+        b = ThreadLocalCacheBuffer()
+        b.set('main', 1)
+
+        def work():
+            b.set('other', 2)
+            b.flush()
+        thread = Thread(target=work)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(b.queue, {'main': 1})
+        self.assertEqual(cache.get_many(['main', 'other']), {'other': 2})
+
+    def test_threads_share_the_local_cache(self):
+        from threading import Thread
+        b = ThreadLocalCacheBuffer()
+        b.set('key1', 'val1')
+
+        results = []
+        thread = Thread(target=lambda: results.append(b.get('key1')))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(results, ['val1'])
+
+    def test_middleware_flushes_and_releases_the_request_buffer(self):
+        from ..cache import cache_buffer
+        middleware = CacheBufferMiddleware()
+        request, response = Mock(), Mock()
+
+        middleware.process_request(request)
+        request_buffer = cache_buffer.current()
+        cache_buffer.set('key1', 'val1')
+        middleware.process_response(request, response)
+
+        self.assertEqual(cache.get('key1'), 'val1')
+        self.assertIsNot(cache_buffer.current(), request_buffer)
+
+    def test_scope_flushes_on_exit_and_restores_outer_buffer(self):
+        b = ThreadLocalCacheBuffer()
+        outer = b.current()
+        b.set('outer', 1)
+
+        with b.scope():
+            b.set('inner', 2)
+            self.assertEqual(b.queue, {'inner': 2})
+
+        self.assertIs(b.current(), outer)
+        self.assertEqual(b.queue, {'outer': 1})
+        self.assertEqual(cache.get_many(['inner', 'outer']), {'inner': 2})
+
+    def test_scope_as_decorator(self):
+        b = ThreadLocalCacheBuffer()
+
+        @b.scope(max_queue_size=2)
+        def job():
+            b.set('a', 1)
+            b.set('b', 2)
+            self.assertEqual(cache.get_many(['a', 'b']), {'a': 1, 'b': 2})
+            b.set('c', 3)
+
+        job()
+        self.assertEqual(cache.get('c'), 3)
+        self.assertIsNone(b.bound())
+
+
+class WriteBehindFlusherTest (TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_flushing_hands_queues_to_the_flusher(self):
+        flusher = WriteBehindFlusher(interval=60)
+        b = CacheBuffer(write_behind=flusher)
+
+        with patch.object(flusher, 'start'):
+            b.set('key1', 'val1')
+            b.flush()
+
+            self.assertEqual(b.queue, {})
+            self.assertEqual(cache.get('key1'), None)
+            self.assertEqual(b.get('key1'), 'val1')
+
+            flusher.drain()
+
+        self.assertEqual(cache.get('key1'), 'val1')
+
+    def test_writes_are_coalesced_across_buffers(self):
+        cache.set('c', 'old')
+        flusher = WriteBehindFlusher(interval=60)
+        b1 = CacheBuffer(write_behind=flusher)
+        b2 = CacheBuffer(write_behind=flusher)
+
+        with patch.object(flusher, 'start'):
+            b1.set_many({'a': 1, 'b': 1})
+            b1.delete('c')
+            b1.flush()
+
+            b2.set('a', 2)
+            b2.set('c', 2)
+            b2.delete('b')
+            b2.flush()
+
+            self.assertEqual(flusher.queue, {'a': 2, 'c': 2})
+            self.assertEqual(flusher.delete_queue, set(['b']))
+
+            with patch('hatch.cache.django_cache.cache.set_many') as set_many:
+                flusher.drain()
+                self.assertEqual(set_many.call_count, 1)
+
+    def test_background_thread_writes_pending_values(self):
+        flusher = WriteBehindFlusher(interval=0.01)
+        b = CacheBuffer(write_behind=flusher)
+
+        b.set('key1', 'val1')
+        b.flush()
+
+        from time import sleep
+        for _ in range(100):
+            if cache.get('key1') is not None: break
+            sleep(0.01)
+        flusher.stop()
+
+        self.assertEqual(cache.get('key1'), 'val1')
+
+
+class InvalidationTest (TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def make_worker_buffer(self, channel):
+        local_cache = LocalCache(channel=channel, sync_interval=60)
+        return CacheBuffer(local_cache=local_cache)
+
+    def let_sync_interval_pass(self, worker):
+        worker.buffer.next_sync = 0
+
+    def test_writes_in_one_worker_invalidate_another(self):
+        channel = InvalidationChannel()
+        worker1 = self.make_worker_buffer(channel)
+        worker2 = self.make_worker_buffer(channel)
+
+        cache.set('key1', 'old')
+        self.assertEqual(worker2.get('key1'), 'old')
+
+        worker1.set('key1', 'new')
+        worker1.flush()
+
+        self.assertEqual(worker2.get('key1'), 'old')
+        self.let_sync_interval_pass(worker2)
+        self.assertEqual(worker2.get('key1'), 'new')
+
+    def test_deletes_in_one_worker_invalidate_another(self):
+        channel = InvalidationChannel()
+        worker1 = self.make_worker_buffer(channel)
+        worker2 = self.make_worker_buffer(channel)
+
+        cache.set('key1', 'old')
+        self.assertEqual(worker2.get('key1'), 'old')
+
+        worker1.delete('key1')
+        worker1.flush()
+
+        self.let_sync_interval_pass(worker2)
+        self.assertEqual(worker2.get('key1'), None)
+
+    def test_own_writes_are_not_invalidated(self):
+        channel = InvalidationChannel()
+        worker = self.make_worker_buffer(channel)
+        worker.get('key1')
+
+        worker.set('key1', 'val1')
+        worker.flush()
+
+        self.let_sync_interval_pass(worker)
+        worker.buffer.sync()
+        self.assertIn('key1', worker.buffer)
+
+    def test_falling_behind_clears_the_buffer(self):
+        channel = InvalidationChannel(max_backlog=2)
+        worker1 = self.make_worker_buffer(channel)
+        worker2 = self.make_worker_buffer(channel)
+        worker2.buffer.set('unrelated', 1)
+        worker2.buffer.sync()
+
+        for key in ['a', 'b', 'c']:
+            worker1.invalidate([key])
+
+        self.let_sync_interval_pass(worker2)
+        worker2.buffer.sync()
+        self.assertNotIn('unrelated', worker2.buffer)
+
+    def test_cache_channel_carries_messages_through_the_cache(self):
+        publisher = CacheInvalidationChannel()
+        subscriber = CacheInvalidationChannel()
+
+        seq, keys = subscriber.poll(None, 'sub')
+        publisher.publish(['a', 'b'], 'pub')
+        publisher.publish(['c'], 'sub')
+
+        new_seq, keys = subscriber.poll(seq, 'sub')
+        self.assertEqual(new_seq, seq + 2)
+        self.assertEqual(keys, set(['a', 'b']))
+
+    def test_app_config_save_invalidates_buffered_config(self):
+        from django.conf import settings
+        from ..cache import cache_buffer
+        from .utils import create_app_config
+        create_app_config()
+
+        with patch.object(cache_buffer.local_cache, 'publish') as publish:
+            AppConfig.get().save()
+            publish.assert_called_with([settings.APP_CONFIG_CACHE_KEY,
+                                      settings.APP_CONFIG_JSON_CACHE_KEY])
+
+
+class SingleFlightTest (TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_concurrent_callers_share_one_fetch(self):
+        from threading import Thread, Event
+        flight = SingleFlight(CacheBuffer())
+        started, release = Event(), Event()
+        calls, results = [], []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'fetched'
+
+        leader = Thread(target=lambda: results.append(flight.do('key1', fetch)))
+        leader.start()
+        started.wait(5)
+
+        followers = [Thread(target=lambda: results.append(flight.do('key1', fetch)))
+                     for _ in range(3)]
+        for follower in followers: follower.start()
+        release.set()
+        for thread in [leader] + followers: thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['fetched'] * 4)
+        self.assertEqual(cache.get('key1'), 'fetched')
+
+    def test_waits_for_value_fetched_by_another_process(self):
+        flight = SingleFlight(CacheBuffer(), wait_timeout=1, poll_interval=0.01)
+        cache.add('key1:lock', True)
+        fetch = Mock(return_value='mine')
+
+        def other_process_finishes(seconds):
+            cache.set('key1', 'theirs')
+
+        with patch('hatch.cache.sleep', other_process_finishes):
+            self.assertEqual(flight.do('key1', fetch), 'theirs')
+        self.assertEqual(fetch.call_count, 0)
+
+    def test_falls_back_to_stale_value_when_other_process_is_slow(self):
+        flight = SingleFlight(CacheBuffer(), wait_timeout=0.05, poll_interval=0.01)
+        cache.set('key1:stale', 'stale')
+        cache.add('key1:lock', True)
+        fetch = Mock(return_value='mine')
+
+        self.assertEqual(flight.do('key1', fetch, keep_stale=True), 'stale')
+        self.assertEqual(fetch.call_count, 0)
+
+    def test_stale_copies_are_only_kept_when_asked_for(self):
+        flight = SingleFlight(CacheBuffer())
+
+        flight.do('key1', Mock(return_value='value1'))
+        self.assertIsNone(cache.get('key1:stale'))
+
+        flight.do('key2', Mock(return_value='value2'), keep_stale=True)
+        self.assertEqual(cache.get('key2:stale'), 'value2')
+
+    def test_releases_lock_when_fetch_fails(self):
+        flight = SingleFlight(CacheBuffer())
+        fetch = Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, flight.do, 'key1', fetch)
+        self.assertIsNone(cache.get('key1:lock'))
@@ -3,7 +3,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
 from ..services import TwitterService
-from ..models import Vision, User, Reply, Tweet
+from ..models import Vision, User, Reply, Tweet, TrackedTwitterUser
 from social_auth.models import UserSocialAuth
 from mock import patch, Mock
 from nose.tools import assert_equal
@@ -128,3 +128,121 @@ class TweetTest (TestCase):
         visions = Tweet.objects.all().make_visions()
         assert_equal(len(visions), 2)
         assert_equal(visions[0].author.id, visions[1].author.id)
+
+
+class StreamImportTest (TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='tweeter', twitter_uid='123456', twitter_screen_name='tweeter')
+        vision_tweet = Tweet.objects.create(tweet_id='1', tweet_data=self.make_tweet_data(1, 'my vision'))
+        self.vision = vision_tweet.make_vision()
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Vision.objects.all().delete()
+        Tweet.objects.all().delete()
+        cache.clear()
+
+    def make_tweet_data(self, tweet_id, text, in_reply_to=None):
+        return {
+            'id': tweet_id,
+            'text': text,
+            'user': {'id': 123456, 'id_str': '123456', 'screen_name': 'tweeter', 'name': 'A. User'},
+            'in_reply_to_status_id_str': in_reply_to,
+            'entities': {},
+        }
+
+    def test_batch_is_imported_with_a_fixed_number_of_queries(self):
+        batch = [
+            self.make_tweet_data(2, 'a reply', in_reply_to='1'),
+            self.make_tweet_data(3, 'a reply to the reply', in_reply_to='2'),
+            self.make_tweet_data(4, 'something about louisville'),
+            self.make_tweet_data(5, 'something else'),
+            self.make_tweet_data(1, 'my vision'),
+        ]
+
+        # Known tweets, visions, replies, tweeters, one insert each for the
+        # tweets and the replies, and then the tracked users
+        with self.assertNumQueries(8):
+            tweets = Tweet.objects.import_from_stream(batch, lambda text: 'louisville' in text)
+
+        assert_equal([tweet.tweet_id for tweet in tweets], ['2', '3', '4'])
+        assert_equal(Tweet.objects.get(tweet_id='3').in_reply_to_id, '2')
+
+        replies = Reply.objects.order_by('tweet')
+        assert_equal([reply.tweet_id for reply in replies], ['2', '3'])
+        assert_equal(set(reply.vision_id for reply in replies), set([self.vision.id]))
+        assert_equal(set(reply.author_id for reply in replies), set([self.user.id]))
+
+    def test_tweets_saved_elsewhere_in_the_mean_time_are_skipped(self):
+        def is_wanted(text):
+            # Someone else saves the tweet while we're looking at it
+            Tweet.objects.get_or_create(tweet_id='4', defaults={'tweet_data': self.make_tweet_data(4, text)})
+            return True
+
+        batch = [
+            self.make_tweet_data(2, 'a reply', in_reply_to='1'),
+            self.make_tweet_data(4, 'something about louisville'),
+        ]
+        tweets = Tweet.objects.import_from_stream(batch, is_wanted)
+
+        assert_equal([tweet.tweet_id for tweet in tweets], ['2'])
+        assert_equal(Reply.objects.get(tweet='2').vision_id, self.vision.id)
+
+
+class TrackedTwitterUserTest (TestCase):
+    def tearDown(self):
+        Tweet.objects.all().delete()
+        TrackedTwitterUser.objects.all().delete()
+
+    def test_tweeters_are_tracked_as_their_tweets_are_saved(self):
+        def tweet_data(tweet_id, user_id, screen_name):
+            return {'id': tweet_id, 'text': 'Hello', 'entities': {},
+                    'user': {'id': user_id, 'id_str': str(user_id), 'screen_name': screen_name}}
+
+        Tweet.objects.create_or_update_from_tweet_data(tweet_data(1, 7, 'seven'))
+        Tweet.objects.import_from_stream([tweet_data(2, 8, 'eight')], lambda text: True)
+        assert_equal([user.user_id for user in TrackedTwitterUser.objects.most_recently_seen(10)], ['8', '7'])
+
+        # Seeing a user again moves them to the front, with their new name
+        Tweet.objects.import_from_stream([tweet_data(3, 7, 'seventh')], lambda text: True)
+        users = list(TrackedTwitterUser.objects.most_recently_seen(10))
+        assert_equal([(user.user_id, user.screen_name) for user in users], [('7', 'seventh'), ('8', 'eight')])
+        assert_equal([user.user_id for user in TrackedTwitterUser.objects.most_recently_seen(1)], ['7'])
+
+
+class UserTwitterIdentityTest (TestCase):
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+
+    def test_twitter_identity_is_copied_from_social_auth(self):
+        user = User.objects.create(username='mjumbe')
+        UserSocialAuth.objects.create(user=user, uid='42', provider='twitter', extra_data=json.dumps({
+            'access_token': 'oauth_token_secret=abc&oauth_token=123', 'id': 42, 'screen_name': 'mjumbe'}))
+
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual(user.twitter_uid, '42')
+        self.assertEqual(user.twitter_screen_name, 'mjumbe')
+
+        UserSocialAuth.objects.filter(user=user).delete()
+        self.assertIsNone(User.objects.get(pk=user.pk).twitter_uid)
+
+    def test_screen_name_is_saved_at_sign_in(self):
+        from social_auth.backends.twitter import TwitterBackend
+        user = User.objects.create(username='mjumbe')
+
+        # What the load_extra_data step of the social auth pipeline saves
+        extra_data = TwitterBackend.extra_data(user, '42', {
+            'id': 42, 'screen_name': 'mjumbe',
+            'access_token': 'oauth_token_secret=abc&oauth_token=123'})
+        UserSocialAuth.objects.create(user=user, uid='42', provider='twitter', extra_data=extra_data)
+
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual((user.twitter_uid, user.twitter_screen_name), ('42', 'mjumbe'))
+
+    def test_importer_finds_users_by_twitter_id(self):
+        user = User.objects.create(username='mjumbe', twitter_uid='42', twitter_screen_name='mjumbe')
+
+        tweeter = Vision.get_or_create_tweeter({'id': 42, 'screen_name': 'mjumbe2', 'name': 'Mjumbe Poe'})
+        self.assertEqual(tweeter, user)
+        self.assertEqual(User.objects.get(pk=user.pk).twitter_screen_name, 'mjumbe2')
@@ -2,18 +2,27 @@ from django.test import TestCase, RequestFactory
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
-from ..services import TwitterService
+from ..services import TwitterService, SocialMediaException
 from ..models import Vision, User, Reply, Tweet
+from ..cache import cache_buffer
 from social_auth.models import UserSocialAuth
 from mock import patch, Mock
+from StringIO import StringIO
+from time import sleep
+from twitter import TwitterHTTPError
+from .utils import create_app_config
 from nose.tools import assert_equal
 import json
 
 
 class FollowedUserTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+
     def tearDown(self):
         User.objects.all().delete()
         cache.clear()
+        cache_buffer.clear()
 
     def test_gets_ids_of_followed_users(self):
         friends_twitter_response = {
@@ -39,7 +48,7 @@ class FollowedUserTest (TestCase):
             @property
             def friends(self):
                 class Stub (object):
-                    def ids(self, user_id):
+                    def ids(self, user_id, cursor, count):
                         return friends_twitter_response
                 return Stub()
 
@@ -50,6 +59,809 @@ class FollowedUserTest (TestCase):
 
             user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
             social_auth = UserSocialAuth.objects.create(user=user, uid=42, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": 42}')
+            for uid in (9926872, 1335646238):
+                friend = User.objects.create(username=str(uid))
+                UserSocialAuth.objects.create(user=friend, uid=uid, provider='twitter', extra_data='{}')
+
             user_ids = service.get_followed_users(user, user)
 
-            self.assertEqual(len(user_ids), 10)
+            # Only the followed users that use the site are kept
+            self.assertEqual(list(user_ids), [9926872, 1335646238])
+
+    def test_follows_cursors_to_the_last_page(self):
+        pages = {
+            -1: {'ids': [3, 1], 'next_cursor': 100},
+            100: {'ids': [2], 'next_cursor': 0},
+        }
+        api = Mock()
+        api.friends.ids.side_effect = lambda user_id, cursor, count: pages[cursor]
+
+        service = TwitterService()
+        user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
+        UserSocialAuth.objects.create(user=user, uid=42, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": 42}')
+
+        with patch.object(service, 'get_api', return_value=api):
+            self.assertEqual(service.fetch_followed_users(user), [1, 2, 3])
+
+    def test_packed_ids_are_the_same_on_every_machine(self):
+        service = TwitterService()
+        entry = service.pack_user_ids([2 ** 40, 7])
+
+        self.assertEqual(entry, 'q' + '\x07' + '\x00' * 7 + '\x00' * 5 + '\x01' + '\x00' * 2)
+        self.assertEqual(list(service.unpack_user_ids(entry)), [7, 2 ** 40])
+        self.assertEqual(list(service.unpack_user_ids(service.pack_user_ids([]))), [])
+
+
+class ConfigTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_uses_stale_config_while_another_process_fetches(self):
+        service = TwitterService()
+        cache.set('twitter-config:stale', {'short_url_length': 22})
+        cache.add('twitter-config:lock', True)
+
+        with patch('hatch.cache.single_flight.wait_timeout', 0.01):
+            with patch.object(service, 'get_api') as get_api:
+                config = service.get_config()
+                self.assertEqual(get_api.call_count, 0)
+
+        self.assertEqual(config, {'short_url_length': 22})
+
+
+class StaleUserInfoTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+        self.user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
+        UserSocialAuth.objects.create(user=self.user, uid=42, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": 42}')
+        self.service = TwitterService()
+        self.cache_key = self.service.get_user_cache_key(self.user, 'info')
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_fresh_info_is_used_without_refreshing(self):
+        cache.set(self.cache_key, self.service.pack_user_info({'name': 'Mjumbe'}))
+
+        with patch('hatch.tasks.refresh_users_info.delay') as delay:
+            info = self.service.get_user_info(self.user)
+            self.assertEqual(delay.call_count, 0)
+        self.assertEqual(info['name'], 'Mjumbe')
+
+    def test_stale_info_is_used_and_refreshed_in_the_background(self):
+        entry = {'info': {'name': 'Old Name'}, 'fresh_until': 0}
+        cache.set(self.cache_key, entry)
+
+        with patch('hatch.tasks.refresh_users_info.delay') as delay:
+            with patch.object(self.service, 'get_api') as get_api:
+                info = self.service.get_user_info(self.user)
+                self.assertEqual(get_api.call_count, 0)
+            delay.assert_called_once_with([self.user.pk])
+
+            # Only one refresh is scheduled at a time
+            self.service.get_users_info([self.user])
+            self.assertEqual(delay.call_count, 1)
+
+        self.assertEqual(info, {'name': 'Old Name'})
+
+    def test_stale_users_are_claimed_for_refresh_in_one_go(self):
+        from django.core import cache as django_cache
+        others = [User.objects.create(username='user%s' % n) for n in range(3)]
+        django_cache.cache.set(self.service.get_user_cache_key(others[0], 'info:refreshing'), True)
+
+        with patch('hatch.tasks.refresh_users_info.delay') as delay:
+            with patch.object(django_cache.cache, 'add') as add:
+                self.service.schedule_user_info_refresh([self.user] + others)
+                self.assertEqual(add.call_count, 0)
+            delay.assert_called_once_with(sorted([self.user.pk, others[1].pk, others[2].pk]))
+
+    def test_bare_info_entries_are_treated_as_stale(self):
+        cache.set(self.cache_key, {'name': 'Old Name', 'id_str': '42'})
+
+        with patch('hatch.tasks.refresh_users_info.delay') as delay:
+            self.service.get_users_info([self.user])
+            delay.assert_called_once_with([self.user.pk])
+
+
+class PackedUserInfoTest (TestCase):
+    full_info = {
+        'id': 42, 'id_str': '42', 'screen_name': 'mjumbe', 'name': u'Mj\xfcmbe',
+        'description': 'A stand-up guy', 'profile_image_url': 'http://example.com/a.png',
+        'status': {'text': 'Hello'}, 'profile_link_color': '0084B4',
+        'entities': {'url': {'urls': []}}, 'followers_count': 100,
+    }
+
+    def test_only_used_fields_are_kept(self):
+        service = TwitterService()
+        entry = service.pack_user_info(self.full_info)
+        info, is_fresh = service.unpack_user_info(entry)
+
+        self.assertTrue(is_fresh)
+        self.assertEqual(info, {
+            'id_str': '42', 'screen_name': 'mjumbe', 'name': u'Mj\xfcmbe',
+            'description': 'A stand-up guy', 'profile_image_url': 'http://example.com/a.png',
+        })
+
+    def test_empty_fields_are_kept_as_none(self):
+        service = TwitterService()
+        entry = service.pack_user_info({'id_str': '42', 'screen_name': 'mjumbe', 'name': None})
+        info, is_fresh = service.unpack_user_info(entry)
+
+        self.assertEqual(info, {
+            'id_str': '42', 'screen_name': 'mjumbe', 'name': None,
+            'description': None, 'profile_image_url': None,
+        })
+
+    def test_compressed_entries(self):
+        service = TwitterService()
+        with patch.object(settings, 'TWITTER_USER_INFO_COMPRESS', True, create=True):
+            entry = service.pack_user_info(self.full_info)
+
+        info, is_fresh = service.unpack_user_info(entry)
+        self.assertEqual(info['name'], u'Mj\xfcmbe')
+
+    def test_full_info_entries_can_still_be_read(self):
+        service = TwitterService()
+
+        info, is_fresh = service.unpack_user_info({'info': self.full_info, 'fresh_until': 0})
+        self.assertEqual(info, self.full_info)
+        self.assertFalse(is_fresh)
+
+        info, is_fresh = service.unpack_user_info(self.full_info)
+        self.assertEqual(info, self.full_info)
+        self.assertFalse(is_fresh)
+
+
+class NotFoundUserTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+        self.user = User.objects.create_user('mjumbe', 'mjumbe@example.com', 'password')
+        UserSocialAuth.objects.create(user=self.user, uid=42, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": 42}')
+        self.service = TwitterService()
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def make_not_found_error(self):
+        from twitter import TwitterHTTPError
+        error = TwitterHTTPError.__new__(TwitterHTTPError)
+        error.e = Mock(code=404)
+        return error
+
+    def test_missing_user_is_not_looked_up_again_during_backoff(self):
+        api = Mock()
+        api.users.show.side_effect = self.make_not_found_error()
+
+        with patch.object(self.service, 'get_api', return_value=api):
+            self.assertRaises(SocialMediaException, self.service.get_user_info, self.user)
+            self.assertRaises(SocialMediaException, self.service.get_user_info, self.user)
+            self.assertRaises(SocialMediaException, self.service.get_followed_users, self.user)
+            self.service.get_users_info([self.user])
+
+        self.assertEqual(api.users.show.call_count, 1)
+        self.assertEqual(api.friends.ids.call_count, 0)
+        self.assertEqual(api.users.lookup.call_count, 0)
+        self.assertTrue(User.objects.get(pk=self.user.pk).sm_not_found)
+
+    def test_backoff_grows_with_each_miss(self):
+        api = Mock()
+        api.users.lookup.return_value = []
+
+        with patch.object(self.service, 'get_api', return_value=api):
+            with patch('hatch.services.time') as time:
+                time.return_value = 0
+                self.service.get_users_info([self.user])
+
+                time.return_value = 60 * 60 + 1
+                self.service.get_users_info([self.user])
+                self.assertEqual(api.users.lookup.call_count, 2)
+
+                time.return_value = 2 * 60 * 60
+                self.service.get_users_info([self.user])
+                self.assertEqual(api.users.lookup.call_count, 2)
+
+        entry = cache_buffer.get(self.service.get_user_cache_key(self.user, 'not-found'))
+        self.assertEqual(entry['strikes'], 2)
+
+    def test_found_user_is_unflagged(self):
+        api = Mock()
+        api.users.lookup.return_value = [{'id': 42, 'id_str': '42', 'name': 'Mjumbe'}]
+        self.service.mark_users_not_found([self.user])
+        cache_buffer.delete(self.service.get_user_cache_key(self.user, 'not-found'))
+
+        with patch.object(self.service, 'get_api', return_value=api):
+            self.service.get_users_info([self.user])
+
+        self.assertFalse(User.objects.get(pk=self.user.pk).sm_not_found)
+
+
+class ParallelLookupTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+        self.users = []
+        for uid in range(1, 151):
+            user = User.objects.create(username='user%s' % uid)
+            UserSocialAuth.objects.create(user=user, uid=uid, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": %s}' % uid)
+            self.users.append(user)
+        self.service = TwitterService()
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_all_chunks_are_merged_and_missing_users_flagged(self):
+        # User 7 (in the first chunk) and user 149 (in the last) are missing
+        def lookup(user_id):
+            return [{'id': int(uid), 'id_str': uid, 'name': 'User ' + uid}
+                    for uid in user_id.split(',') if uid not in ('7', '149')]
+
+        api = Mock()
+        api.users.lookup.side_effect = lookup
+
+        with patch.object(self.service, 'get_api', return_value=api):
+            all_info = self.service.get_users_info(self.users)
+
+        self.assertEqual(api.users.lookup.call_count, 2)
+        self.assertEqual(len(all_info), 148)
+        self.assertEqual(
+            set(User.objects.filter(sm_not_found=True).values_list('username', flat=True)),
+            set(['user7', 'user149']))
+
+
+class RateLimitTest (TestCase):
+    def setUp(self):
+        from ..ratelimit import RateLimitScheduler
+        self.scheduler = RateLimitScheduler(max_wait=0)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_endpoints_are_grouped_by_family(self):
+        self.assertEqual(self.scheduler.get_endpoint('1.1/statuses/show/123'), 'statuses/show')
+        self.assertEqual(self.scheduler.get_endpoint('1.1/users/lookup'), 'users/lookup')
+
+    def test_calls_are_deferred_once_the_quota_is_used_up(self):
+        from ..ratelimit import RateLimitExceeded
+        from time import time
+
+        self.scheduler.update('users/lookup', 'app', {
+            'x-rate-limit-remaining': '1', 'x-rate-limit-reset': str(int(time()) + 600)})
+
+        self.scheduler.acquire('users/lookup', 'app')
+        self.assertRaises(RateLimitExceeded, self.scheduler.acquire, 'users/lookup', 'app')
+
+        # Other endpoints and identities have their own quotas
+        self.scheduler.acquire('users/show', 'app')
+        self.scheduler.acquire('users/lookup', 'someone-else')
+
+    def test_tokens_are_taken_with_an_atomic_decrement(self):
+        from ..ratelimit import RateLimitExceeded
+        from time import time
+
+        self.scheduler.update('users/lookup', 'app', {
+            'x-rate-limit-remaining': '1', 'x-rate-limit-reset': str(int(time()) + 600)})
+        remaining_key, _ = self.scheduler.get_bucket_keys('users/lookup', 'app')
+
+        # Another process takes the last token between our read and our take
+        real_decr = cache.decr
+        def decr(key, delta=1):
+            real_decr(key)
+            return real_decr(key, delta)
+
+        with patch.object(cache, 'decr', side_effect=decr):
+            self.assertRaises(RateLimitExceeded, self.scheduler.acquire, 'users/lookup', 'app')
+        self.assertEqual(cache.get(remaining_key), -1)
+
+    def test_patient_calls_wait_for_the_quota_to_reset(self):
+        from time import time
+
+        self.scheduler.update('users/lookup', 'app', {
+            'x-rate-limit-remaining': '5', 'x-rate-limit-reset': str(int(time()) + 600)}, status=429)
+
+        with patch('hatch.ratelimit.sleep') as sleep:
+            with self.scheduler.patience(15 * 60):
+                sleep.side_effect = lambda seconds: cache.delete_many(
+                    self.scheduler.get_bucket_keys('users/lookup', 'app'))
+                self.scheduler.acquire('users/lookup', 'app')
+            self.assertEqual(sleep.call_count, 1)
+
+
+class CredentialPoolTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+        create_app_config()
+        for uid, lends in ((1, True), (2, False)):
+            user = User.objects.create(username='user%s' % uid)
+            UserSocialAuth.objects.create(user=user, uid=uid, provider='twitter', extra_data=json.dumps({
+                'access_token': 'oauth_token_secret=secret%s&oauth_token=token%s' % (uid, uid),
+                'id': uid, 'lend_rate_limits': lends}))
+        self.service = TwitterService()
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_pool_has_the_app_and_consenting_users(self):
+        pool = self.service.get_credential_pool()
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool[1].token, 'token1')
+
+    def test_pool_is_capped_at_its_max_size(self):
+        user = User.objects.create(username='user3')
+        UserSocialAuth.objects.create(user=user, uid=3, provider='twitter', extra_data=json.dumps({
+            'access_token': 'oauth_token_secret=secret3&oauth_token=token3',
+            'id': 3, 'lend_rate_limits': True}))
+
+        with patch.object(settings, 'TWITTER_CREDENTIAL_POOL_MAX_SIZE', 2):
+            pool = self.service.get_credential_pool()
+        self.assertEqual([oauth.token for oauth in pool[1:]], ['token1'])
+        self.assertEqual(len(pool), 2)
+
+    def test_exhausted_credentials_are_not_chosen(self):
+        from ..ratelimit import rate_limits
+        from time import time
+
+        app_identity = rate_limits.get_identity(self.service.get_credential_pool()[0])
+        rate_limits.update('users/lookup', app_identity, {
+            'x-rate-limit-remaining': '0', 'x-rate-limit-reset': str(int(time()) + 600)})
+
+        for _ in range(10):
+            oauth = self.service.get_pooled_oauth('users/lookup')
+            self.assertEqual(oauth.token, 'token1')
+
+
+class FakeTwitterTest (TestCase):
+    def setUp(self):
+        from ..faketwitter import FakeTwitterAPI
+        cache_buffer.clear()
+        create_app_config()
+        self.fake = FakeTwitterAPI(rate_limit=2, missing_user_ids=[2], seed=1)
+        self.service = TwitterService(connection_pool=self.fake)
+
+        self.users = []
+        for uid in (1, 2):
+            user = User.objects.create(username='user%s' % uid)
+            UserSocialAuth.objects.create(user=user, uid=uid, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=%s-123", "id": %s}' % (uid, uid))
+            self.users.append(user)
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_user_lookups(self):
+        all_info = self.service.get_users_info(self.users)
+        self.assertEqual([info['screen_name'] for info in all_info], ['user1'])
+        self.assertTrue(User.objects.get(username='user2').sm_not_found)
+
+        # Info comes back the same whether it was just fetched or cached
+        self.assertEqual(set(all_info[0].keys()), set(TwitterService.USER_INFO_FIELDS))
+        self.assertEqual(self.service.get_users_info(self.users), all_info)
+
+    def test_tweeting_and_retweeting(self):
+        success, tweet = self.service.tweet('Hello', on_behalf_of=self.users[0])
+        self.assertTrue(success)
+        self.assertEqual(tweet['user']['id_str'], '1')
+
+        success, retweet = self.service.retweet(tweet['id'], on_behalf_of=self.users[0])
+        self.assertTrue(success)
+        self.assertEqual(retweet['retweeted_status']['id'], tweet['id'])
+
+    def test_rate_limited_calls_are_deferred(self):
+        from ..ratelimit import RateLimitExceeded
+        api = self.service.get_api(self.users[0])
+        api.help.configuration()
+        api.help.configuration()
+        self.assertRaises(RateLimitExceeded, api.help.configuration)
+        self.assertEqual(self.fake.calls['help/configuration'], 2)
+
+    def test_only_the_latest_tweets_are_kept(self):
+        from ..faketwitter import FakeTwitterAPI
+        fake = FakeTwitterAPI(max_tweets=3)
+        tweets = list(tweet for tweet in fake.generate_stream(follow='1,2', rate=1000, count=5)
+                      if tweet is not None)
+
+        self.assertEqual(fake.tweets.keys(), [tweet['id'] for tweet in tweets[2:]])
+
+        status, timeline = fake.handle_statuses_user_timeline(user_id=tweets[-1]['user']['id_str'])
+        self.assertEqual(timeline, [tweet for tweet in reversed(tweets[2:])
+                                    if tweet['user'] == tweets[-1]['user']])
+
+    def test_scripted_stream(self):
+        self.fake.stream_script = lambda track: [None, {'text': track}]
+        self.assertEqual(list(self.service.itertweets(track='hello')), [None, {'text': 'hello'}])
+
+
+class CircuitBreakerTest (TestCase):
+    def setUp(self):
+        from ..faketwitter import FakeTwitterAPI
+        from ..circuit import twitter_circuit
+        cache_buffer.clear()
+        create_app_config()
+        twitter_circuit.reset()
+        self.fake = FakeTwitterAPI(seed=1)
+        self.service = TwitterService(connection_pool=self.fake)
+
+        self.user = User.objects.create(username='user1')
+        UserSocialAuth.objects.create(user=self.user, uid=1, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=1-123", "id": 1}')
+
+    def tearDown(self):
+        from ..circuit import twitter_circuit
+        twitter_circuit.reset()
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_breaker_opens_after_repeated_failures(self):
+        from ..circuit import TwitterUnavailable
+        self.fake.error_rate = 1
+        api = self.service.get_api()
+
+        for _ in range(settings.TWITTER_CIRCUIT_BREAKER_THRESHOLD):
+            self.assertRaises(TwitterHTTPError, api.help.configuration)
+        self.assertEqual(self.fake.calls['help/configuration'], settings.TWITTER_CIRCUIT_BREAKER_THRESHOLD)
+
+        # Twitter is left alone until the breaker resets
+        self.assertRaises(TwitterUnavailable, api.help.configuration)
+        self.assertEqual(self.fake.calls['help/configuration'], settings.TWITTER_CIRCUIT_BREAKER_THRESHOLD)
+
+    def test_breaker_lets_a_call_through_after_the_reset_timeout(self):
+        from ..circuit import CircuitBreaker, TwitterUnavailable
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        breaker.record_failure('help/configuration', 'HTTP 503')
+        breaker.record_failure('help/configuration', 'HTTP 503')
+        self.assertRaises(TwitterUnavailable, breaker.before_call, 'help/configuration')
+
+        sleep(0.06)
+        breaker.before_call('help/configuration')
+        self.assertRaises(TwitterUnavailable, breaker.before_call, 'help/configuration')
+
+        breaker.record_success()
+        breaker.before_call('help/configuration')
+
+    def test_timeouts_cut_short_by_the_time_budget_leave_the_breaker_closed(self):
+        import socket
+        from ..circuit import twitter_circuit, TwitterUnavailable
+        from ..transport import PooledTwitter
+
+        class SlowPool (object):
+            read_timeout = 30
+
+            def __init__(self):
+                self.read_timeouts = []
+
+            def request(self, method, url, body, headers, read_timeout=None):
+                self.read_timeouts.append(read_timeout)
+                raise socket.timeout('timed out')
+
+        slow_pool = SlowPool()
+        api = PooledTwitter(connection_pool=slow_pool)
+
+        for _ in range(settings.TWITTER_CIRCUIT_BREAKER_THRESHOLD):
+            with twitter_circuit.time_budget(1):
+                self.assertRaises(TwitterUnavailable, api.help.configuration)
+        self.assertTrue(all(timeout <= 1 for timeout in slow_pool.read_timeouts))
+        self.assertEqual(twitter_circuit.failures, 0)
+        self.assertEqual(twitter_circuit.state, twitter_circuit.CLOSED)
+
+        # Timeouts that hit the configured read timeout do count
+        self.assertRaises(TwitterUnavailable, api.help.configuration)
+        self.assertEqual(twitter_circuit.failures, 1)
+
+    def test_pages_make_do_when_the_time_budget_is_spent(self):
+        from ..circuit import twitter_circuit
+        from ..serializers import UserSerializer
+
+        with twitter_circuit.time_budget(0):
+            self.assertEqual(self.service.get_config(), TwitterService.DEFAULT_CONFIG)
+
+            serializer = UserSerializer([self.user], many=True)
+            serializer.context = {'twitter_service': self.service, 'requesting_user': None}
+            data = serializer.data
+
+        self.assertIsNone(data[0]['avatar_url'])
+        self.assertEqual(sum(self.fake.calls.values()), 0)
+
+        # The user wasn't marked as missing from Twitter
+        self.assertFalse(User.objects.get(pk=self.user.pk).sm_not_found)
+
+
+class StreamReaderTest (TestCase):
+    def setUp(self):
+        from threading import Event
+        from ..streaming import ListenerControl
+        self.control = ListenerControl(poll_interval=0.01)
+        self.released = Event()
+
+    def tearDown(self):
+        self.released.set()
+        cache.clear()
+
+    def test_reading_stops_when_the_stream_hangs_up(self):
+        from ..streaming import read_batches
+        stream = [None, {'text': 'a'}, None, {'hangup': True}, {'text': 'b'}]
+        self.assertEqual(list(read_batches(stream, 10, 1, self.control)), [[{'text': 'a'}]])
+
+    def make_keep_alive_stream(self, stall_timeout):
+        import socket
+        from ..streaming import KeepAliveJSONIter
+        ours, theirs = socket.socketpair()
+        handle = Mock(headers={})
+        handle.fp._sock.fp._sock = ours
+        handle.close.side_effect = ours.close
+        return KeepAliveJSONIter(handle, stall_timeout, poll_interval=0.01), theirs
+
+    def send_chunk(self, sock, data):
+        sock.sendall('%x\r\n%s\r\n' % (len(data), data))
+
+    def test_keep_alives_keep_a_quiet_stream_from_stalling(self):
+        stream, twitter = self.make_keep_alive_stream(stall_timeout=0.2)
+        messages = iter(stream)
+
+        def send():
+            for _ in range(5):
+                sleep(0.1)
+                self.send_chunk(twitter, '\r\n')
+            self.send_chunk(twitter, '{"text": "a"}\r\n')
+
+        from threading import Thread
+        sender = Thread(target=send)
+        sender.start()
+
+        # Half a second of keep-alives, with no messages, isn't a stall...
+        self.assertEqual(next(messages), {'text': 'a'})
+        sender.join()
+
+        # ...but silence is
+        self.assertEqual(next(messages), {'timeout': True})
+        self.assertEqual(list(messages), [])
+        self.assertEqual(stream.handle.close.call_count, 1)
+
+    def test_stopping_the_reader_closes_the_stream(self):
+        from Queue import Queue
+        from ..streaming import StreamReader
+        stream, twitter = self.make_keep_alive_stream(stall_timeout=5)
+
+        reader = StreamReader(stream, Queue())
+        reader.start()
+        reader.stop()
+        reader.join(1)
+
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(stream.handle.close.call_count, 1)
+
+    def test_stream_errors_are_raised_in_the_listener(self):
+        from ..streaming import read_batches
+
+        def stream():
+            yield {'text': 'a'}
+            raise IOError('Connection reset')
+
+        batches = read_batches(stream(), 1, None, self.control)
+        self.assertEqual(next(batches), [{'text': 'a'}])
+        self.assertRaises(IOError, list, batches)
+
+    def test_commands_are_handed_to_the_reader_between_batches(self):
+        from ..streaming import read_batches
+
+        def stream():
+            self.released.wait(5)
+            yield {'text': 'a'}
+
+        commands = []
+        batches = read_batches(stream(), 10, 1, self.control,
+                               on_command=commands.append, idle_interval=0.05)
+
+        # Idle batches come in while we wait
+        self.assertEqual(next(batches), [])
+        self.control.publish('follow:7:100')
+        while not commands:
+            self.assertEqual(next(batches), [])
+        self.assertEqual(commands, ['follow:7:100'])
+
+        self.released.set()
+        self.assertEqual([batch for batch in batches if batch], [[{'text': 'a'}]])
+
+
+class StreamFilterTest (TestCase):
+    def setUp(self):
+        from ..faketwitter import FakeTwitterAPI
+        self.fake = FakeTwitterAPI(seed=1)
+        self.service = TwitterService(connection_pool=self.fake)
+        create_app_config()
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Tweet.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def test_reconnects_wait_for_the_reconnect_interval(self):
+        from ..streaming import StreamFilter
+        stream_filter = StreamFilter(['louisville'], [1, 2], reconnect_interval=0.05)
+        self.assertEqual(stream_filter.get_stream_params(), {'track': 'louisville', 'follow': '1,2'})
+
+        self.assertEqual(stream_filter.add_users(['2', '3']), set(['3']))
+        self.assertEqual(stream_filter.add_users(['3']), set())
+        self.assertTrue(stream_filter.is_stale())
+        self.assertFalse(stream_filter.should_reconnect())
+
+        sleep(0.06)
+        self.assertTrue(stream_filter.should_reconnect())
+
+    def test_keyword_changes_are_noticed(self):
+        from ..streaming import StreamFilter
+        stream_filter = StreamFilter(['louisville'], [])
+        stream_filter.change_track(['louisville'])
+        self.assertFalse(stream_filter.is_stale())
+        stream_filter.change_track(['louisville', 'vision'])
+        self.assertTrue(stream_filter.is_stale())
+
+    def test_catching_up_on_users_who_are_not_followed_yet(self):
+        from .. import tasks
+        first = self.fake.make_tweet('My first tweet about louisville', 7)
+        self.fake.make_tweet('Something about louisville', 7)
+        latest = self.fake.make_tweet('Something else', 7)
+        self.fake.make_tweet('Someone else on louisville', 8)
+
+        since_ids = {'7': first['id_str']}
+        with patch.object(tasks, 'twitter_service', self.service):
+            tasks.catch_up_on_users(since_ids, lambda text: 'louisville' in text)
+
+        self.assertEqual([tweet.tweet_data['text'] for tweet in Tweet.objects.all()],
+                         ['Something about louisville'])
+        self.assertEqual(since_ids, {'7': latest['id_str']})
+
+
+class KeywordMatcherTest (TestCase):
+    def get_matcher_classes(self):
+        from ..keywords import KeywordMatcher
+
+        # Short lists of words are scanned for one by one; make sure that the
+        # automaton used for longer lists agrees.
+        class AutomatonMatcher (KeywordMatcher):
+            scan_threshold = 0
+
+        return [KeywordMatcher, AutomatonMatcher]
+
+    def test_all_words_of_any_term_must_match(self):
+        for KeywordMatcher in self.get_matcher_classes():
+            matcher = KeywordMatcher(['Louisville vision', 'newark', ''])
+
+            self.assertTrue(matcher.matches(u'My VISION for #Louisville'))
+            self.assertTrue(matcher.matches(u'Downtown Newark at night'))
+            self.assertFalse(matcher.matches(u'Louisville at night'))
+            self.assertFalse(matcher.matches(u'Visions of the future'))
+
+    def test_words_match_inside_other_words(self):
+        for KeywordMatcher in self.get_matcher_classes():
+            matcher = KeywordMatcher(['new newark', 'she hers'])
+
+            self.assertTrue(matcher.matches(u'#visionnewark'))
+            self.assertTrue(matcher.matches(u'ushers'))
+            self.assertFalse(matcher.matches(u'usher'))
+
+    def test_matchers_are_built_once_per_keywords_value(self):
+        from ..keywords import get_keyword_matcher
+        matcher = get_keyword_matcher(u'louisville\nvision')
+        self.assertIs(get_keyword_matcher(u'louisville\nvision'), matcher)
+        self.assertIsNot(get_keyword_matcher(u'louisville'), matcher)
+        self.assertFalse(get_keyword_matcher(u'\n'))
+
+
+class WarmCacheCommandTest (TestCase):
+    def setUp(self):
+        cache_buffer.clear()
+        create_app_config()
+        self.users = []
+        for uid in (1, 2, 3):
+            user = User.objects.create_user('user%s' % uid, 'user%s@example.com' % uid, 'password')
+            UserSocialAuth.objects.create(user=user, uid=uid, provider='twitter', extra_data='{"access_token": "oauth_token_secret=abc&oauth_token=123", "id": %s}' % uid)
+            self.users.append(user)
+
+    def tearDown(self):
+        User.objects.all().delete()
+        cache.clear()
+        cache_buffer.clear()
+
+    def warm_cache(self, **options):
+        from ..management.commands.warmcache import Command
+        from ..services import default_twitter_service
+
+        api = Mock()
+        api.users.lookup.side_effect = lambda user_id: [
+            {'id': int(uid), 'id_str': uid, 'screen_name': 'user' + uid} for uid in user_id.split(',')]
+        api.help.configuration.return_value = {'short_url_length': 22}
+
+        command = Command()
+        command.stdout = StringIO()
+        with patch.object(default_twitter_service, 'get_api', return_value=api):
+            command.execute(batch_size=2, **options)
+        return api, command.stdout.getvalue()
+
+    def test_fills_the_cache(self):
+        api, output = self.warm_cache(restart=False)
+
+        self.assertEqual(api.users.lookup.call_count, 2)
+        self.assertIn('Cached info for 3/3 user(s)', output)
+        self.assertIsNotNone(cache.get(settings.CATEGORIES_JSON_CACHE_KEY))
+        self.assertIsNotNone(cache.get('twitter-config'))
+        for user in self.users:
+            self.assertIsNotNone(cache.get(TwitterService().get_user_cache_key(user, 'info')))
+
+    def test_resumes_after_the_last_user_cached(self):
+        cache.set('warmcache:last-user-pk', self.users[1].pk)
+
+        api, output = self.warm_cache(restart=False)
+        self.assertEqual(api.users.lookup.call_count, 1)
+        api.users.lookup.assert_called_once_with(user_id='3')
+        self.assertIsNone(cache.get('warmcache:last-user-pk'))
+
+
+class PooledTransportTest (TestCase):
+    def setUp(self):
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from threading import Thread
+
+        connections = self.connections = []
+
+        class Handler (BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                status = 404 if 'missing' in self.path else 200
+                body = json.dumps({'path': self.path.split('?')[0]})
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Rate-Limit-Remaining', '179')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        from ..transport import pool
+        pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_api(self):
+        from ..transport import PooledTwitter
+        return PooledTwitter(domain='127.0.0.1:%s' % self.server.server_port, secure=False)
+
+    def test_connections_are_reused_across_api_objects(self):
+        response = self.get_api().users.show(user_id=42)
+        self.assertEqual(response, {'path': '/1.1/users/show.json'})
+        self.assertEqual(response.rate_limit_remaining, 179)
+
+        self.get_api().help.configuration()
+        self.assertEqual(len(self.connections), 1)
+
+    def test_http_errors_are_raised_as_twitter_errors(self):
+        from twitter import TwitterHTTPError
+        try:
+            self.get_api().users.missing()
+        except TwitterHTTPError as e:
+            self.assertEqual(e.e.code, 404)
+        else:
+            self.fail('Expected a TwitterHTTPError')
@@ -0,0 +1,229 @@
+"""
+A keep-alive HTTP transport for the Twitter API.
+
+The twitter library opens a new connection (and does a new TLS handshake) for
+every call it makes. ``PooledTwitter`` makes the same calls over connections
+that are kept open and shared by every API object in the process.
+"""
+
+from django.conf import settings
+from collections import defaultdict
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from StringIO import StringIO
+from threading import BoundedSemaphore, Lock
+from time import time
+from twitter import Twitter, TwitterHTTPError
+from twitter.api import TwitterCall, wrap_response
+from urllib2 import HTTPError
+from urlparse import urlsplit, urlunsplit
+from .circuit import twitter_circuit, TwitterUnavailable
+from .ratelimit import rate_limits, RateLimitExceeded
+import gzip
+import json
+import os
+import socket
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class ConnectionPool (object):
+    """
+    Keeps idle HTTP(S) connections around so that they can be reused, with at
+    most ``max_per_host`` connections open to any one host at a time.
+    """
+    def __init__(self, max_per_host=None, connect_timeout=None,
+                 read_timeout=None, idle_timeout=None):
+        self.max_per_host = max_per_host or settings.TWITTER_HTTP_MAX_CONNECTIONS_PER_HOST
+        self.connect_timeout = connect_timeout or settings.TWITTER_HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.TWITTER_HTTP_READ_TIMEOUT
+        self.idle_timeout = idle_timeout or settings.TWITTER_HTTP_IDLE_TIMEOUT
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pid = os.getpid()
+            self.idle = defaultdict(list)
+            self.slots = {}
+
+    def check_pid(self):
+        # Connections must not be shared with a parent process (e.g., when a
+        # server forks its workers after loading the app).
+        if self.pid != os.getpid():
+            self.reset()
+
+    def get_slots(self, host_key):
+        with self.lock:
+            if host_key not in self.slots:
+                self.slots[host_key] = BoundedSemaphore(self.max_per_host)
+            return self.slots[host_key]
+
+    def checkout(self, host_key):
+        """
+        Get an idle connection to the host, or a new one if there are none
+        that are still fresh. Returns the connection and whether it was reused.
+        """
+        now = time()
+        with self.lock:
+            idle = self.idle[host_key]
+            while idle:
+                conn, idle_since = idle.pop()
+                if now - idle_since < self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        scheme, host = host_key
+        conn_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return conn_class(host, timeout=self.connect_timeout), False
+
+    def checkin(self, host_key, conn):
+        with self.lock:
+            self.idle[host_key].append((conn, time()))
+
+    def request(self, method, url, body=None, headers={}, read_timeout=None):
+        """
+        Make a request and read the whole response. Returns the status, the
+        reason, the response headers, and the response body.
+        """
+        self.check_pid()
+
+        scheme, host, path, query, _ = urlsplit(url)
+        host_key = (scheme, host)
+        path = urlunsplit(('', '', path or '/', query, ''))
+
+        slots = self.get_slots(host_key)
+        with slots:
+            while True:
+                conn, reused = self.checkout(host_key)
+                try:
+                    if conn.sock is None:
+                        # Don't spend longer connecting than the caller
+                        # will wait for the whole response.
+                        if read_timeout:
+                            conn.timeout = min(self.connect_timeout, read_timeout)
+                        conn.connect()
+                    conn.sock.settimeout(read_timeout or self.read_timeout)
+
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+
+                except (HTTPException, socket.error) as e:
+                    conn.close()
+
+                    # The server may have closed a connection that was
+                    # sitting idle; try again on a new one.
+                    if reused and not isinstance(e, socket.timeout):
+                        log.debug('Reused connection to %s failed (%s); '
+                                  'reconnecting' % (host, e))
+                        continue
+                    raise
+
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.checkin(host_key, conn)
+
+                return response.status, response.reason, response.msg, data
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+pool = ConnectionPool()
+
+
+class PooledTwitterCall (TwitterCall):
+    # Calls use the process-wide pool unless they're given another one
+    connection_pool = None
+
+    def _handle_response(self, req, uri, arg_data, _timeout=None):
+        connection_pool = self.connection_pool or pool
+
+        headers = dict(req.header_items())
+        if req.has_data() and not any(h.lower() == 'content-type' for h in headers):
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        endpoint = rate_limits.get_endpoint(uri)
+        identity = rate_limits.get_identity(self.auth)
+
+        def request():
+            rate_limits.acquire(endpoint, identity)
+
+            # Don't let the call run past the thread's deadline, if it has one
+            read_timeout = _timeout
+            configured_timeout = _timeout or getattr(connection_pool, 'read_timeout', None)
+            time_left = twitter_circuit.before_call(endpoint)
+            cut_short = (time_left is not None and
+                         (configured_timeout is None or time_left < configured_timeout))
+            if cut_short:
+                read_timeout = time_left
+
+            try:
+                response = connection_pool.request(
+                    req.get_method(), req.get_full_url(), req.get_data(), headers,
+                    read_timeout=read_timeout)
+            except (HTTPException, socket.error) as e:
+                # A call that timed out because the caller ran out of time
+                # says nothing about Twitter, so it doesn't count against the
+                # breaker.
+                if cut_short and isinstance(e, socket.timeout):
+                    raise TwitterUnavailable(endpoint, 'out of time waiting for Twitter')
+                twitter_circuit.record_failure(endpoint, e)
+                raise TwitterUnavailable(endpoint, 'no response from Twitter (%s)' % (e,))
+
+            status, _, response_headers, _ = response
+            if status >= 500:
+                twitter_circuit.record_failure(endpoint, 'HTTP %s' % (status,))
+            else:
+                twitter_circuit.record_success()
+
+            rate_limits.update(endpoint, identity, response_headers, status)
+            return response
+
+        status, reason, response_headers, data = request()
+
+        # Someone else may have used up the quota since we last heard about
+        # it. If we're willing to wait for it to reset, try once more.
+        if status == 429:
+            try:
+                status, reason, response_headers, data = request()
+            except RateLimitExceeded:
+                pass
+
+        if status >= 400:
+            e = HTTPError(req.get_full_url(), status, reason,
+                          response_headers, StringIO(data))
+            raise TwitterHTTPError(e, uri, self.format, arg_data)
+        elif status == 304:
+            return []
+
+        if response_headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+
+        if self.format == 'json':
+            return wrap_response(json.loads(data.decode('utf8')), response_headers)
+        else:
+            return wrap_response(data.decode('utf8'), response_headers)
+
+
+class PooledTwitter (PooledTwitterCall, Twitter):
+    """
+    A drop-in replacement for ``twitter.Twitter`` that makes its calls over
+    the shared connection pool, or over the given connection_pool (anything
+    with the same request method as ConnectionPool).
+    """
+    def __init__(self, connection_pool=None, **kwargs):
+        Twitter.__init__(self, **kwargs)
+        self.connection_pool = connection_pool
+
+        def make_call(**call_kwargs):
+            call = PooledTwitterCall(**call_kwargs)
+            call.connection_pool = connection_pool
+            return call
+        self.callable_cls = make_call
@@ -1,4 +1,5 @@
 from django.conf import settings
+from bisect import bisect_left
 from itertools import combinations, islice
 from random import randint
 
@@ -24,5 +25,23 @@ def chunk(iterable, n):
         else: break
 
 
+def intersect_sorted(a, b):
+    """Return the items that are in both sorted sequences, in order"""
+    if len(a) > len(b):
+        a, b = b, a
+
+    # Look up each item of the shorter sequence in the longer one, starting
+    # each search where the last one left off.
+    result = []
+    lo = 0
+    for item in a:
+        lo = bisect_left(b, item, lo)
+        if lo == len(b):
+            break
+        if b[lo] == item:
+            result.append(item)
+    return result
+
+
 def settings_context(request):
     return {'settings': settings}
\ No newline at end of file
@@ -9,33 +9,38 @@ from django.views.generic.detail import SingleObjectMixin
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.utils.decorators import method_decorator
 from django.utils.text import Truncator
-from django.db.models import Count
 from django.http import Http404
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.routers import DefaultRouter
-from rest_framework.viewsets import ViewSet, ModelViewSet
+from rest_framework.viewsets import ViewSet, ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.generics import RetrieveAPIView, GenericAPIView
 from rest_framework.mixins import ListModelMixin
 from rest_framework.exceptions import APIException
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.utils.encoders import JSONEncoder
 from .cache import cache_buffer
-from .models import Reply, User, Vision, Category, Tweet, AppConfig
+from .circuit import twitter_circuit
+from .models import Reply, User, Vision, Category, AppConfig, OutgoingTweet
 from .forms import SecretAllySignupForm
 from .serializers import (
     ReplySerializer, UserSerializer, VisionSerializer, CategorySerializer,
-    MinimalVisionSerializer, AppConfigSerializer, RecentEngagementSerializer)
-from .services import default_twitter_service
+    MinimalVisionSerializer, AppConfigSerializer, RecentEngagementSerializer,
+    OutgoingTweetSerializer)
+from .services import default_twitter_service, SocialMediaException
+from .tasks import send_outgoing_tweet
+
+from logging import getLogger
+log = getLogger(__name__)
 
 
 class AppMixin (object):
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
     def dispatch(self, *args, **kwargs):
-        result = super(AppMixin, self).dispatch(*args, **kwargs)
-        cache_buffer.flush()
-        return result
+        # Don't keep the client waiting on Twitter for too long
+        with twitter_circuit.time_budget(settings.TWITTER_REQUEST_TIME_BUDGET):
+            return super(AppMixin, self).dispatch(*args, **kwargs)
 
     @classmethod
     def get_twitter_service(self):
@@ -53,6 +58,36 @@ class AppMixin (object):
         context['requesting_user'] = self.get_requesting_user()
         return context
 
+    def send_tweet(self, outgoing_tweet, error_prefix):
+        """
+        Hand an outgoing tweet off to a worker, or send it right away if
+        tweets are not sent asynchronously. Raises a TweetException if a
+        tweet sent right away fails.
+        """
+        self.outgoing_tweets = getattr(self, 'outgoing_tweets', []) + [outgoing_tweet]
+
+        if settings.OUTGOING_TWEETS_ASYNC:
+            try:
+                send_outgoing_tweet.delay(outgoing_tweet.pk)
+            except Exception:
+                # The tweet is safe in the outbox; the sendtweets command
+                # will pick it up.
+                log.exception('Could not queue %s' % (outgoing_tweet,))
+
+        elif not outgoing_tweet.send(self.get_twitter_service()):
+            raise TweetException(error_prefix + outgoing_tweet.error)
+
+    def add_outgoing_tweets(self, response):
+        """
+        Let the client know which tweets are still on their way, so that it
+        can check on them at /api/outbox/<id>.
+        """
+        pending = [outgoing_tweet for outgoing_tweet in getattr(self, 'outgoing_tweets', [])
+                   if outgoing_tweet.status == OutgoingTweet.PENDING]
+        if pending and response.status_code < 400:
+            response.data['outgoing_tweets'] = OutgoingTweetSerializer(pending, many=True).data
+        return response
+
     @classmethod
     def get_vision_url(cls, request, vision):
         return request.build_absolute_uri(
@@ -62,46 +97,65 @@ class AppMixin (object):
     def get_vision_queryset(self, base_queryset=None):
         return (base_queryset or Vision.objects.all())\
             .select_related('author')\
-            .prefetch_related('author__social_auth')\
             .prefetch_related('author__groups')\
             .prefetch_related('replies')\
-            .prefetch_related('replies__author__social_auth')\
             .prefetch_related('replies__author__groups')\
             .prefetch_related('supporters')\
-            .prefetch_related('supporters__social_auth')\
             .prefetch_related('supporters__groups')\
             .prefetch_related('sharers')
 
     def get_user_queryset(self, base_queryset=None):
         qs = (base_queryset or User.objects.all())\
-            .annotate(social_count=Count('social_auth'))\
-            .filter(social_count__gt=0)\
+            .filter(twitter_uid__isnull=False)\
             .prefetch_related('visions')\
             .prefetch_related('visions__supporters')\
             .prefetch_related('visions__replies')\
             .prefetch_related('replies')\
-            .prefetch_related('replies__vision__author__social_auth')\
+            .prefetch_related('replies__vision__author')\
             .prefetch_related('replies__vision__supporters')\
             .prefetch_related('supported')\
-            .prefetch_related('supported__author__social_auth')\
+            .prefetch_related('supported__author')\
             .prefetch_related('supported__supporters')\
-            .prefetch_related('social_auth')\
             .prefetch_related('groups')
 
+        # Put the users that the requesting user follows first
         user = self.request.user
         if user.is_authenticated():
-            followed_ids = self.get_twitter_service().get_followed_users(user, on_behalf_of=user)
-            qs = qs.extra(
-                tables=['social_auth_usersocialauth'],
-                where=['hatch_user.id=social_auth_usersocialauth.user_id'],
-                select={'is_followed': 'social_auth_usersocialauth.uid IN (%s)' % ','.join(["'%s'" % uid for uid in (followed_ids or [000000])])})\
-                .order_by('-is_followed')
+            try:
+                followed_pks = self.get_twitter_service().get_followed_site_users(user, on_behalf_of=user)
+            except SocialMediaException as e:
+                log.warning('Could not get the users that %s follows: %s' % (user, e))
+                followed_pks = []
+
+            if followed_pks:
+                qs = qs.extra(
+                    select={'is_followed': 'hatch_user.id IN (%s)' % ','.join(['%s'] * len(followed_pks))},
+                    select_params=followed_pks)\
+                    .order_by('-is_followed')
 
         return qs
 
     def get_category_queryset(self, base_queryset=None):
         return (base_queryset or Category.objects.all())
 
+    @classmethod
+    def get_categories_json(cls):
+        categories_json = cache_buffer.get(settings.CATEGORIES_JSON_CACHE_KEY)
+        if categories_json is None:
+            category_query = Category.objects.all()
+            categories_json = json.dumps(CategorySerializer(category_query).data)
+            cache_buffer.set(settings.CATEGORIES_JSON_CACHE_KEY, categories_json,
+                             settings.CATEGORIES_JSON_CACHE_TIMEOUT)
+        return categories_json
+
+    @classmethod
+    def get_app_config_json(cls, app_config):
+        app_config_json = cache_buffer.get(settings.APP_CONFIG_JSON_CACHE_KEY)
+        if app_config_json is None:
+            app_config_json = json.dumps(AppConfigSerializer(app_config).data)
+            cache_buffer.set(settings.APP_CONFIG_JSON_CACHE_KEY, app_config_json)
+        return app_config_json
+
     def get_recent_engagements(self):
         user = self.request.user
         if user.is_authenticated():
@@ -136,20 +190,17 @@ class AppMixin (object):
         context['NS'] = 'Hatch'
         context['twitter_config'] = json.dumps(service.get_config(user))
 
-        category_query = self.get_category_queryset()
-        context['categories'] = json.dumps(CategorySerializer(category_query).data)
-
-        app_config_query = AppConfig.objects.all()[:1]
+        context['categories'] = self.get_categories_json()
 
         try:
-            app_config = app_config_query[0]
+            app_config = AppConfig.get(cache=cache_buffer)
         except IndexError:
             raise Exception('This app has not been configured. Please add a ' \
                 'record to the AppConfig model to set your app-specific ' \
                 'settings.')
 
         context['app'] = app_config
-        context['app_json'] = json.dumps(AppConfigSerializer(app_config).data)
+        context['app_json'] = self.get_app_config_json(app_config)
 
         if user:
             # Bootstrap user information
@@ -273,19 +324,6 @@ class VisionViewSet (AppMixin, ModelViewSet):
             ' ', vision_url
         ])
 
-    @classmethod
-    def tweet_vision_from_app(cls, request, vision):
-        tweet_text = cls.get_app_tweet_text(request, vision)
-        service = cls.get_twitter_service()
-        success, response = service.tweet(tweet_text)
-
-        if success:
-            tweet, created = Tweet.objects.create_or_update_from_tweet_data(response)
-            vision.app_tweet = tweet
-            vision.save()
-        else:
-            raise TweetException('App tweet not sent: ' + response)
-
     def post_save(self, vision, created):
         """
         This is called in the create handler, after the serializer saves the
@@ -294,25 +332,26 @@ class VisionViewSet (AppMixin, ModelViewSet):
         """
         if created:
             # Always tweet with the app's account
-            try:
-                self.tweet_vision_from_app(self.request, vision)
-            except TweetException:
-                vision.delete()
-                raise
+            app_tweet = OutgoingTweet.objects.create(
+                kind=OutgoingTweet.APP_VISION,
+                requested_by=self.request.user,
+                vision=vision,
+                text=self.get_app_tweet_text(self.request, vision))
+            self.send_tweet(app_tweet, 'App tweet not sent: ')
 
             # Also tweet from user's account if requested
             if self.request.META.get('HTTP_X_SEND_TO_TWITTER', False):
-                tweet_text = self.get_user_tweet_text(self.request, vision)
-                service = self.get_twitter_service()
-                success, response = service.tweet(tweet_text,
-                                                  self.request.user)
-                if success:
-                    # Set the user tweet as the primary tweet on the vision
-                    tweet, created = Tweet.objects.create_or_update_from_tweet_data(response)
-                    vision.tweet = tweet
-                    vision.save()
-                else:
-                    raise TweetException('User tweet not sent: ' + response)
+                user_tweet = OutgoingTweet.objects.create(
+                    kind=OutgoingTweet.USER_VISION,
+                    requested_by=self.request.user,
+                    sender=self.request.user,
+                    vision=vision,
+                    text=self.get_user_tweet_text(self.request, vision))
+                self.send_tweet(user_tweet, 'User tweet not sent: ')
+
+    def create(self, request, *args, **kwargs):
+        response = super(VisionViewSet, self).create(request, *args, **kwargs)
+        return self.add_outgoing_tweets(response)
 
 
 class ReplyViewSet (AppMixin, ModelViewSet):
@@ -332,24 +371,24 @@ class ReplyViewSet (AppMixin, ModelViewSet):
 
         return truncatechars(tweet_text, 140)
 
-    def pre_save(self, reply):
+    def post_save(self, reply, created):
         """
-        This is called in the create handler, before the serializer saves the
-        reply. We do it _before_ saving so that we don't need to delete the
-        model instance if the tweet fails.
+        This is called in the create handler, after the serializer saves the
+        reply. The reply's tweet is sent in reply to the vision's tweet.
         """
-        if reply.pk is None:
-            tweet_text = self.get_tweet_text(self.request, reply)
-            service = self.get_twitter_service()
-            success, response = service.tweet(
-                tweet_text, self.request.user,
-                in_reply_to_status_id=reply.vision.tweet_id or reply.vision.app_tweet_id)
+        if created:
+            outgoing_tweet = OutgoingTweet.objects.create(
+                kind=OutgoingTweet.REPLY,
+                requested_by=self.request.user,
+                sender=self.request.user,
+                vision=reply.vision,
+                reply=reply,
+                text=self.get_tweet_text(self.request, reply))
+            self.send_tweet(outgoing_tweet, 'User reply not tweeted: ')
 
-            if success:
-                tweet, created = Tweet.objects.create_or_update_from_tweet_data(response)
-                reply.tweet = tweet
-            else:
-                raise TweetException('User reply not tweeted: ' + response)
+    def create(self, request, *args, **kwargs):
+        response = super(ReplyViewSet, self).create(request, *args, **kwargs)
+        return self.add_outgoing_tweets(response)
 
 
 class SiteMapView (AppMixin, TemplateView):
@@ -431,17 +470,36 @@ class VisionActionViewSet (SingleObjectMixin, AppMixin, ViewSet):
 
     def share(self, request, *args, **kwargs):
         vision = self.get_object()
-        service = self.get_twitter_service()
-        success, response = service.retweet(
-            vision.tweet_id or vision.app_tweet_id, self.request.user)
+        share = self.request.user.share(vision)
+
+        outgoing_tweet = OutgoingTweet.objects.create(
+            kind=OutgoingTweet.SHARE,
+            requested_by=self.request.user,
+            sender=self.request.user,
+            vision=vision,
+            share=share)
+        self.send_tweet(outgoing_tweet, 'Vision not retweeted: ')
+
+        # If the retweet is still on its way, say so and tell the client
+        # where to check on it.
+        if outgoing_tweet.status == OutgoingTweet.PENDING:
+            serializer = OutgoingTweetSerializer(outgoing_tweet)
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-        if success:
-            tweet_id = response['id']
-        else:
-            raise TweetException('User reply not tweeted: ' + response)
 
-        self.request.user.share(vision, tweet_id)
-        return Response(status=status.HTTP_204_NO_CONTENT)
+class OutgoingTweetViewSet (AppMixin, ReadOnlyModelViewSet):
+    """
+    Lets clients check on the tweets that they have asked the app to send.
+    """
+    model = OutgoingTweet
+    serializer_class = OutgoingTweetSerializer
+
+    def get_queryset(self):
+        user = self.request.user
+        if not user.is_authenticated():
+            return OutgoingTweet.objects.none()
+        return OutgoingTweet.objects.filter(requested_by=user)
 
 
 class NotificationsViewSet (AppMixin, ListModelMixin, GenericAPIView, ViewSet):
@@ -481,3 +539,4 @@ api_router = DefaultRouter(trailing_slash=False)
 api_router.register('visions', VisionViewSet)
 api_router.register('users', UserViewSet)
 api_router.register('replies', ReplyViewSet)
+api_router.register('outbox', OutgoingTweetViewSet)
@@ -0,0 +1,81 @@
+"""
+Compare the cost of checking streamed tweets against the tracking keywords,
+the old way (scanning the text for each word of each term) and with the
+compiled KeywordMatcher. Run it from the src directory:
+
+    python scripts/benchmark_keywords.py [number of terms] [number of tweets]
+
+For each number of terms, up to the one given, it prints the microseconds
+spent per tweet with each approach. Most of the made-up tweets match none of
+the terms, as in a busy stream.
+"""
+
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hatch.keywords import KeywordMatcher
+
+
+def old_contains_keywords(streaming_keywords, text):
+    text = text.lower()
+    for term in streaming_keywords:
+        if all(keyword in text for keyword in term.lower().split()):
+            return True
+    return False
+
+
+def make_word(rand):
+    return ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz')
+                   for _ in range(rand.randint(4, 10)))
+
+
+def make_terms(rand, count):
+    return [' '.join(make_word(rand) for _ in range(rand.randint(1, 3)))
+            for _ in range(count)]
+
+
+def make_tweets(rand, terms, count):
+    tweets = []
+    for _ in range(count):
+        words = [make_word(rand) for _ in range(rand.randint(8, 20))]
+        # About one in twenty tweets mentions a term
+        if rand.random() < 0.05:
+            words.append(rand.choice(terms))
+        tweets.append(' '.join(words).title())
+    return tweets
+
+
+def time_per_tweet(check, tweets):
+    start = timer()
+    matched = sum(1 for text in tweets if check(text))
+    return (timer() - start) / len(tweets) * 1e6, matched
+
+
+def main(max_terms=1000, tweet_count=2000):
+    rand = random.Random(1)
+
+    print '%8s  %12s  %12s  %8s' % ('terms', 'old (us)', 'compiled (us)', 'matched')
+    term_count = 1
+    while term_count <= max_terms:
+        terms = make_terms(rand, term_count)
+        tweets = make_tweets(rand, terms, tweet_count)
+
+        old_time, old_matched = time_per_tweet(
+            lambda text: old_contains_keywords(terms, text), tweets)
+
+        build_start = timer()
+        matcher = KeywordMatcher(terms)
+        build_time = timer() - build_start
+        new_time, new_matched = time_per_tweet(matcher.matches, tweets)
+
+        assert old_matched == new_matched
+        print '%8s  %12.1f  %12.1f  %8s  (built in %.1f ms)' % (
+            term_count, old_time, new_time, new_matched, build_time * 1000)
+        term_count *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])